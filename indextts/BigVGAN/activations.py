@@ -45,6 +45,29 @@ class Snake(nn.Module):
         self.alpha.requires_grad = alpha_trainable
 
         self.no_div_by_zero = 0.000000001
+        # freeze() 之后推理用的常量, 不保存到 state_dict
+        self.register_buffer("frozen_alpha", None, persistent=False)
+        self.register_buffer("frozen_inv_beta", None, persistent=False)
+
+    def constants(self):
+        '''
+        (alpha, 1 / (alpha + eps)) lined up with x to [1, C, 1], precomputed by `freeze()` at inference.
+        '''
+        if self.frozen_alpha is not None:
+            return self.frozen_alpha, self.frozen_inv_beta
+        alpha = self.alpha.unsqueeze(0).unsqueeze(-1)  # line up with x to [B, C, T]
+        if self.alpha_logscale:
+            alpha = torch.exp(alpha)
+        return alpha, 1.0 / (alpha + self.no_div_by_zero)
+
+    def freeze(self):
+        '''
+        Precompute `constants()` for inference, after the weights are loaded and the module is moved to its
+        device and dtype; alpha must not change afterwards.
+        '''
+        self.frozen_alpha = self.frozen_inv_beta = None
+        with torch.no_grad():
+            self.frozen_alpha, self.frozen_inv_beta = self.constants()
 
     def forward(self, x):
         '''
@@ -52,10 +75,8 @@ class Snake(nn.Module):
         Applies the function to the input elementwise.
         Snake ∶= x + 1/a * sin^2 (xa)
         '''
-        alpha = self.alpha.unsqueeze(0).unsqueeze(-1)  # line up with x to [B, C, T]
-        if self.alpha_logscale:
-            alpha = torch.exp(alpha)
-        x = x + (1.0 / (alpha + self.no_div_by_zero)) * pow(sin(x * alpha), 2)
+        alpha, inv_beta = self.constants()
+        x = x + inv_beta * pow(sin(x * alpha), 2)
 
         return x
 
@@ -105,18 +126,39 @@ class SnakeBeta(nn.Module):
         self.beta.requires_grad = alpha_trainable
 
         self.no_div_by_zero = 0.000000001
+        # freeze() 之后推理用的常量, 不保存到 state_dict
+        self.register_buffer("frozen_alpha", None, persistent=False)
+        self.register_buffer("frozen_inv_beta", None, persistent=False)
 
-    def forward(self, x):
+    def constants(self):
         '''
-        Forward pass of the function.
-        Applies the function to the input elementwise.
-        SnakeBeta ∶= x + 1/b * sin^2 (xa)
+        (alpha, 1 / (beta + eps)) lined up with x to [1, C, 1], precomputed by `freeze()` at inference.
         '''
+        if self.frozen_alpha is not None:
+            return self.frozen_alpha, self.frozen_inv_beta
         alpha = self.alpha.unsqueeze(0).unsqueeze(-1)  # line up with x to [B, C, T]
         beta = self.beta.unsqueeze(0).unsqueeze(-1)
         if self.alpha_logscale:
             alpha = torch.exp(alpha)
             beta = torch.exp(beta)
-        x = x + (1.0 / (beta + self.no_div_by_zero)) * pow(sin(x * alpha), 2)
+        return alpha, 1.0 / (beta + self.no_div_by_zero)
+
+    def freeze(self):
+        '''
+        Precompute `constants()` for inference, after the weights are loaded and the module is moved to its
+        device and dtype; alpha and beta must not change afterwards.
+        '''
+        self.frozen_alpha = self.frozen_inv_beta = None
+        with torch.no_grad():
+            self.frozen_alpha, self.frozen_inv_beta = self.constants()
+
+    def forward(self, x):
+        '''
+        Forward pass of the function.
+        Applies the function to the input elementwise.
+        SnakeBeta ∶= x + 1/b * sin^2 (xa)
+        '''
+        alpha, inv_beta = self.constants()
+        x = x + inv_beta * pow(sin(x * alpha), 2)
 
         return x
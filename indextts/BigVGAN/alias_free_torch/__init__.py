@@ -4,3 +4,4 @@
 from .act import *
 from .filter import *
 from .resample import *
+from .polyphase import *
@@ -0,0 +1,153 @@
+import torch
+import torch.nn.functional as F
+
+from ..activations import Snake, SnakeBeta
+from .act import Activation1d
+
+__all__ = ["PolyphaseActivation1d"]
+
+
+def _upsample_phases(filter, ratio, pad, pad_left):
+    """
+    Taps of `UpSample1d` per output phase: ``y[ratio * j + q] = sum_m weight[q, m] * x[j + m - left]``
+    on ``x`` replicate padded by ``(left, right)``. Returns ``(weight (ratio, 1, k), left, right)``.
+    """
+    kernel_size = filter.shape[-1]
+    taps = []  # (phase, x offset, filter tap)
+    for q in range(ratio):
+        a = q + pad_left
+        phase, shift = a % ratio, a // ratio - pad
+        for t in range((kernel_size - phase + ratio - 1) // ratio):
+            taps.append((q, shift - t, ratio * t + phase))
+    left = max(0, -min(offset for _, offset, _ in taps))
+    right = max(0, max(offset for _, offset, _ in taps))
+    weight = torch.zeros((ratio, 1, left + right + 1), dtype=filter.dtype)
+    for q, offset, tap in taps:
+        weight[q, 0, left + offset] += ratio * filter[0, 0, tap]
+    return weight, left, right
+
+
+def _downsample_phases(filter, ratio, pad_left):
+    """
+    Taps of `DownSample1d` over the phases of its input: ``out[k] = sum_p sum_m weight[p, m] * z_p[k + m - left]``
+    with ``z_p[u] = z[ratio * u + p]``. Returns ``(weight (ratio, 1, k), left, right)``.
+    """
+    kernel_size = filter.shape[-1]
+    taps = [((t - pad_left) % ratio, (t - pad_left) // ratio, t) for t in range(kernel_size)]
+    left = max(0, -min(offset for _, offset, _ in taps))
+    right = max(0, max(offset for _, offset, _ in taps))
+    weight = torch.zeros((ratio, 1, left + right + 1), dtype=filter.dtype)
+    for p, offset, tap in taps:
+        weight[p, 0, left + offset] += filter[0, 0, tap]
+    return weight, left, right
+
+
+def _replicate_tail(x, lengths, last=None):
+    """Set the samples of every row after its length to ``last`` (B, C, 1), default its last sample."""
+    if last is None:
+        last = x.gather(2, (lengths - 1).view(-1, 1, 1).expand(x.shape[0], x.shape[1], 1))
+    return torch.where(torch.arange(x.shape[-1], device=x.device) < lengths.view(-1, 1, 1), x, last)
+
+
+def _edge_weights(weight, pad):
+    """
+    Replicate padding = zero padding + the edge sample times these weights, on the first and last ``pad`` outputs
+    of ``conv1d(x, weight, padding=pad)``. Returns ``(left (n, pad), right (n, pad))`` for the ``n`` kernels.
+    """
+    weight = weight[:, 0]
+    left = torch.stack([weight[:, :pad - j].sum(dim=-1) for j in range(pad)], dim=-1)
+    right = torch.stack([weight[:, 2 * pad - j:].sum(dim=-1) for j in range(pad)], dim=-1)
+    return left, right
+
+
+def _symmetric(weight, left, right):
+    """Zero taps on one side of the kernels so that they are centered, for ``conv1d(..., padding=pad)``."""
+    pad = max(left, right)
+    return F.pad(weight, (pad - left, pad - right)), pad
+
+
+class PolyphaseActivation1d(Activation1d):
+    """
+    `Activation1d` computed by phases, same parameters and outputs (up to float rounding):
+        - every phase of the upsampled signal is a depthwise conv of the input (no zero stuffing, no transposed conv)
+        - the activation runs on every phase (it is elementwise)
+        - the low-pass filter is only computed at the kept samples, a depthwise conv per phase, summed
+    The convs are zero padded and the replicate padding is added on the edge outputs afterwards,
+    so the signals are never copied into padded buffers.
+    Only for ``up_ratio == down_ratio``, as in BigVGAN.
+    """
+
+    def __init__(self, activation, up_ratio: int = 2, down_ratio: int = 2, up_kernel_size: int = 12,
+                 down_kernel_size: int = 12):
+        super().__init__(activation, up_ratio, down_ratio, up_kernel_size, down_kernel_size)
+        if up_ratio != down_ratio:
+            raise ValueError(f"PolyphaseActivation1d needs up_ratio == down_ratio, got {up_ratio} and {down_ratio}")
+        up_weight, self.up_pad = _symmetric(*_upsample_phases(
+            self.upsample.filter, up_ratio, self.upsample.pad, self.upsample.pad_left))
+        lowpass = self.downsample.lowpass
+        down_weight, self.down_pad = _symmetric(*_downsample_phases(lowpass.filter, down_ratio, lowpass.pad_left))
+        up_left, up_right = _edge_weights(up_weight, self.up_pad)
+        down_left, down_right = _edge_weights(down_weight, self.down_pad)
+        # 由 upsample / downsample 的 filter 计算得到, 不保存到 state_dict, checkpoint 与 Activation1d 通用
+        self.register_buffer("up_weight", up_weight, persistent=False)
+        self.register_buffer("up_left", up_left, persistent=False)
+        self.register_buffer("up_right", up_right, persistent=False)
+        self.register_buffer("down_weight", down_weight, persistent=False)
+        # 各相位的输出相加, 边缘修正也相加
+        self.register_buffer("down_left", down_left.sum(dim=0), persistent=False)
+        self.register_buffer("down_right", down_right.sum(dim=0), persistent=False)
+
+    def _activation(self, x):
+        """`Snake` / `SnakeBeta` with one temporary tensor instead of one per op, same result; other activations as is."""
+        act = self.act
+        if not isinstance(act, (Snake, SnakeBeta)):
+            return act(x)
+        alpha, inv_beta = act.constants()
+        y = x * alpha
+        y.sin_()
+        y.mul_(y)
+        return y.mul_(inv_beta).add_(x)
+
+    def _filter(self, x, weight, pad):
+        """Depthwise conv of every channel of ``x`` with the kernel ``weight`` (1, 1, k), zero padded."""
+        return F.conv1d(x, weight.to(x.dtype).expand(x.shape[1], -1, -1), padding=pad, groups=x.shape[1])
+
+    # x: [B,C,T]
+    def forward(self, x, lengths=None):
+        """
+        lengths: (B,) samples of every row of a right padded batch, see `models.masked_activation()`
+        """
+        B, C, T = x.shape
+        if T < 2 * max(self.up_pad, self.down_pad):
+            # the left and right edges overlap
+            return super().forward(x) if lengths is None else self._masked_reference(x, lengths)
+        if lengths is not None:
+            x = _replicate_tail(x, lengths)
+        pad = self.up_pad
+        phases = []
+        for q in range(self.up_ratio):
+            z = self._filter(x, self.up_weight[q:q + 1], pad)
+            z[..., :pad] += x[..., :1] * self.up_left[q].to(x.dtype)
+            z[..., -pad:] += x[..., -1:] * self.up_right[q].to(x.dtype)
+            phases.append(self._activation(z))
+
+        # replicate padding of the upsampled signal: first sample is in phase 0, last one in the last phase
+        first = phases[0][..., :1]
+        if lengths is None:
+            last = phases[-1][..., -1:]
+        else:
+            last = phases[-1].gather(2, (lengths - 1).view(-1, 1, 1).expand(B, C, 1))
+            phases = [_replicate_tail(z, lengths, last) for z in phases]
+        pad = self.down_pad
+        out = None
+        for p, z in enumerate(phases):
+            z = self._filter(z, self.down_weight[p:p + 1], pad)
+            out = z if out is None else out.add_(z)
+        out[..., :pad] += first * self.down_left.to(out.dtype)
+        out[..., -pad:] += last * self.down_right.to(out.dtype)
+        return out
+
+    def _masked_reference(self, x, lengths):
+        x = self.upsample(_replicate_tail(x, lengths))
+        x = self.act(x)
+        return self.downsample(_replicate_tail(x, lengths * self.up_ratio))
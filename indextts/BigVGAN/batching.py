@@ -0,0 +1,62 @@
+import math
+from typing import List, Optional, Sequence, Union
+
+import torch
+import torch.nn.functional as F
+
+from indextts.BigVGAN.models import BigVGAN
+
+
+def hop_length(bigvgan: BigVGAN) -> int:
+    """Waveform samples per GPT latent frame."""
+    return math.prod(bigvgan.h.upsample_rates) * (4 if bigvgan.feat_upsample else 1)
+
+
+@torch.no_grad()
+def vocode_batch(bigvgan: BigVGAN, latents: Sequence[torch.Tensor],
+                 speaker_embeddings: Optional[Union[torch.Tensor, Sequence[torch.Tensor]]] = None, max_batch_size=4,
+                 bucket_frames=16, cond_biases: Optional[Sequence] = None) -> List[torch.Tensor]:
+    """
+    Vocode latents of different lengths and voices (sentences of one or several requests) in padded batches:
+    the rows are sorted by length, grouped by ``max_batch_size``, right padded to a multiple of ``bucket_frames``
+    (fewer distinct shapes for cudnn / compiled kernels) and decoded with their lengths, see `BigVGAN.forward()`.
+    Every waveform is the one of the row decoded alone, up to float rounding.
+    Args:
+        latents: (1, t, gpt_dim) or (t, gpt_dim) GPT latents of every row
+        speaker_embeddings: (1, 1, dim) `BigVGAN.get_speaker_embedding()` of every row, or one for all rows
+        cond_biases: `BigVGAN.get_conditioning_biases()` of every row, or one for all rows,
+            instead of ``speaker_embeddings``
+    Returns:
+        the (1, t * hop_length) float waveforms, in the order of ``latents``
+    """
+    latents = [latent[0] if latent.ndim == 3 else latent for latent in latents]
+    if cond_biases is not None:
+        # one list of biases for all rows, or one per row
+        conditions = [cond_biases] * len(latents) if isinstance(cond_biases[0], torch.Tensor) else cond_biases
+    elif speaker_embeddings is not None:
+        conditions = [speaker_embeddings] * len(latents) \
+            if isinstance(speaker_embeddings, torch.Tensor) else speaker_embeddings
+    else:
+        raise ValueError("vocode_batch needs `speaker_embeddings` or `cond_biases`")
+    if len(conditions) != len(latents):
+        raise ValueError(f"Got {len(conditions)} speaker conditions for {len(latents)} latents")
+    hop = hop_length(bigvgan)
+    order = sorted(range(len(latents)), key=lambda i: latents[i].shape[0])
+    wavs: List[torch.Tensor] = [None] * len(latents)
+    for start in range(0, len(order), max_batch_size):
+        rows = order[start:start + max_batch_size]
+        lengths = [latents[i].shape[0] for i in rows]
+        frames = math.ceil(max(lengths) / bucket_frames) * bucket_frames
+        x = torch.stack([F.pad(latents[i], (0, 0, 0, frames - latents[i].shape[0])) for i in rows])
+        x_lengths = None
+        if min(lengths) < frames:
+            x_lengths = torch.tensor(lengths, device=x.device)
+        if cond_biases is None:
+            speaker_embedding = torch.cat([conditions[i].reshape(1, 1, -1) for i in rows])
+            wav, _ = bigvgan(x, None, speaker_embedding=speaker_embedding, x_lengths=x_lengths)
+        else:
+            biases = [torch.cat(layer_biases) for layer_biases in zip(*(conditions[i] for i in rows))]
+            wav, _ = bigvgan(x, None, x_lengths=x_lengths, cond_biases=biases)
+        for row, i in enumerate(rows):
+            wavs[i] = wav[row, :, :lengths[row] * hop]
+    return wavs
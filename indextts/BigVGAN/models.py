@@ -3,6 +3,9 @@
 
 # Adapted from https://github.com/jik876/hifi-gan under the MIT license.
 #   LICENSE is in incl_licenses directory.
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -11,11 +14,114 @@ from torch.nn.utils import remove_weight_norm, spectral_norm, weight_norm
 
 import indextts.BigVGAN.activations as activations
 
+from indextts.BigVGAN.alias_free_torch.polyphase import PolyphaseActivation1d
 from indextts.BigVGAN.ECAPA_TDNN import ECAPA_TDNN
 from indextts.BigVGAN.utils import get_padding, init_weights
 
 LRELU_SLOPE = 0.1
 
+_resblock_pool = None
+_resblock_pool_size = 0
+_resblock_streams = {}
+_resblock_lock = threading.Lock()
+
+
+def _autocast_state(device_type):
+    """(enabled, dtype) of autocast on the calling thread, autocast and grad mode are thread local."""
+    if hasattr(torch, "get_autocast_dtype"):
+        return torch.is_autocast_enabled(device_type), torch.get_autocast_dtype(device_type)
+    if device_type == "cpu":
+        return torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype()
+    return torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()
+
+
+def _run_block(block, x, lengths, grad_enabled, device_type, autocast_enabled, autocast_dtype):
+    with torch.set_grad_enabled(grad_enabled), \
+            torch.amp.autocast(device_type, enabled=autocast_enabled, dtype=autocast_dtype):
+        return block(x, lengths)
+
+
+def run_blocks_concurrently(blocks, x, lengths=None):
+    """
+    Outputs of the AMP blocks of one upsampling stage on the same input, evaluated concurrently:
+    on CUDA each block on its own stream, on CPU the other blocks on worker threads (the convolutions release the GIL).
+    The outputs are the ones of the sequential calls.
+    """
+    global _resblock_pool, _resblock_pool_size
+    if x.is_cuda:
+        main = torch.cuda.current_stream(x.device)
+        with _resblock_lock:
+            streams = _resblock_streams.setdefault(x.device, [])
+            streams.extend(torch.cuda.Stream(x.device) for _ in range(len(blocks) - len(streams)))
+        outputs = []
+        for block, stream in zip(blocks, streams):
+            stream.wait_stream(main)
+            with torch.cuda.stream(stream):
+                outputs.append((block(x, lengths), stream))
+        for output, stream in outputs:
+            main.wait_stream(stream)
+            # 其他 stream 上分配或使用的显存, 在主 stream 用完之前不能复用
+            output.record_stream(main)
+            x.record_stream(stream)
+        return [output for output, _ in outputs]
+    with _resblock_lock:
+        if _resblock_pool_size < len(blocks) - 1:
+            if _resblock_pool is not None:
+                # 已提交的任务仍会执行完, 之后线程退出
+                _resblock_pool.shutdown(wait=False)
+            _resblock_pool_size = len(blocks) - 1
+            _resblock_pool = ThreadPoolExecutor(max_workers=_resblock_pool_size, thread_name_prefix="bigvgan-resblock")
+        pool = _resblock_pool
+    state = (torch.is_grad_enabled(), x.device.type) + _autocast_state(x.device.type)
+    futures = [pool.submit(_run_block, block, x, lengths, *state) for block in blocks[1:]]
+    return [blocks[0](x, lengths)] + [future.result() for future in futures]
+
+
+def get_activation1d(h):
+    """`Activation1d` class of the config: the fused CUDA kernel, the polyphase torch version, or the torch reference."""
+    if h.get("use_cuda_kernel", False):
+        from indextts.BigVGAN.alias_free_activation.cuda.activation1d import Activation1d
+        return Activation1d
+    if h.get("polyphase_activation", False):
+        return PolyphaseActivation1d
+    from indextts.BigVGAN.alias_free_torch import Activation1d
+    return Activation1d
+
+
+def _length_mask(x, lengths):
+    """(b, 1, t) bool mask of the first ``lengths[i]`` samples of every row of ``x``."""
+    return torch.arange(x.shape[-1], device=x.device) < lengths.view(-1, 1, 1)
+
+
+def zero_padding(x, lengths=None):
+    """Zero the samples of every row after its length, the zero padding of the convs for the padded rows."""
+    if lengths is None:
+        return x
+    return x.masked_fill(~_length_mask(x, lengths), 0.0)
+
+
+def replicate_padding(x, lengths=None):
+    """Repeat the last sample of every row after its length, the replicate padding of the resampling filters."""
+    if lengths is None:
+        return x
+    last = x.gather(2, (lengths - 1).view(-1, 1, 1).expand(x.shape[0], x.shape[1], 1))
+    return torch.where(_length_mask(x, lengths), x, last)
+
+
+def masked_activation(activation, x, lengths=None):
+    """
+    `Activation1d` of a batch of padded rows, the samples of every row before its length are the same as with
+    the row alone (up to float rounding), the ones after are undefined.
+    """
+    if lengths is None:
+        return activation(x)
+    if isinstance(activation, PolyphaseActivation1d):
+        return activation(x, lengths)
+    x = activation.upsample(replicate_padding(x, lengths))
+    x = activation.act(x)
+    x = replicate_padding(x, lengths * activation.up_ratio)
+    return activation.downsample(x)
+
 
 class AMPBlock1(torch.nn.Module):
     def __init__(self, h, channels, kernel_size=3, dilation=(1, 3, 5), activation=None):
@@ -43,10 +149,7 @@ class AMPBlock1(torch.nn.Module):
         self.convs2.apply(init_weights)
 
         self.num_layers = len(self.convs1) + len(self.convs2)  # total number of conv layers
-        if self.h.get("use_cuda_kernel", False):
-            from indextts.BigVGAN.alias_free_activation.cuda.activation1d import Activation1d
-        else:
-            from indextts.BigVGAN.alias_free_torch import Activation1d
+        Activation1d = get_activation1d(self.h)
         if activation == 'snake':  # periodic nonlinearity with snake function and anti-aliasing
             self.activations = nn.ModuleList([
                 Activation1d(
@@ -62,13 +165,13 @@ class AMPBlock1(torch.nn.Module):
         else:
             raise NotImplementedError("activation incorrectly specified. check the config file and look for 'activation'.")
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
         acts1, acts2 = self.activations[::2], self.activations[1::2]
         for c1, c2, a1, a2 in zip(self.convs1, self.convs2, acts1, acts2):
-            xt = a1(x)
-            xt = c1(xt)
-            xt = a2(xt)
-            xt = c2(xt)
+            xt = masked_activation(a1, x, lengths)
+            xt = c1(zero_padding(xt, lengths))
+            xt = masked_activation(a2, xt, lengths)
+            xt = c2(zero_padding(xt, lengths))
             x = xt + x
 
         return x
@@ -94,10 +197,7 @@ class AMPBlock2(torch.nn.Module):
         self.convs.apply(init_weights)
 
         self.num_layers = len(self.convs)  # total number of conv layers
-        if self.h.get("use_cuda_kernel", False):
-            from indextts.BigVGAN.alias_free_activation.cuda.activation1d import Activation1d
-        else:
-            from indextts.BigVGAN.alias_free_torch import Activation1d
+        Activation1d = get_activation1d(self.h)
 
         if activation == 'snake':  # periodic nonlinearity with snake function and anti-aliasing
             self.activations = nn.ModuleList([
@@ -114,10 +214,10 @@ class AMPBlock2(torch.nn.Module):
         else:
             raise NotImplementedError("activation incorrectly specified. check the config file and look for 'activation'.")
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
         for c, a in zip(self.convs, self.activations):
-            xt = a(x)
-            xt = c(xt)
+            xt = masked_activation(a, x, lengths)
+            xt = c(zero_padding(xt, lengths))
             x = xt + x
 
         return x
@@ -129,21 +229,26 @@ class AMPBlock2(torch.nn.Module):
 
 class BigVGAN(torch.nn.Module):
     # this is our main BigVGAN model. Applies anti-aliased periodic activation for resblocks.
-    def __init__(self, h, use_cuda_kernel=False):
+    def __init__(self, h, use_cuda_kernel=False, polyphase_activation=False):
         """
         Args:
             h (dict)
             use_cuda_kernel (bool): whether to use custom cuda kernel for anti-aliased activation
+            polyphase_activation (bool): whether to use `PolyphaseActivation1d` for the torch anti-aliased activation,
+                faster on CPU, same weights and outputs up to float rounding
         """
         super(BigVGAN, self).__init__()
         self.h = h
         self.h["use_cuda_kernel"] = use_cuda_kernel
+        self.h["polyphase_activation"] = polyphase_activation
 
         self.num_kernels = len(h.resblock_kernel_sizes)
         self.num_upsamples = len(h.upsample_rates)
 
         self.feat_upsample = h.feat_upsample
         self.cond_in_each_up_layer = h.cond_d_vector_in_each_upsampling_layer
+        # 推理时同一上采样层的 num_kernels 个 AMP block 并发执行, 见 `run_blocks_concurrently()`
+        self.parallel_resblocks = False
 
         # pre conv
         self.conv_pre = weight_norm(Conv1d(h.gpt_dim, h.upsample_initial_channel, 7, 1, padding=3))
@@ -166,10 +271,7 @@ class BigVGAN(torch.nn.Module):
             ch = h.upsample_initial_channel // (2 ** (i + 1))
             for j, (k, d) in enumerate(zip(h.resblock_kernel_sizes, h.resblock_dilation_sizes)):
                 self.resblocks.append(resblock(self.h, ch, k, d, activation=h.activation))
-        if use_cuda_kernel:
-            from indextts.BigVGAN.alias_free_activation.cuda.activation1d import Activation1d
-        else:
-            from indextts.BigVGAN.alias_free_torch import Activation1d
+        Activation1d = get_activation1d(self.h)
 
         # post conv
         if h.activation == "snake":  # periodic nonlinearity with snake function and anti-aliasing
@@ -198,53 +300,106 @@ class BigVGAN(torch.nn.Module):
 
         # self.logit_scale = nn.Parameter(torch.ones([]) * np.log(1 / 0.07))
 
-    def forward(self, x, mel_ref, lens=None):
-        speaker_embedding = self.speaker_encoder(mel_ref, lens)
+    def get_speaker_embedding(self, mel_ref, lens=None):
+        """
+        mel_ref: (b, frames, n_mels) reference mel spectrogram
+        Returns the ECAPA-TDNN speaker embedding in shape (b, 1, speaker_embedding_dim),
+        which can be cached and passed to `forward(..., speaker_embedding=...)`.
+        """
+        return self.speaker_encoder(mel_ref, lens)
+
+    def get_conditioning_biases(self, speaker_embedding):
+        """
+        speaker_embedding: (b, 1, speaker_embedding_dim)
+        Returns the speaker conditioning added after `conv_pre` and after each upsampling layer,
+        ``[cond_layer(e), conds[0](e), ...]`` in shapes (b, channels, 1), constant per voice,
+        which can be cached and passed to `forward(..., cond_biases=...)`.
+        """
+        speaker_embedding = speaker_embedding.transpose(1, 2)
+        biases = [self.cond_layer(speaker_embedding)]
+        if self.cond_in_each_up_layer:
+            biases.extend(cond(speaker_embedding) for cond in self.conds)
+        return biases
+
+    def freeze_for_inference(self):
+        """
+        Precompute the constants of the `Snake` / `SnakeBeta` activations, see `Snake.freeze()`.
+        Call it after loading the weights, `remove_weight_norm()` and moving the model to its device / dtype.
+        """
+        for module in self.modules():
+            if isinstance(module, (activations.Snake, activations.SnakeBeta)):
+                module.freeze()
+        return self
+
+    def forward(self, x, mel_ref, lens=None, speaker_embedding=None, x_lengths=None, cond_biases=None):
+        """
+        x: (b, frames, gpt_dim) GPT latents
+        speaker_embedding: (b, 1, speaker_embedding_dim), one voice per row
+        cond_biases: `get_conditioning_biases()` of the speaker embeddings, instead of ``speaker_embedding``
+        x_lengths: (b,) frames of every row of a right padded batch, the samples of row ``i`` before
+            ``x_lengths[i] * hop_length`` are the same as with the row alone (up to float rounding),
+            the ones after are undefined; see `vocode_batch()`.
+        """
         n_batch = x.size(0)
         contrastive_loss = None
-        if n_batch * 2 == speaker_embedding.size(0):
-            spe_emb_chunk1, spe_emb_chunk2 = speaker_embedding[:n_batch, :, :], speaker_embedding[n_batch:, :, :]
-            contrastive_loss = self.cal_clip_loss(spe_emb_chunk1.squeeze(1), spe_emb_chunk2.squeeze(1), self.logit_scale.exp())
+        if cond_biases is None:
+            if speaker_embedding is None:
+                speaker_embedding = self.speaker_encoder(mel_ref, lens)
+            if n_batch * 2 == speaker_embedding.size(0):
+                spe_emb_chunk1, spe_emb_chunk2 = speaker_embedding[:n_batch, :, :], speaker_embedding[n_batch:, :, :]
+                contrastive_loss = self.cal_clip_loss(spe_emb_chunk1.squeeze(1), spe_emb_chunk2.squeeze(1), self.logit_scale.exp())
 
-            speaker_embedding = speaker_embedding[:n_batch, :, :]
-        speaker_embedding = speaker_embedding.transpose(1, 2)
+                speaker_embedding = speaker_embedding[:n_batch, :, :]
+            cond_biases = self.get_conditioning_biases(speaker_embedding)
+        lengths = x_lengths
 
         # upsample feat
         if self.feat_upsample:
             x = torch.nn.functional.interpolate(
-                x.transpose(1, 2),
+                replicate_padding(x.transpose(1, 2), lengths),
                 scale_factor=[4],
                 mode="linear",
             ).squeeze(1)
+            if lengths is not None:
+                lengths = lengths * 4
         else:
             x = x.transpose(1, 2)
 
         ### bigVGAN ###
         # pre conv
-        x = self.conv_pre(x)
+        x = self.conv_pre(zero_padding(x, lengths))
 
-        x = x + self.cond_layer(speaker_embedding)
+        x = x + cond_biases[0]
 
         for i in range(self.num_upsamples):
             # upsampling
             for i_up in range(len(self.ups[i])):
-                x = self.ups[i][i_up](x)
+                x = self.ups[i][i_up](zero_padding(x, lengths))
+                if lengths is not None:
+                    lengths = lengths * self.ups[i][i_up].stride[0]
 
             if self.cond_in_each_up_layer:
-                x = x + self.conds[i](speaker_embedding)
+                x = x + cond_biases[i + 1]
 
             # AMP blocks
-            xs = None
-            for j in range(self.num_kernels):
-                if xs is None:
-                    xs = self.resblocks[i * self.num_kernels + j](x)
-                else:
-                    xs += self.resblocks[i * self.num_kernels + j](x)
+            if self.parallel_resblocks and self.num_kernels > 1:
+                outputs = run_blocks_concurrently(self.resblocks[i * self.num_kernels:(i + 1) * self.num_kernels],
+                                                  x, lengths)
+                xs = outputs[0]
+                for output in outputs[1:]:
+                    xs += output
+            else:
+                xs = None
+                for j in range(self.num_kernels):
+                    if xs is None:
+                        xs = self.resblocks[i * self.num_kernels + j](x, lengths)
+                    else:
+                        xs += self.resblocks[i * self.num_kernels + j](x, lengths)
             x = xs / self.num_kernels
 
         # post conv
-        x = self.activation_post(x)
-        x = self.conv_post(x)
+        x = masked_activation(self.activation_post, x, lengths)
+        x = self.conv_post(zero_padding(x, lengths))
         x = torch.tanh(x)
 
         return x, contrastive_loss
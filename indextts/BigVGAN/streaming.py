@@ -0,0 +1,164 @@
+import math
+from typing import Iterable, Iterator, List, Optional
+
+import torch
+
+from indextts.BigVGAN.batching import hop_length
+from indextts.BigVGAN.models import AMPBlock1, BigVGAN
+
+
+def to_pcm16(wav: torch.Tensor) -> torch.Tensor:
+    """float waveform in [-1, 1] -> int16 PCM, the same conversion as `IndexTTS.infer()`."""
+    return torch.clamp(32767 * wav, -32767.0, 32767.0).type(torch.int16)
+
+
+def _conv_reach(conv) -> int:
+    """One-sided reach of a "same" padded Conv1d, in input samples."""
+    return conv.dilation[0] * (conv.kernel_size[0] - 1) // 2
+
+
+def _activation_reach(activation) -> int:
+    """One-sided reach of `Activation1d` (replicate padded up/down sampling filters), in input samples."""
+    up, down = activation.upsample, activation.downsample
+    # each filter spans kernel_size / 2 samples on each side at the upsampled rate
+    return math.ceil(up.kernel_size / 2 / up.ratio) + math.ceil(down.kernel_size / 2 / down.ratio)
+
+
+def _resblock_reach(block) -> int:
+    if isinstance(block, AMPBlock1):
+        acts1, acts2 = block.activations[::2], block.activations[1::2]
+        return sum(_activation_reach(a1) + _conv_reach(c1) + _activation_reach(a2) + _conv_reach(c2)
+                   for c1, c2, a1, a2 in zip(block.convs1, block.convs2, acts1, acts2))
+    return sum(_activation_reach(a) + _conv_reach(c) for c, a in zip(block.convs, block.activations))
+
+
+def receptive_field_frames(bigvgan: BigVGAN) -> int:
+    """
+    One-sided receptive field of the generator in GPT latent frames: the outputs of a window farther than this
+    from its edges do not see the zero/replicate padding of the edges, through `conv_pre`, the transposed conv
+    upsamplers, the AMP blocks and the `Activation1d` filters. Conservative, rounded up.
+    """
+    frames = 0.0
+    rate = 1  # samples per latent frame at the input of the current layer
+    if bigvgan.feat_upsample:
+        frames += 1
+        rate = 4
+    frames += _conv_reach(bigvgan.conv_pre) / rate
+    for i in range(bigvgan.num_upsamples):
+        for up in bigvgan.ups[i]:
+            frames += (math.ceil(up.kernel_size[0] / 2 / up.stride[0]) + 1) / rate
+            rate *= up.stride[0]
+        blocks = bigvgan.resblocks[i * bigvgan.num_kernels:(i + 1) * bigvgan.num_kernels]
+        frames += max(_resblock_reach(block) for block in blocks) / rate
+    frames += (_activation_reach(bigvgan.activation_post) + _conv_reach(bigvgan.conv_post)) / rate
+    return math.ceil(frames) + 1
+
+
+class StreamingVocoder:
+    """
+    Incremental BigVGAN decoding of the GPT latents of one utterance:
+    the latent frames are pushed as they come and vocoded by windows with ``context_frames`` frames of context on
+    both sides (the receptive field by default), so the audio is the same as the one of `BigVGAN.forward()` on the
+    whole sequence, up to float rounding. The first window starts at the first frame and `flush()` decodes the last
+    one up to the last frame, like the edges of the full decoding.
+    The first window has ``window_frames`` frames for a short time to first audio, the next ones double up to
+    ``max_window_frames`` so that the context is decoded less often.
+    ```
+    vocoder = StreamingVocoder(tts.bigvgan, speaker_embedding=speaker.speaker_embedding)
+    for latents in latent_chunks:  # (1, t, dim)
+        pcm = vocoder.push(latents)  # int16 (samples,) or None
+    pcm = vocoder.flush()
+    ```
+    """
+
+    def __init__(self, bigvgan: BigVGAN, mel_ref: Optional[torch.Tensor] = None,
+                 speaker_embedding: Optional[torch.Tensor] = None, window_frames=16, max_window_frames=128,
+                 context_frames: Optional[int] = None, cond_biases: Optional[List[torch.Tensor]] = None):
+        """
+        Args:
+            mel_ref: (1, frames, n_mels) reference mel spectrogram, if ``speaker_embedding`` is not given
+            speaker_embedding: (1, 1, dim) `BigVGAN.get_speaker_embedding()` of the reference
+            cond_biases: `BigVGAN.get_conditioning_biases()` of the speaker embedding, computed by the first window
+                if not given
+        """
+        if speaker_embedding is None and cond_biases is None:
+            if mel_ref is None:
+                raise ValueError("StreamingVocoder needs `mel_ref` or `speaker_embedding`")
+            with torch.no_grad():
+                speaker_embedding = bigvgan.get_speaker_embedding(mel_ref)
+        self.bigvgan = bigvgan
+        self.speaker_embedding = speaker_embedding
+        self.cond_biases = cond_biases
+        self.window_frames = window_frames
+        self.max_window_frames = max(window_frames, max_window_frames)
+        self.context_frames = receptive_field_frames(bigvgan) if context_frames is None else context_frames
+        self.hop_length = hop_length(bigvgan)
+        self.reset()
+
+    def reset(self):
+        """Start a new utterance."""
+        self._chunks: List[torch.Tensor] = []
+        self._offset = 0  # latent frame of the first buffered frame
+        self.num_frames = 0
+        self.emitted_frames = 0
+        self.finished = False
+        self._window = self.window_frames
+
+    def _buffer(self) -> torch.Tensor:
+        if len(self._chunks) > 1:
+            self._chunks = [torch.cat(self._chunks, dim=1)]
+        return self._chunks[0]
+
+    @torch.no_grad()
+    def _decode(self, end: int) -> torch.Tensor:
+        """PCM of the frames [emitted_frames, end - context) (or up to ``end`` if it is the last frame)."""
+        start = max(0, self.emitted_frames - self.context_frames)
+        last = end == self.num_frames and self.finished
+        stop = end if last else end - self.context_frames
+        latents = self._buffer()[:, start - self._offset:end - self._offset]
+        if self.cond_biases is None:
+            # 每个窗口的音色条件都一样, 只计算一次
+            self.cond_biases = self.bigvgan.get_conditioning_biases(self.speaker_embedding)
+        wav, _ = self.bigvgan(latents, None, cond_biases=self.cond_biases)
+        wav = wav.squeeze(1)[0, (self.emitted_frames - start) * self.hop_length:(stop - start) * self.hop_length]
+        self.emitted_frames = stop
+        self._window = min(self._window * 2, self.max_window_frames)
+        # keep the left context of the next window
+        drop = max(0, self.emitted_frames - self.context_frames) - self._offset
+        if drop > 0:
+            self._chunks = [self._buffer()[:, drop:]]
+            self._offset += drop
+        return to_pcm16(wav.float())
+
+    def push(self, latents: torch.Tensor) -> Optional[torch.Tensor]:
+        """
+        Add the latent frames (1, t, dim), returns the int16 PCM (samples,) of the completed windows or None.
+        """
+        if self.finished:
+            raise RuntimeError("StreamingVocoder is flushed, call `reset()` to start a new utterance")
+        if latents.shape[1] == 0:
+            return None
+        self._chunks.append(latents)
+        self.num_frames += latents.shape[1]
+        ready = (self.num_frames - self.context_frames - self.emitted_frames) // self._window
+        if ready <= 0:
+            return None
+        return self._decode(self.emitted_frames + ready * self._window + self.context_frames)
+
+    def flush(self) -> Optional[torch.Tensor]:
+        """End of the utterance, returns the int16 PCM of the remaining frames or None."""
+        self.finished = True
+        if self.num_frames <= self.emitted_frames:
+            return None
+        return self._decode(self.num_frames)
+
+    def stream(self, latent_chunks: Iterable[torch.Tensor]) -> Iterator[torch.Tensor]:
+        """Yield the int16 PCM chunks of the latent chunks (1, t, dim) of one utterance."""
+        self.reset()
+        for latents in latent_chunks:
+            pcm = self.push(latents)
+            if pcm is not None:
+                yield pcm
+        pcm = self.flush()
+        if pcm is not None:
+            yield pcm
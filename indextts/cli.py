@@ -4,24 +4,155 @@ import warnings
 # Suppress warnings from tensorflow and other libraries
 warnings.filterwarnings("ignore", category=UserWarning)
 warnings.filterwarnings("ignore", category=FutureWarning)
+
+
+def default_device():
+    import torch
+    if torch.cuda.is_available():
+        return "cuda:0"
+    elif torch.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def register_voice_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="indextts register-voice",
+                                     description="Precompute the speaker conditioning of a reference audio and save it to the voice store")
+    parser.add_argument("name", type=str, help="Voice name, used as `--voice` afterwards")
+    parser.add_argument("wav_path", type=str, help="Path to the reference audio file (wav format)")
+    parser.add_argument("-c", "--config", type=str, default="checkpoints/config.yaml", help="Path to the config file. Default is 'checkpoints/config.yaml'")
+    parser.add_argument("--model_dir", type=str, default="checkpoints", help="Path to the model directory. Default is 'checkpoints'")
+    parser.add_argument("--voice_dir", type=str, default=None, help="Path to the voice store directory. Default is '<model_dir>/voices'")
+    parser.add_argument("-f", "--force", action="store_true", default=False, help="Force to overwrite the voice if it exists")
+    parser.add_argument("-d", "--device", type=str, default=None, help="Device to run the model on (cpu, cuda, mps)." )
+    args = parser.parse_args(argv)
+    if not os.path.isfile(args.wav_path):
+        print(f"Audio file {args.wav_path} does not exist.")
+        sys.exit(1)
+    if not os.path.exists(args.config):
+        print(f"Config file {args.config} does not exist.")
+        sys.exit(1)
+    from indextts.utils.voice_store import VoiceStore
+    if not VoiceStore.is_valid_name(args.name):
+        print(f"ERROR: Invalid voice name {args.name!r}, only letters, digits, '_', '-' and '.' are allowed.")
+        sys.exit(1)
+    voice_dir = args.voice_dir if args.voice_dir is not None else os.path.join(args.model_dir, "voices")
+    if VoiceStore(voice_dir).exists(args.name) and not args.force:
+        print(f"ERROR: Voice {args.name!r} already exists in {voice_dir}. Use --force to overwrite.")
+        sys.exit(1)
+
+    device = args.device if args.device is not None else default_device()
+    from indextts.infer import IndexTTS
+    tts = IndexTTS(cfg_path=args.config, model_dir=args.model_dir, is_fp16=device != "cpu", device=device, voice_dir=voice_dir)
+    tts.register_voice(args.name, args.wav_path, overwrite=args.force)
+
+
+def convert_checkpoint_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="indextts convert-checkpoint",
+                                     description="Convert the GPT and BigVGAN .pth checkpoints to .safetensors for memory-mapped loading")
+    parser.add_argument("-c", "--config", type=str, default="checkpoints/config.yaml", help="Path to the config file. Default is 'checkpoints/config.yaml'")
+    parser.add_argument("--model_dir", type=str, default="checkpoints", help="Path to the model directory. Default is 'checkpoints'")
+    parser.add_argument("-f", "--force", action="store_true", default=False, help="Force to overwrite existing .safetensors files")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.config):
+        print(f"Config file {args.config} does not exist.")
+        sys.exit(1)
+    from omegaconf import OmegaConf
+    from indextts.utils.checkpoint import checkpoint_safetensors_path, convert_checkpoint
+    cfg = OmegaConf.load(args.config)
+    for name in (cfg.gpt_checkpoint, cfg.bigvgan_checkpoint):
+        model_pth = os.path.join(args.model_dir, name)
+        output_path = checkpoint_safetensors_path(model_pth)
+        if os.path.exists(output_path) and not args.force:
+            print(f">> {output_path} already exists, skipped. Use --force to overwrite.")
+            continue
+        convert_checkpoint(model_pth, output_path)
+        print(f">> {model_pth} converted to: {output_path}")
+
+
+def export_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="indextts export",
+                                     description="Export an inference-only bundle: training-only weights stripped, weight norm folded, "
+                                                 "pre-cast dtype variants and a manifest with hashes")
+    parser.add_argument("output_dir", type=str, help="Output bundle directory, used as `--model_dir` afterwards")
+    parser.add_argument("-c", "--config", type=str, default="checkpoints/config.yaml", help="Path to the config file. Default is 'checkpoints/config.yaml'")
+    parser.add_argument("--model_dir", type=str, default="checkpoints", help="Path to the model directory. Default is 'checkpoints'")
+    parser.add_argument("--dtypes", type=str, nargs="+", default=["float32", "float16"], choices=["float32", "float16", "bfloat16"],
+                        help="GPT weight variants to export, float32 is always exported. Default is 'float32 float16'")
+    parser.add_argument("--verify", action="store_true", default=False, help="Verify the file hashes of the exported bundle")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.config):
+        print(f"Config file {args.config} does not exist.")
+        sys.exit(1)
+    if os.path.abspath(args.output_dir) == os.path.abspath(args.model_dir):
+        print("ERROR: output_dir must be different from model_dir.")
+        sys.exit(1)
+    from indextts.utils.export import export_inference_bundle, verify_bundle
+    export_inference_bundle(args.config, args.model_dir, args.output_dir, dtypes=args.dtypes)
+    if args.verify:
+        mismatched = verify_bundle(args.output_dir)
+        if mismatched:
+            print("ERROR: hash mismatch:", *mismatched, sep="\n  ")
+            sys.exit(1)
+        print(">> bundle verified")
+
+
+def build_normalizer_cache_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="indextts build-normalizer-cache",
+                                     description="Prebuild the text normalizer FSTs into a cache directory that workers can share read-only "
+                                                 "(point them at it with $INDEXTTS_TN_CACHE_DIR)")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Cache directory. Default is $INDEXTTS_TN_CACHE_DIR, or the cache directory inside the package")
+    parser.add_argument("-f", "--force", action="store_true", default=False, help="Rebuild the FSTs even if they exist")
+    args = parser.parse_args(argv)
+    from indextts.utils.front import TextNormalizer
+    normalizer = TextNormalizer(cache_dir=args.cache_dir)
+    normalizer.build_cache(overwrite=args.force)
+    normalizer.check_cache()
+    print(">> text normalizer FST cache is ready:", normalizer.cache_dir)
+
+
+SUBCOMMANDS = {
+    "register-voice": register_voice_main,
+    "convert-checkpoint": convert_checkpoint_main,
+    "export": export_main,
+    "build-normalizer-cache": build_normalizer_cache_main,
+}
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        return
     import argparse
-    parser = argparse.ArgumentParser(description="IndexTTS Command Line")
+    parser = argparse.ArgumentParser(description="IndexTTS Command Line",
+                                     epilog="Subcommands: " + ", ".join(SUBCOMMANDS) + " (run `indextts <subcommand> -h` for help)")
     parser.add_argument("text", type=str, help="Text to be synthesized")
-    parser.add_argument("-v", "--voice", type=str, required=True, help="Path to the audio prompt file (wav format)")
+    parser.add_argument("-v", "--voice", type=str, required=True, help="Path to the audio prompt file (wav format), or a voice name registered by `indextts register-voice`")
     parser.add_argument("-o", "--output_path", type=str, default="gen.wav", help="Path to the output wav file")
     parser.add_argument("-c", "--config", type=str, default="checkpoints/config.yaml", help="Path to the config file. Default is 'checkpoints/config.yaml'")
     parser.add_argument("--model_dir", type=str, default="checkpoints", help="Path to the model directory. Default is 'checkpoints'")
+    parser.add_argument("--voice_dir", type=str, default=None, help="Path to the voice store directory. Default is '<model_dir>/voices'")
     parser.add_argument("--fp16", action="store_true", default=True, help="Use FP16 for inference if available")
     parser.add_argument("-f", "--force", action="store_true", default=False, help="Force to overwrite the output file if it exists")
     parser.add_argument("-d", "--device", type=str, default=None, help="Device to run the model on (cpu, cuda, mps)." )
+    parser.add_argument("--decode_engine", type=str, default="hf", choices=["hf", "native"],
+                        help="GPT decoding: 'hf' (transformers generate) or 'native' (static KV cache decode loop). Default is 'hf'")
+    parser.add_argument("--polyphase_activation", action="store_true", default=False,
+                        help="Compute the BigVGAN anti-aliased activations by phases, faster without the CUDA kernel")
     args = parser.parse_args()
     if len(args.text.strip()) == 0:
         print("ERROR: Text is empty.")
         parser.print_help()
         sys.exit(1)
-    if not os.path.exists(args.voice):
-        print(f"Audio prompt file {args.voice} does not exist.")
+    from indextts.utils.voice_store import VoiceStore
+    voice_dir = args.voice_dir if args.voice_dir is not None else os.path.join(args.model_dir, "voices")
+    if not os.path.exists(args.voice) and not VoiceStore(voice_dir).exists(args.voice):
+        print(f"Audio prompt file or voice {args.voice} does not exist.")
         parser.print_help()
         sys.exit(1)
     if not os.path.exists(args.config):
@@ -55,7 +186,8 @@ def main():
             print("WARNING: Running on CPU may be slow.")
 
     from indextts.infer import IndexTTS
-    tts = IndexTTS(cfg_path=args.config, model_dir=args.model_dir, is_fp16=args.fp16, device=args.device)
+    tts = IndexTTS(cfg_path=args.config, model_dir=args.model_dir, is_fp16=args.fp16, device=args.device, voice_dir=voice_dir,
+                   decode_engine=args.decode_engine, polyphase_activation=args.polyphase_activation)
     tts.infer(audio_prompt=args.voice, text=args.text.strip(), output_path=output_path)
 
 if __name__ == "__main__":
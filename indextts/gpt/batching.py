@@ -0,0 +1,302 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional
+
+import torch
+import torch.nn.functional as F
+
+from indextts.gpt.generation import GPT2DecodeEngine, PrefixKV, SlotKVCache, StaticKVCache
+from indextts.gpt.sampling import FusedSampler
+from indextts.utils.runaway_guard import RunawayGuard
+
+
+class GenerationRequest:
+    """A sentence waiting for, or being decoded by, `ContinuousBatchingScheduler`."""
+
+    def __init__(self, conds_latent: torch.Tensor, text_tokens: torch.Tensor, max_mel_tokens: int,
+                 prefix: Optional[PrefixKV] = None, guard: Optional[RunawayGuard] = None,
+                 runaway_stats: Optional[dict] = None):
+        self.conds_latent = conds_latent
+        self.text_tokens = text_tokens
+        self.max_mel_tokens = max_mel_tokens
+        self.prefix = prefix
+        self.guard = guard
+        self.runaway_stats = runaway_stats
+        self.future: Future = Future()
+        self.submit_time = time.perf_counter()
+
+
+class ContinuousBatchingScheduler:
+    """
+    Iteration-level (continuous) batching of mel-token generation, for serving concurrent requests with one GPT:
+        - sentences of any request and any voice are admitted into the running decode batch at token boundaries
+        - finished rows are retired immediately, their slot is reused by the next waiting sentence
+        - the codes (and latents) of each sentence are returned by its `Future` as soon as it finishes
+        - the rows stuck in silence or in a token loop are stopped by their own `RunawayGuard`, see `submit()`
+    Decoding is sampling or greedy (no beam search), with the layers of `GPT2DecodeEngine` and a `SlotKVCache`.
+    All GPT calls run on the scheduler thread, `submit()` can be called from any thread.
+    Args:
+        gpt: `UnifiedVoice` after `post_init_gpt2_config()`
+        max_batch_size: number of rows decoded together, the KV cache is preallocated for all of them
+        max_mel_tokens: max generated tokens of a sentence
+        dtype: autocast dtype of the GPT, None to disable autocast
+        return_latent: also return the GPT latents of the codes, `(codes, latents)`
+    """
+
+    def __init__(self, gpt, max_batch_size=8, max_mel_tokens=600, dtype=None, do_sample=True, top_p=0.8, top_k=30,
+                 temperature=1.0, repetition_penalty=10.0, return_latent=True):
+        self.gpt = gpt
+        self.engine = getattr(gpt, "native_decoder", None) or GPT2DecodeEngine(gpt.inference_model)
+        self.max_batch_size = max_batch_size
+        self.max_mel_tokens = max_mel_tokens
+        self.dtype = dtype
+        self.return_latent = return_latent
+        self.sampler = FusedSampler(do_sample, top_k, top_p, temperature, repetition_penalty)
+        self.device = next(gpt.parameters()).device
+
+        # [cond][start_text][text][stop_text][start_mel] + generated tokens
+        max_length = gpt.cond_num + gpt.max_text_tokens + 3 + max_mel_tokens
+        self.cache = SlotKVCache(len(self.engine.transformer.h), max_batch_size, max_length, device=self.device)
+        slots = max_batch_size
+        self.key_mask = torch.zeros((slots, max_length), dtype=torch.long, device=self.device)
+        self.codes = torch.zeros((slots, max_mel_tokens), dtype=torch.long, device=self.device)
+        # token counts of the repetition penalty: [1 (fake input ids), start_mel_token, generated tokens...]
+        self.token_counts = torch.zeros((slots, gpt.number_mel_codes), device=self.device)
+        self.generated = torch.zeros(slots, dtype=torch.long, device=self.device)
+        self.last_tokens = torch.zeros(slots, dtype=torch.long, device=self.device)
+        self.latents = None
+        self.requests: List[Optional[GenerationRequest]] = [None] * slots
+        self.host_generated = [0] * slots
+
+        self._waiting: List[GenerationRequest] = []
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self.steps = 0
+        self.admitted = 0
+        self.retired = 0
+        self.row_steps = 0
+
+    @property
+    def num_active(self) -> int:
+        return self.cache.active
+
+    def stats(self) -> dict:
+        with self._cond:
+            waiting = len(self._waiting)
+        return {
+            "steps": self.steps,
+            "admitted": self.admitted,
+            "retired": self.retired,
+            "active": self.num_active,
+            "waiting": waiting,
+            "mean_batch_size": self.row_steps / self.steps if self.steps else 0.0,
+            "kv_cache_bytes": self.cache.nbytes,
+        }
+
+    def submit(self, conds_latent: torch.Tensor, text_tokens: torch.Tensor, max_mel_tokens: Optional[int] = None,
+               prefix: Optional[PrefixKV] = None, runaway_guard=None, runaway_stats: Optional[dict] = None) -> Future:
+        """
+        Queue a sentence for generation.
+        Args:
+            conds_latent: (1, 32, dim) `UnifiedVoice.get_conditioning()` output of the voice
+            text_tokens: (1, L) or (L,) text token ids
+            prefix: `UnifiedVoice.get_conditioning_prefix()` of ``conds_latent``, cached with the voice,
+                computed at admission if not given
+            runaway_guard: True or a dict of `RunawayGuard` kwargs, as in `UnifiedVoice.inference_speech()`
+            runaway_stats: dict with the keys of `UnifiedVoice.runaway_stats`, the stops of this sentence are added
+                to it (and to the totals of the GPT) before its `Future` is resolved
+        Returns:
+            `Future` of codes (1, T), or `(codes, latents)` (1, T, dim) if ``return_latent``;
+            codes end with ``stop_mel_token`` unless ``max_mel_tokens`` was reached.
+        """
+        if text_tokens.ndim == 1:
+            text_tokens = text_tokens.unsqueeze(0)
+        if text_tokens.shape[-1] > self.gpt.max_text_tokens:
+            raise ValueError(f"Too many text tokens: {text_tokens.shape[-1]} > {self.gpt.max_text_tokens}")
+        if conds_latent.shape[1] > self.gpt.cond_num:
+            raise ValueError(f"Unexpected conditioning length: {conds_latent.shape[1]} > {self.gpt.cond_num}")
+        max_mel_tokens = self.max_mel_tokens if max_mel_tokens is None else min(max_mel_tokens, self.max_mel_tokens)
+        guard = None
+        if runaway_guard:
+            # the guard sees the generated codes of its row only: no prompt, max_length is the budget
+            guard = RunawayGuard(self.gpt.stop_mel_token, 0, max_mel_tokens,
+                                 **(runaway_guard if isinstance(runaway_guard, dict) else {}))
+        request = GenerationRequest(conds_latent, text_tokens, max_mel_tokens, prefix, guard, runaway_stats)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("ContinuousBatchingScheduler is closed")
+            self._waiting.append(request)
+            self._cond.notify()
+        return request.future
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="indextts-batching", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for request in self._waiting + [r for r in self.requests if r is not None]:
+            if not request.future.done():
+                request.future.set_exception(RuntimeError("ContinuousBatchingScheduler is closed"))
+        self._waiting.clear()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._waiting and self.num_active == 0:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            self.step()
+
+    def step(self):
+        """
+        One iteration: admit the waiting sentences into the free slots (prefill and their first token),
+        or if there are none, decode one token for all the active rows.
+        """
+        with self._cond:
+            free = self.max_batch_size - self.num_active
+            admitted, self._waiting = self._waiting[:free], self._waiting[free:]
+        try:
+            with torch.no_grad(), torch.amp.autocast(self.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                if admitted:
+                    self._admit(admitted)
+                elif self.num_active > 0:
+                    self._decode()
+        except BaseException as e:
+            # fail every sentence in flight, the scheduler stays usable for new ones
+            for request in admitted + [r for r in self.requests if r is not None]:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            self.requests = [None] * self.max_batch_size
+            self.cache.active = 0
+            if not isinstance(e, Exception):
+                raise
+
+    def _admit(self, requests: List[GenerationRequest]):
+        """
+        Prefill the text of the new sentences as one left-padded batch after their conditioning prefix,
+        and sample their first token. The prefix keys/values are copied into the rows' slots.
+        """
+        gpt = self.gpt
+        for request in requests:
+            if request.prefix is None:
+                request.prefix = self.engine.prefix_kv(request.conds_latent.to(self.device))
+        prefix = PrefixKV.stack([r.prefix for r in requests])
+        max_text_len = max(r.text_tokens.shape[-1] for r in requests)
+        text_inputs = torch.cat([F.pad(r.text_tokens.to(self.device), (0, max_text_len - r.text_tokens.shape[-1]),
+                                       value=gpt.stop_text_token) for r in requests])
+        # [pad][text][start_mel_token], the conditioning latents are in the prefix
+        conds_latent = torch.cat([r.conds_latent[:, :0].to(self.device) for r in requests])
+        input_ids, mel_emb, attention_mask = gpt.prepare_gpt_inputs(conds_latent, text_inputs)
+        prefill_cache = StaticKVCache(self.cache.num_layers, input_ids.shape[1])
+        hidden_states = self.engine.prefill(self.engine.embed_prefill(mel_emb, input_ids), attention_mask,
+                                            prefill_cache, prefix)
+        latents = self.engine.model.final_norm(hidden_states[:, -1]) if self.return_latent else None
+        logits = self.engine.model.lm_head(hidden_states[:, -1:])[:, -1, :]
+
+        start = self.num_active
+        slots = torch.arange(start, start + len(requests), device=self.device)
+        for i, request in enumerate(requests):
+            slot = start + i
+            self.cache.load(slot, prefill_cache, i, prefix)
+            self.requests[slot] = request
+            self.host_generated[slot] = 0
+        self.key_mask[slots] = 0
+        self.key_mask[slots, :prefix.length] = 1
+        self.key_mask[slots, prefix.length:prefix.length + input_ids.shape[1]] = attention_mask
+        self.token_counts[slots] = self.sampler.token_counts(
+            torch.tensor([[1, gpt.start_mel_token]], device=self.device), self.token_counts.shape[1])
+        self.generated[slots] = 0
+        self.cache.active += len(requests)
+        self.admitted += len(requests)
+        tokens = self.sampler.sample(logits, self.token_counts[slots])
+        self._record(start, tokens, latents)
+
+    def _decode(self):
+        active = self.num_active
+        rows = torch.arange(active, device=self.device)
+        model = self.engine.model
+        # the mel position of the last token follows `GPT2DecodeEngine.embed_step()`: generated + 1
+        emb = model.embeddings(self.last_tokens[:active, None]) \
+            + model.text_pos_embedding.emb(self.generated[:active] + 1).unsqueeze(1)
+        self.key_mask[rows, self.cache.lengths[:active]] = 1
+        attention_mask = self.key_mask[:active, :self.cache.key_length()]
+        hidden_states = self.engine.forward(emb, attention_mask, self.cache)
+        latents = model.final_norm(hidden_states[:, -1]) if self.return_latent else None
+        logits = model.lm_head(hidden_states)[:, -1, :]
+        logits = self._apply_guards(logits)
+        tokens = self.sampler.sample(logits, self.token_counts[:active])
+        self.steps += 1
+        self.row_steps += active
+        self._record(0, tokens, latents)
+
+    def _apply_guards(self, logits: torch.Tensor) -> torch.Tensor:
+        """`RunawayGuard` of every active row on its own generated codes, the rows have different lengths."""
+        for slot in range(logits.shape[0]):
+            guard = self.requests[slot].guard
+            length = self.host_generated[slot]
+            if guard is None or length < min(guard.max_silent_tokens, guard.min_loop_length + 1):
+                continue
+            logits[slot:slot + 1] = guard(self.codes[slot:slot + 1, :length], logits[slot:slot + 1])
+        return logits
+
+    def _record(self, start: int, tokens: torch.Tensor, latents: Optional[torch.Tensor]):
+        """Store the new tokens of the rows ``start:start+len(tokens)``, then retire the finished rows."""
+        end = start + tokens.shape[0]
+        rows = torch.arange(start, end, device=self.device)
+        generated = self.generated[start:end]
+        self.codes[rows, generated] = tokens
+        self.sampler.update(self.token_counts[start:end], tokens)
+        if latents is not None:
+            if self.latents is None:
+                self.latents = latents.new_zeros((self.max_batch_size, self.max_mel_tokens, latents.shape[-1]))
+            self.latents[rows, generated] = latents
+        self.generated[start:end] += 1
+        self.last_tokens[start:end] = tokens
+        for slot in range(start, end):
+            self.host_generated[slot] += 1
+        finished = (tokens == self.gpt.stop_mel_token).tolist()
+        for slot in range(end - 1, start - 1, -1):
+            request = self.requests[slot]
+            if finished[slot - start] or self.host_generated[slot] >= request.max_mel_tokens:
+                self._retire(slot)
+
+    def _retire(self, slot: int):
+        request = self.requests[slot]
+        length = self.host_generated[slot]
+        codes = self.codes[slot, :length].unsqueeze(0).clone()
+        if self.return_latent:
+            result = (codes, self.latents[slot, :length].unsqueeze(0).clone())
+        else:
+            result = codes
+        last = self.num_active - 1
+        if slot != last:
+            self._move(last, slot)
+        self.requests[last] = None
+        self.cache.active -= 1
+        self.retired += 1
+        self.gpt._add_runaway_stats(request.guard, request.runaway_stats)
+        request.future.set_result(result)
+
+    def _move(self, src: int, dst: int):
+        self.cache.move(src, dst)
+        length = self.host_generated[src]
+        self.key_mask[dst] = self.key_mask[src]
+        self.codes[dst, :length] = self.codes[src, :length]
+        self.token_counts[dst] = self.token_counts[src]
+        if self.latents is not None:
+            self.latents[dst, :length] = self.latents[src, :length]
+        self.generated[dst] = self.generated[src]
+        self.last_tokens[dst] = self.last_tokens[src]
+        self.requests[dst] = self.requests[src]
+        self.host_generated[dst] = length
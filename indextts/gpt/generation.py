@@ -0,0 +1,753 @@
+from typing import Callable, List, Optional, Sequence
+
+import torch
+import torch.nn.functional as F
+
+from indextts.gpt.sampling import FusedSampler
+
+# `GPT2InferenceModel.generate()` (transformers) default generation config
+HF_GENERATE_DEFAULTS = {
+    "do_sample": False,
+    "top_k": 50,
+    "top_p": 1.0,
+    "temperature": 1.0,
+    "repetition_penalty": 1.0,
+    "num_beams": 1,
+    "length_penalty": 1.0,
+    "early_stopping": False,
+}
+
+
+class StaticKVCache:
+    """
+    Preallocated key/value buffers of every GPT2 layer, each in shape (rows, heads, max_length, head_dim).
+    New keys/values are written in place, instead of concatenating the cache tuples at every step.
+    The buffers are allocated by the first `update()`, with the dtype of the keys (e.g. float16 under autocast).
+    """
+
+    def __init__(self, num_layers: int, max_length: int):
+        self.num_layers = num_layers
+        self.max_length = max_length
+        self.keys: List[torch.Tensor] = []
+        self.values: List[torch.Tensor] = []
+        self.length = 0
+
+    def update(self, layer: int, key: torch.Tensor, value: torch.Tensor):
+        """
+        Write the keys/values (rows, heads, q, head_dim) of the current step, returns all the keys/values so far.
+        """
+        if not self.keys:
+            rows, heads, _, head_dim = key.shape
+            for _ in range(self.num_layers):
+                self.keys.append(key.new_empty(rows, heads, self.max_length, head_dim))
+                self.values.append(value.new_empty(rows, heads, self.max_length, head_dim))
+        end = self.length + key.shape[-2]
+        if end > self.max_length:
+            raise ValueError(f"KV cache overflow: {end} > max_length {self.max_length}")
+        self.keys[layer][:, :, self.length:end] = key
+        self.values[layer][:, :, self.length:end] = value
+        return self.keys[layer][:, :, :end], self.values[layer][:, :, :end]
+
+    def advance(self, n: int):
+        self.length += n
+
+    def truncate(self, length: int):
+        """Drop the positions from ``length`` on, e.g. the rejected draft tokens, they are overwritten later."""
+        self.length = min(self.length, length)
+
+    def reorder(self, index: torch.Tensor):
+        """Reorder the rows in place, e.g. to follow the selected beams."""
+        for buffer in self.keys + self.values:
+            buffer[:, :, :self.length] = buffer[:, :, :self.length].index_select(0, index)
+
+    def compact(self, index: torch.Tensor):
+        """Keep only the rows ``index``, e.g. drop the finished rows, the buffers shrink to ``len(index)`` rows."""
+        def select(buffer):
+            kept = buffer.new_empty((index.shape[0],) + buffer.shape[1:])
+            kept[:, :, :self.length] = buffer[:, :, :self.length].index_select(0, index)
+            return kept
+        self.keys = [select(k) for k in self.keys]
+        self.values = [select(v) for v in self.values]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in self.keys + self.values)
+
+
+class PrefixKV:
+    """
+    Keys/values of a prefix shared by all the rows, e.g. the conditioning latents of a voice,
+    (1, heads, P, head_dim) per layer. The rows attend to it by reference, it is never copied per row.
+    """
+
+    def __init__(self, keys: List[torch.Tensor], values: List[torch.Tensor]):
+        self.keys = keys
+        self.values = values
+
+    @property
+    def length(self) -> int:
+        return self.keys[0].shape[-2]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in self.keys + self.values)
+
+    @classmethod
+    def stack(cls, prefixes: Sequence["PrefixKV"]) -> "PrefixKV":
+        """One prefix per row, for rows of different voices."""
+        if all(p is prefixes[0] for p in prefixes):
+            return prefixes[0]
+        return cls([torch.cat(ks) for ks in zip(*[p.keys for p in prefixes])],
+                   [torch.cat(vs) for vs in zip(*[p.values for p in prefixes])])
+
+
+class SlotKVCache:
+    """
+    Key/value buffers of ``slots`` independent rows, each row has its own length.
+    Used by continuous batching: rows join and leave the running batch at any step,
+    the rows in use are kept packed in the first ``active`` slots.
+    """
+
+    def __init__(self, num_layers: int, slots: int, max_length: int, device=None):
+        self.num_layers = num_layers
+        self.slots = slots
+        self.max_length = max_length
+        self.keys: List[torch.Tensor] = []
+        self.values: List[torch.Tensor] = []
+        self.lengths = torch.zeros(slots, dtype=torch.long, device=device)
+        # host copy of `lengths`, to slice the buffers without syncing
+        self.host_lengths = [0] * slots
+        self.active = 0
+
+    def _allocate(self, like: torch.Tensor):
+        _, heads, _, head_dim = like.shape
+        for _ in range(self.num_layers):
+            # zeros, not empty: the masked positions are multiplied by 0 in attention, NaN garbage would leak through
+            self.keys.append(like.new_zeros(self.slots, heads, self.max_length, head_dim))
+            self.values.append(like.new_zeros(self.slots, heads, self.max_length, head_dim))
+
+    def key_length(self) -> int:
+        """Key length of the next decode step of the active rows."""
+        return max(self.host_lengths[:self.active]) + 1
+
+    def update(self, layer: int, key: torch.Tensor, value: torch.Tensor):
+        """
+        Write the keys/values (active, heads, 1, head_dim) of one decode step at each row's own position.
+        """
+        if not self.keys:
+            self._allocate(key)
+        rows = torch.arange(self.active, device=key.device)
+        positions = self.lengths[:self.active]
+        self.keys[layer][rows, :, positions] = key[:, :, 0]
+        self.values[layer][rows, :, positions] = value[:, :, 0]
+        end = self.key_length()
+        return self.keys[layer][:self.active, :, :end], self.values[layer][:self.active, :, :end]
+
+    def advance(self, n: int):
+        self.lengths[:self.active] += n
+        for i in range(self.active):
+            self.host_lengths[i] += n
+
+    def load(self, slot: int, cache: StaticKVCache, row: int, prefix: Optional[PrefixKV] = None):
+        """
+        Copy the prefilled keys/values of ``row`` of ``cache`` into ``slot``,
+        after the keys/values of ``prefix`` (its row ``row``, or its only row) if given.
+        """
+        if not self.keys:
+            self._allocate(cache.keys[0])
+        offset = 0 if prefix is None else prefix.length
+        length = offset + cache.length
+        if length > self.max_length:
+            raise ValueError(f"KV cache overflow: {length} > max_length {self.max_length}")
+        for layer in range(self.num_layers):
+            if prefix is not None:
+                prefix_row = row if prefix.keys[layer].shape[0] > 1 else 0
+                self.keys[layer][slot, :, :offset] = prefix.keys[layer][prefix_row]
+                self.values[layer][slot, :, :offset] = prefix.values[layer][prefix_row]
+            self.keys[layer][slot, :, offset:length] = cache.keys[layer][row, :, :cache.length]
+            self.values[layer][slot, :, offset:length] = cache.values[layer][row, :, :cache.length]
+        self.lengths[slot] = length
+        self.host_lengths[slot] = length
+
+    def move(self, src: int, dst: int):
+        """Move the row in ``src`` to ``dst``, e.g. to refill the slot of a retired row."""
+        length = self.host_lengths[src]
+        for buffer in self.keys + self.values:
+            buffer[dst, :, :length] = buffer[src, :, :length]
+        self.lengths[dst] = self.lengths[src]
+        self.host_lengths[dst] = length
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.numel() * t.element_size() for t in self.keys + self.values)
+
+
+class BeamHypotheses:
+    """
+    n-best list of finished hypotheses of one batch item, same scoring as `transformers` beam search.
+    """
+
+    def __init__(self, num_beams: int, length_penalty: float, early_stopping: bool):
+        self.num_beams = num_beams
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+        self.beams = []
+        self.worst_score = 1e9
+
+    def __len__(self):
+        return len(self.beams)
+
+    def add(self, hyp: torch.Tensor, sum_logprobs: float, generated_len: int, beam_indices: Optional[torch.Tensor] = None):
+        score = sum_logprobs / (generated_len ** self.length_penalty)
+        if len(self) < self.num_beams or score > self.worst_score:
+            self.beams.append((score, hyp, beam_indices))
+            if len(self) > self.num_beams:
+                sorted_next_scores = sorted([(s, idx) for idx, (s, _, _) in enumerate(self.beams)])
+                del self.beams[sorted_next_scores[0][1]]
+                self.worst_score = sorted_next_scores[1][0]
+            else:
+                self.worst_score = min(score, self.worst_score)
+
+    def is_done(self, best_sum_logprobs: float, generated_len: int) -> bool:
+        if len(self) < self.num_beams:
+            return False
+        if self.early_stopping:
+            return True
+        return self.worst_score >= best_sum_logprobs / generated_len ** self.length_penalty
+
+
+class GPT2DecodeEngine:
+    """
+    Autoregressive decoding of `GPT2InferenceModel` owned by IndexTTS, a replacement of `generate()` of transformers:
+        - keys/values are written into a `StaticKVCache` preallocated for the whole generation
+        - greedy, sampling, beam search and beam sampling are implemented on tensors,
+          with the same logits processing and tie-breaking as transformers, so a fixed seed gives the same codes
+        - the mel position of the decoded tokens follows the KV cache path of `GPT2InferenceModel`
+    Only the GPT2 configuration used by UnifiedVoice is supported (no cross attention, no reordered/upcast attention).
+    """
+
+    def __init__(self, inference_model):
+        self.model = inference_model
+        self.transformer = inference_model.transformer
+        config = self.transformer.config
+        if config.add_cross_attention or config.reorder_and_upcast_attn or config.scale_attn_by_inverse_layer_idx:
+            raise ValueError("GPT2DecodeEngine does not support this GPT2 configuration")
+        self.scale_attn_weights = config.scale_attn_weights
+        self.num_heads = config.n_head
+        self.head_dim = config.n_embd // config.n_head
+        self.last_stats = {}
+
+    @staticmethod
+    def supported_kwargs():
+        return set(HF_GENERATE_DEFAULTS)
+
+    @torch.no_grad()
+    def prefix_kv(self, prefix_emb: torch.Tensor) -> PrefixKV:
+        """
+        Keys/values of a prefix without position embedding, e.g. the conditioning latents (1, 32, dim) of a voice.
+        The attention inside the prefix is causal, like in the full prefill.
+        """
+        rows, length = prefix_emb.shape[:2]
+        cache = StaticKVCache(len(self.transformer.h), length)
+        attention_mask = torch.ones((rows, length), dtype=torch.long, device=prefix_emb.device)
+        self.forward(prefix_emb, attention_mask, cache)
+        return PrefixKV([k.clone() for k in cache.keys], [v.clone() for v in cache.values])
+
+    def embed_prefill(self, mel_emb: torch.Tensor, input_ids: torch.Tensor):
+        """
+        [conditioning latents][text][start_mel_token, input tokens...], see `GPT2InferenceModel.forward()`.
+        """
+        mel_len = mel_emb.shape[1]
+        text_inputs = input_ids[:, mel_len:]
+        text_emb = self.model.embeddings(text_inputs)
+        text_emb = text_emb + self.model.text_pos_embedding(text_emb)
+        if mel_emb.shape[0] != text_emb.shape[0]:
+            mel_emb = mel_emb.repeat_interleave(text_emb.shape[0] // mel_emb.shape[0], 0)
+        return torch.cat([mel_emb, text_emb], dim=1)
+
+    def embed_step(self, tokens: torch.Tensor, position: int):
+        """
+        Embedding of the last decoded tokens (rows, 1), ``position`` = attention mask length - mel_emb length.
+        """
+        emb = self.model.embeddings(tokens)
+        return emb + self.model.text_pos_embedding.get_fixed_embedding(position, tokens.device)
+
+    def _scaled_scores(self, query, key):
+        attn_weights = torch.matmul(query, key.transpose(-1, -2))
+        if self.scale_attn_weights:
+            attn_weights = attn_weights / torch.full(
+                [], key.size(-1) ** 0.5, dtype=attn_weights.dtype, device=attn_weights.device
+            )
+        return attn_weights
+
+    def _attention(self, query, key, value, attention_mask, causal_mask=None, prefix_key=None, prefix_value=None):
+        attn_weights = self._scaled_scores(query, key)
+        if causal_mask is not None:
+            mask_value = torch.full([], torch.finfo(attn_weights.dtype).min, dtype=attn_weights.dtype,
+                                    device=attn_weights.device)
+            attn_weights = torch.where(causal_mask, attn_weights, mask_value)
+        attn_weights = attn_weights + attention_mask
+        if prefix_key is None:
+            attn_weights = F.softmax(attn_weights, dim=-1)
+            attn_weights = attn_weights.type(value.dtype)
+            return torch.matmul(attn_weights, value)
+        # the shared prefix is visible to every position, (1, heads, P, head_dim) broadcasts over the rows
+        prefix_len = prefix_key.shape[-2]
+        prefix_weights = self._scaled_scores(query, prefix_key.to(query.dtype))
+        attn_weights = torch.cat([prefix_weights.to(attn_weights.dtype), attn_weights], dim=-1)
+        attn_weights = F.softmax(attn_weights, dim=-1)
+        attn_weights = attn_weights.type(value.dtype)
+        return torch.matmul(attn_weights[..., :prefix_len], prefix_value.to(value.dtype)) \
+            + torch.matmul(attn_weights[..., prefix_len:], value)
+
+    def forward(self, hidden_states: torch.Tensor, attention_mask: torch.Tensor, cache: StaticKVCache,
+                prefix: Optional[PrefixKV] = None):
+        """
+        Run the GPT2 layers on the new positions ``hidden_states`` (rows, q, dim),
+        ``attention_mask`` (rows, k) covers the cached and the new positions, ``k`` is the key length returned by
+        ``cache.update()``, i.e. cache.length + q for a `StaticKVCache`.
+        ``prefix`` is attended by all the positions before the cached ones, it is not part of ``attention_mask``.
+        Returns the hidden states after the final layer norm of GPT2.
+        """
+        hidden_states = self.run_layers(hidden_states, attention_mask, cache, prefix)
+        cache.advance(hidden_states.shape[1])
+        return self.transformer.ln_f(hidden_states)
+
+    def run_layers(self, hidden_states: torch.Tensor, attention_mask: torch.Tensor, cache: StaticKVCache,
+                   prefix: Optional[PrefixKV] = None, layers: Optional[range] = None,
+                   packed: Optional[torch.Tensor] = None):
+        """
+        The GPT2 blocks ``layers`` (all by default) of `forward()`, without advancing the cache and without
+        the final layer norm, e.g. the first layers of the speculative draft.
+        ``packed``: (rows, q) bool of the real (not padded) positions, ``hidden_states`` (n, dim) are then only these
+        positions: the linear layers and the MLP skip the padding, the attention scatters q/k/v to (rows, q).
+        """
+        if packed is None:
+            rows, q_len = hidden_states.shape[:2]
+        else:
+            rows, q_len = packed.shape
+            index = packed.reshape(-1).nonzero().squeeze(1)
+        k_len = attention_mask.shape[-1]
+        dtype = self.transformer.dtype
+        attention_mask = attention_mask[:, None, None, :].to(dtype=dtype)
+        attention_mask = (1.0 - attention_mask) * torch.finfo(dtype).min
+        causal_mask = None
+        if q_len > 1:
+            causal_mask = torch.ones((q_len, k_len), dtype=torch.bool, device=hidden_states.device).tril(k_len - q_len)
+        for i in layers if layers is not None else range(len(self.transformer.h)):
+            block = self.transformer.h[i]
+            residual = hidden_states
+            hidden_states = block.ln_1(hidden_states)
+            qkv = block.attn.c_attn(hidden_states)
+            if packed is not None:
+                # padded positions get zero keys/values, they are masked by ``attention_mask``
+                qkv = qkv.new_zeros((rows * q_len, qkv.shape[-1])).index_copy_(0, index, qkv).view(rows, q_len, -1)
+            query, key, value = qkv.split(block.attn.split_size, dim=2)
+            query = query.view(rows, q_len, self.num_heads, self.head_dim).permute(0, 2, 1, 3)
+            key = key.view(rows, q_len, self.num_heads, self.head_dim).permute(0, 2, 1, 3)
+            value = value.view(rows, q_len, self.num_heads, self.head_dim).permute(0, 2, 1, 3)
+            key, value = cache.update(i, key, value)
+            if prefix is None:
+                attn_output = self._attention(query, key, value, attention_mask, causal_mask)
+            else:
+                attn_output = self._attention(query, key, value, attention_mask, causal_mask,
+                                              prefix.keys[i], prefix.values[i])
+            attn_output = attn_output.permute(0, 2, 1, 3).contiguous().view(rows, q_len, self.num_heads * self.head_dim)
+            if packed is not None:
+                attn_output = attn_output.view(rows * q_len, -1).index_select(0, index)
+            attn_output = block.attn.c_proj(attn_output)
+            hidden_states = attn_output + residual
+            residual = hidden_states
+            feed_forward_hidden_states = block.mlp(block.ln_2(hidden_states))
+            hidden_states = residual + feed_forward_hidden_states
+        return hidden_states
+
+    def prefill(self, hidden_states: torch.Tensor, attention_mask: torch.Tensor, cache: StaticKVCache,
+                prefix: Optional[PrefixKV] = None, ragged=True):
+        """
+        `forward()` of the left padded prompts (rows, q, dim), ``attention_mask`` (rows, q).
+        ``ragged``: the linear layers and the MLP only run on the real positions, packed without padding,
+        so that mixing short and long sentences does not cost the padding (see `run_layers()`).
+        The hidden states of the padded positions are 0.
+        """
+        rows, q_len, dim = hidden_states.shape
+        packed = attention_mask.bool()
+        if not ragged or bool(packed.all()):
+            return self.forward(hidden_states, attention_mask, cache, prefix)
+        index = packed.reshape(-1).nonzero().squeeze(1)
+        packed_states = self.run_layers(hidden_states.reshape(rows * q_len, dim).index_select(0, index),
+                                        attention_mask, cache, prefix, packed=packed)
+        cache.advance(q_len)
+        packed_states = self.transformer.ln_f(packed_states)
+        return packed_states.new_zeros((rows * q_len, dim)).index_copy_(0, index, packed_states).view(rows, q_len, dim)
+
+    @staticmethod
+    def _select_rows(logits_processor: Optional[Sequence[Callable]], index: torch.Tensor):
+        for fn in logits_processor or ():
+            if hasattr(fn, "select_rows"):
+                fn.select_rows(index)
+
+    @torch.no_grad()
+    def generate(self, mel_emb: torch.Tensor, input_ids: torch.Tensor, attention_mask: torch.Tensor, max_length: int,
+                 eos_token_id: int, pad_token_id: int, num_return_sequences: int = 1,
+                 logits_processor: Optional[Sequence[Callable]] = None, return_latent=False,
+                 prefix: Optional[PrefixKV] = None, compact_finished=True, draft_layers: Optional[int] = None,
+                 num_draft_tokens: int = 4, ragged_prefill=True, stats: Optional[dict] = None,
+                 streamer: Optional[Callable] = None, **kwargs):
+        """
+        Same arguments and results as `GPT2InferenceModel.generate()` for UnifiedVoice.
+        Args:
+            mel_emb: (b, s, dim) the conditioning + text embeddings, `UnifiedVoice.prepare_gpt_inputs()`
+            input_ids: (b, s + n) fake ids of mel_emb, followed by the start_mel_token (and input tokens)
+            attention_mask: (b, s + n)
+            max_length: max total length of the sequences, including the ``s + n`` input positions
+            logits_processor: extra callables `(input_ids, scores) -> scores` applied after the repetition penalty,
+                the ones with a `select_rows(index)` method are told the rows kept by ``compact_finished``
+            prefix: keys/values of the conditioning latents shared by all the rows, see `prefix_kv()`,
+                ``mel_emb`` and ``input_ids`` then start after the conditioning latents
+            compact_finished: drop the finished rows (beam groups) from the batch and the KV cache instead of
+                decoding padding for them. The codes are unchanged, but sampling draws from the random generator
+                for fewer rows, so a fixed seed gives the transformers results only with ``compact_finished=False``.
+            draft_layers: self-speculative decoding (greedy and sampling, ignored with beams): the first
+                ``draft_layers`` layers + ``final_norm``/``mel_head`` draft ``num_draft_tokens`` tokens, the other
+                layers verify them in one forward, see `_speculative_decode()`. Greedy decoding gives the same codes,
+                sampling keeps the same distribution (rejection sampling) but not the same draws with a fixed seed.
+            ragged_prefill: skip the left padding of the prompts in the prefill, see `prefill()`.
+            streamer: greedy/sampling without ``draft_layers`` only, called after every decode step with
+                ``(rows, tokens, latents)``: the original rows (r,) of the decoded rows, their new tokens (r,)
+                (``pad_token_id`` for the finished rows) and the latents of these tokens (r, dim) if ``return_latent``.
+                A token and its latent are final when they are emitted.
+            kwargs: do_sample, top_k, top_p, temperature, repetition_penalty, num_beams, length_penalty, early_stopping
+        Returns:
+            sequences: (b * num_return_sequences, length) including the input ids
+            step_latents: (steps, rows, dim) if ``return_latent``, else None
+            beam_indices: (b * num_return_sequences, steps) the source row of every step for beam search, else None
+        `last_stats` records the decode steps, the decoded row-steps and the padding row-steps avoided by compaction,
+        and the drafted/accepted tokens of speculative decoding. It is overwritten by every call, pass an empty dict
+        as ``stats`` to get the ones of this call when several threads share the engine.
+        """
+        unsupported = set(kwargs) - self.supported_kwargs()
+        if unsupported:
+            raise ValueError(f"GPT2DecodeEngine does not support the generate arguments: {sorted(unsupported)}")
+        options = {**HF_GENERATE_DEFAULTS, **kwargs}
+        num_beams = options["num_beams"]
+        do_sample = options["do_sample"]
+        if num_beams > 1 and num_return_sequences > num_beams:
+            raise ValueError("`num_return_sequences` has to be smaller or equal to `num_beams`.")
+        if streamer is not None and (num_beams > 1 or draft_layers):
+            raise ValueError("`streamer` is only supported by greedy/sampling decoding without `draft_layers`")
+        min_tokens_to_keep = 2 if num_beams > 1 else 1
+        sampler = FusedSampler(do_sample, options["top_k"], options["top_p"], options["temperature"],
+                               options["repetition_penalty"], logits_processor, min_tokens_to_keep)
+        expand_size = num_beams if num_beams > 1 else num_return_sequences
+        if expand_size > 1:
+            input_ids = input_ids.repeat_interleave(expand_size, dim=0)
+            attention_mask = attention_mask.repeat_interleave(expand_size, dim=0)
+        rows, cur_len = input_ids.shape
+        prompt_len = cur_len
+        device = input_ids.device
+        total_length = max(max_length, cur_len)
+        # preallocated sequences and attention mask
+        sequences = torch.full((rows, total_length), pad_token_id, dtype=input_ids.dtype, device=device)
+        sequences[:, :cur_len] = input_ids
+        full_attention_mask = torch.ones((rows, total_length), dtype=attention_mask.dtype, device=device)
+        full_attention_mask[:, :cur_len] = attention_mask
+        cache = StaticKVCache(len(self.transformer.h), total_length)
+        mel_len = mel_emb.shape[1]
+        stats = {} if stats is None else stats
+        stats.update(steps=0, row_steps=0, padding_steps_avoided=0)
+        self.last_stats = stats
+        step_latents = None
+
+        def record_latent(hidden_state, step, latent_rows):
+            nonlocal step_latents
+            if return_latent:
+                latent = self.model.final_norm(hidden_state)
+                if step_latents is None:
+                    step_latents = latent.new_zeros((max(total_length - prompt_len, 1), rows, latent.shape[-1]))
+                step_latents[step, latent_rows] = latent
+
+        def logits_and_latents(hidden_states, step, latent_rows):
+            record_latent(hidden_states[:, -1], step, latent_rows)
+            return self.model.lm_head(hidden_states)[:, -1, :]
+
+        def decode_step(seq, mask, cur_len, step, latent_rows):
+            emb = self.embed_step(seq[:, cur_len - 1:cur_len], cur_len - mel_len)
+            hidden_states = self.forward(emb, mask[:, :cur_len], cache, prefix)
+            stats["steps"] += 1
+            stats["row_steps"] += seq.shape[0]
+            stats["padding_steps_avoided"] += rows - seq.shape[0]
+            return logits_and_latents(hidden_states, step, latent_rows)
+
+        hidden_states = self.prefill(self.embed_prefill(mel_emb, input_ids), attention_mask, cache, prefix,
+                                     ragged=ragged_prefill)
+        seq, mask = sequences, full_attention_mask
+        step = 0
+
+        if num_beams == 1:
+            # original row of each decoded row, the finished rows are dropped if ``compact_finished``
+            out_rows = torch.arange(rows, device=device)
+            logits = logits_and_latents(hidden_states, step, out_rows)
+            counts = sampler.token_counts(input_ids, logits.shape[-1])
+            unfinished = torch.ones(rows, dtype=torch.long, device=device)
+            if draft_layers:
+                sequences, step = self._speculative_decode(
+                    sequences, full_attention_mask, cache, prefix, cur_len, mel_len, max_length, eos_token_id,
+                    pad_token_id, logits, counts, sampler, options, logits_processor, draft_layers, num_draft_tokens,
+                    compact_finished, record_latent, stats)
+                return sequences, step_latents[:step] if return_latent else None, None
+            while True:
+                next_tokens = sampler.sample(logits, counts, seq[:, :cur_len])
+                next_tokens = next_tokens * unfinished + pad_token_id * (1 - unfinished)
+                seq[:, cur_len] = next_tokens
+                sampler.update(counts, next_tokens)
+                if streamer is not None:
+                    streamer(out_rows, next_tokens, step_latents[step, out_rows] if return_latent else None)
+                cur_len += 1
+                step += 1
+                unfinished = unfinished.mul((next_tokens != eos_token_id).long())
+                num_unfinished = int(unfinished.sum())
+                if num_unfinished == 0 or cur_len >= max_length:
+                    break
+                if compact_finished and num_unfinished < seq.shape[0]:
+                    keep = unfinished.nonzero().squeeze(1)
+                    if seq is not sequences:
+                        sequences[out_rows] = seq
+                    seq, mask, out_rows, unfinished = seq[keep], mask[keep], out_rows[keep], unfinished[keep]
+                    counts = counts[keep]
+                    self._select_rows(logits_processor, keep)
+                    cache.compact(keep)
+                logits = decode_step(seq, mask, cur_len, step, out_rows)
+            if seq is not sequences:
+                sequences[out_rows] = seq
+            return sequences[:, :cur_len], step_latents[:step] if return_latent else None, None
+
+        batch_size = rows // num_beams
+        # original batch index of each decoded group of beams, the finished groups are dropped if ``compact_finished``
+        groups = list(range(batch_size))
+        logits = logits_and_latents(hidden_states, step, slice(0, rows))
+        counts = sampler.token_counts(input_ids, logits.shape[-1])
+        hyps = [BeamHypotheses(num_beams, options["length_penalty"], options["early_stopping"]) for _ in range(batch_size)]
+        done = [False] * batch_size
+        beam_scores = torch.zeros((batch_size, num_beams), dtype=torch.float, device=device)
+        if not do_sample:
+            beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.view(-1)
+        # the source row of each step, for gathering the latents of the selected beams
+        beam_history = torch.zeros((rows, 0), dtype=torch.long, device=device)
+        while True:
+            num_groups = len(groups)
+            batch_offsets = (torch.arange(num_groups, device=device) * num_beams).unsqueeze(1)
+            next_token_scores = F.log_softmax(logits, dim=-1)
+            next_token_scores_processed = sampler(next_token_scores, counts, seq[:, :cur_len])
+            next_token_scores = next_token_scores_processed + beam_scores[:, None].expand_as(next_token_scores_processed)
+            vocab_size = next_token_scores.shape[-1]
+            next_token_scores = next_token_scores.view(num_groups, num_beams * vocab_size)
+            if do_sample:
+                probs = F.softmax(next_token_scores, dim=-1)
+                next_tokens = torch.multinomial(probs, num_samples=2 * num_beams)
+                next_token_scores = torch.gather(next_token_scores, -1, next_tokens)
+                next_token_scores, _indices = torch.sort(next_token_scores, descending=True, dim=1)
+                next_tokens = torch.gather(next_tokens, -1, _indices)
+            else:
+                next_token_scores, next_tokens = torch.topk(next_token_scores, 2 * num_beams, dim=1, largest=True, sorted=True)
+            next_indices = torch.div(next_tokens, vocab_size, rounding_mode="floor")
+            next_tokens = next_tokens % vocab_size
+
+            # candidates are sorted by score: the first `num_beams` non-eos candidates continue,
+            # eos candidates ranked in the top `num_beams` become finished hypotheses
+            is_eos = next_tokens == eos_token_id
+            keep = ~is_eos & (torch.cumsum((~is_eos).long(), dim=1) <= num_beams)
+            order = torch.argsort((~keep).to(torch.int8), dim=1, stable=True)[:, :num_beams]
+            beam_next_scores = torch.gather(next_token_scores, 1, order)
+            beam_next_tokens = torch.gather(next_tokens, 1, order)
+            beam_idx = torch.gather(next_indices, 1, order) + batch_offsets
+            finished_mask = is_eos[:, :num_beams]
+            generated_len = cur_len + 1 - prompt_len
+            if any(done[b] for b in groups) or finished_mask.any():
+                finished = finished_mask.nonzero().tolist()
+                best_scores = next_token_scores.max(dim=1).values.tolist()
+                for i, batch_idx in enumerate(groups):
+                    if done[batch_idx]:
+                        # transformers pads the finished batch items with the first row
+                        beam_next_scores[i] = 0
+                        beam_next_tokens[i] = pad_token_id
+                        beam_idx[i] = 0
+                for i, rank in finished:
+                    if done[groups[i]]:
+                        continue
+                    row = i * num_beams + next_indices[i, rank].item()
+                    hyps[groups[i]].add(seq[row, :cur_len].clone(), next_token_scores[i, rank].item(),
+                                        generated_len, torch.cat([beam_history[row], beam_history.new_tensor([row])]))
+                for i, batch_idx in enumerate(groups):
+                    if not done[batch_idx]:
+                        done[batch_idx] = hyps[batch_idx].is_done(best_scores[i], generated_len)
+            beam_scores = beam_next_scores.view(-1)
+            beam_idx = beam_idx.view(-1)
+            seq[:, :cur_len] = seq[:, :cur_len].index_select(0, beam_idx)
+            seq[:, cur_len] = beam_next_tokens.view(-1)
+            cache.reorder(beam_idx)
+            counts = sampler.update(counts.index_select(0, beam_idx), seq[:, cur_len])
+            beam_history = torch.cat([beam_history.index_select(0, beam_idx), beam_idx.unsqueeze(1)], dim=1)
+            cur_len += 1
+            step += 1
+            if all(done) or cur_len >= max_length:
+                break
+            if compact_finished and any(done[b] for b in groups):
+                kept_groups = [i for i, b in enumerate(groups) if not done[b]]
+                keep = (torch.tensor(kept_groups, device=device).unsqueeze(1) * num_beams
+                        + torch.arange(num_beams, device=device)).view(-1)
+                seq, mask = seq[keep], mask[keep]
+                beam_scores, beam_history = beam_scores[keep], beam_history[keep]
+                counts = counts[keep]
+                self._select_rows(logits_processor, keep)
+                cache.compact(keep)
+                groups = [groups[i] for i in kept_groups]
+            logits = decode_step(seq, mask, cur_len, step, slice(0, seq.shape[0]))
+
+        # finalize: add the unfinished beams and select the best hypotheses
+        final_scores = beam_scores.tolist()
+        for i, batch_idx in enumerate(groups):
+            if done[batch_idx]:
+                continue
+            for beam in range(num_beams):
+                row = i * num_beams + beam
+                hyps[batch_idx].add(seq[row, :cur_len], final_scores[row], cur_len - prompt_len, beam_history[row])
+        best, best_indices = [], []
+        for batch_idx in range(batch_size):
+            sorted_hyps = sorted(hyps[batch_idx].beams, key=lambda x: x[0])
+            for _ in range(num_return_sequences):
+                _, hyp, indices = sorted_hyps.pop()
+                best.append(hyp)
+                best_indices.append(indices)
+        sent_lengths = [len(hyp) for hyp in best]
+        sent_max_len = min(max(sent_lengths) + 1, max_length)
+        decoded = input_ids.new_full((len(best), sent_max_len), pad_token_id)
+        beam_indices = input_ids.new_full((len(best), sent_max_len), -1)
+        for i, (hyp, indices) in enumerate(zip(best, best_indices)):
+            decoded[i, :sent_lengths[i]] = hyp
+            beam_indices[i, :len(indices)] = indices
+            if sent_lengths[i] < sent_max_len:
+                decoded[i, sent_lengths[i]] = eos_token_id
+        return decoded, step_latents[:step] if return_latent else None, beam_indices
+
+    def _speculative_decode(self, sequences, attention_mask, cache, prefix, cur_len, mel_len, max_length, eos_token_id,
+                            pad_token_id, logits, counts, sampler, options, logits_processor, draft_layers,
+                            num_draft_tokens, compact_finished, record_latent, stats):
+        """
+        Self-speculative greedy/sampling decoding, after the prefill (``logits`` of the first token).
+        Every round:
+            1. the first ``draft_layers`` layers, `ln_f` and `lm_head` draft up to ``num_draft_tokens`` tokens
+               after the last emitted one, one position at a time, with the penalty/temperature/top-k/top-p of
+               ``sampler`` but not its ``logits_processor``
+            2. the other layers run once on all the drafted positions, from the hidden states of the draft:
+               the keys/values of the first layers are the ones written by the draft
+            3. the drafts are accepted in order while every unfinished row accepts: the same token as the
+               target argmax (greedy), or with probability min(1, p / q) (sampling). At the first position that
+               a row rejects, the rows emit the target token (greedy) or a draw from max(p - q, 0) (sampling),
+               the rows that accepted emit their draft, so all the rows keep the same length.
+               If all the drafts are accepted, the last position of the verification gives one more token.
+        The last emitted token is not in the cache yet, it is the first input of the next round.
+        Returns:
+            sequences: (rows, length) and the number of generated tokens
+        """
+        num_layers = len(self.transformer.h)
+        if not 0 < draft_layers < num_layers:
+            raise ValueError(f"`draft_layers` has to be in [1, {num_layers}), but is {draft_layers}")
+        do_sample = options["do_sample"]
+        draft_sampler = FusedSampler(do_sample, options["top_k"], options["top_p"], options["temperature"],
+                                     options["repetition_penalty"])
+        rows = sequences.shape[0]
+        device = sequences.device
+        seq, mask = sequences, attention_mask
+        out_rows = torch.arange(rows, device=device)
+        unfinished = torch.ones(rows, dtype=torch.long, device=device)
+        stats.update(draft_steps=0, drafted=0, accepted=0)
+        step = 0
+
+        def emit(tokens):
+            nonlocal cur_len, step, unfinished
+            tokens = tokens * unfinished + pad_token_id * (1 - unfinished)
+            seq[:, cur_len] = tokens
+            sampler.update(counts, tokens)
+            cur_len += 1
+            step += 1
+            unfinished = unfinished.mul((tokens != eos_token_id).long())
+            return int(unfinished.sum()) == 0 or cur_len >= max_length
+
+        finished = emit(sampler.sample(logits, counts, seq[:, :cur_len]))
+        while not finished:
+            num_drafts = min(num_draft_tokens, max_length - cur_len - 1)
+            # 1. draft, the positions cur_len - 1 ... cur_len - 1 + num_drafts
+            start = cur_len - 1
+            draft_counts = counts.clone()
+            draft_hidden, draft_probs = [], []
+            for j in range(num_drafts + 1):
+                index = start + j
+                emb = self.embed_step(seq[:, index:index + 1], index + 1 - mel_len)
+                hidden_states = self.run_layers(emb, mask[:, :index + 1], cache, prefix, range(draft_layers))
+                cache.advance(1)
+                draft_hidden.append(hidden_states)
+                if j == num_drafts:
+                    break
+                scores = draft_sampler(self.model.lm_head(self.transformer.ln_f(hidden_states))[:, -1], draft_counts)
+                if do_sample:
+                    probs = F.softmax(scores, dim=-1)
+                    draft_probs.append(probs)
+                    tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+                else:
+                    tokens = torch.argmax(scores, dim=-1)
+                seq[:, index + 1] = tokens
+                draft_sampler.update(draft_counts, tokens)
+            stats["draft_steps"] += num_drafts + 1
+            stats["drafted"] += num_drafts
+            # 2. verify
+            cache.truncate(start)
+            hidden_states = self.run_layers(torch.cat(draft_hidden, dim=1), mask[:, :start + num_drafts + 1], cache,
+                                            prefix, range(draft_layers, num_layers))
+            cache.advance(num_drafts + 1)
+            hidden_states = self.transformer.ln_f(hidden_states)
+            all_logits = self.model.lm_head(hidden_states)
+            stats["steps"] += 1
+            stats["row_steps"] += seq.shape[0]
+            stats["padding_steps_avoided"] += rows - seq.shape[0]
+            # 3. accept
+            for j in range(num_drafts + 1):
+                record_latent(hidden_states[:, j], step, out_rows)
+                scores = sampler(all_logits[:, j], counts, seq[:, :cur_len])
+                if j == num_drafts:
+                    accept = None
+                    tokens = torch.argmax(scores, dim=-1) if not do_sample \
+                        else torch.multinomial(F.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+                elif not do_sample:
+                    tokens = torch.argmax(scores, dim=-1)
+                    accept = tokens == seq[:, cur_len]
+                else:
+                    drafts = seq[:, cur_len]
+                    probs, draft_prob = F.softmax(scores, dim=-1), draft_probs[j]
+                    ratio = probs.gather(1, drafts[:, None]).squeeze(1) / draft_prob.gather(1, drafts[:, None]).squeeze(1)
+                    accept = torch.rand(ratio.shape, device=device) < ratio
+                    residual = (probs - draft_prob).clamp(min=0)
+                    residual = torch.where(accept[:, None] | (residual.sum(dim=-1, keepdim=True) <= 0), probs, residual)
+                    tokens = torch.where(accept, drafts, torch.multinomial(residual, num_samples=1).squeeze(1))
+                all_accepted = accept is not None and bool((accept | (unfinished == 0)).all())
+                stats["accepted"] += int(all_accepted)
+                finished = emit(tokens)
+                if finished or not all_accepted:
+                    break
+            # the last emitted token is the input of the next round, the drafts after it are dropped
+            cache.truncate(cur_len - 1)
+            seq[:, cur_len:start + num_drafts + 1] = pad_token_id
+            if finished:
+                break
+            if compact_finished and int(unfinished.sum()) < seq.shape[0]:
+                keep = unfinished.nonzero().squeeze(1)
+                if seq is not sequences:
+                    sequences[out_rows] = seq
+                seq, mask, out_rows, unfinished = seq[keep], mask[keep], out_rows[keep], unfinished[keep]
+                counts = counts[keep]
+                self._select_rows(logits_processor, keep)
+                cache.compact(keep)
+        if seq is not sequences:
+            sequences[out_rows] = seq
+        return sequences[:, :cur_len], step
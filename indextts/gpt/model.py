@@ -9,8 +9,11 @@ from transformers.utils.model_parallel_utils import (assert_device_map,
                                                      get_device_map)
 
 from indextts.gpt.conformer_encoder import ConformerEncoder
+from indextts.gpt.generation import GPT2DecodeEngine, PrefixKV
 from indextts.gpt.perceiver import PerceiverResampler
 from indextts.utils.arch_util import AttentionBlock
+from indextts.utils.mel_budget import MelTokenLimit
+from indextts.utils.runaway_guard import RunawayGuard
 from indextts.utils.typical_sampling import TypicalLogitsWarper
 
 
@@ -52,6 +55,8 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         self.model_parallel = False
         self.device_map = None
         self.cached_mel_emb = None
+        # normalized last hidden state of every decode step, see `start_latent_capture()`
+        self.captured_latents = None
 
     def parallelize(self, device_map=None):
         self.device_map = (
@@ -82,6 +87,23 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
     def store_mel_emb(self, mel_emb):
         self.cached_mel_emb = mel_emb
 
+    def start_latent_capture(self):
+        """
+        Record `final_norm(hidden_state)` of the last position at every forward call during `generate()`.
+        The hidden state that predicts a mel token is the GPT latent of that token used by BigVGAN.
+        """
+        self.captured_latents = []
+
+    def stop_latent_capture(self):
+        """
+        Stop recording and return the recorded latents in shape (steps, b, dim).
+        """
+        latents = self.captured_latents
+        self.captured_latents = None
+        if not latents:
+            return None
+        return torch.stack(latents, dim=0)
+
     def prepare_inputs_for_generation(self, input_ids, past_key_values=None, **kwargs):
         token_type_ids = kwargs.get("token_type_ids", None)  # usually None
         if not self.kv_cache:
@@ -177,6 +199,8 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
                 torch.cuda.set_device(self.transformer.first_device)
             hidden_states = hidden_states.to(self.lm_head.weight.device)
 
+        if self.captured_latents is not None:
+            self.captured_latents.append(self.final_norm(hidden_states[:, -1]))
         lm_logits = self.lm_head(hidden_states)
 
         if not return_dict:
@@ -384,8 +408,18 @@ class UnifiedVoice(nn.Module):
             embeddings.append(self.mel_embedding)
         for module in embeddings:
             module.weight.data.normal_(mean=0.0, std=.02)
+        # totals of the `RunawayGuard` stops of `inference_speech()`
+        self.runaway_stats = {"silence_stops": 0, "loop_stops": 0, "tokens_saved": 0}
 
-    def post_init_gpt2_config(self, use_deepspeed=False, kv_cache=False, half=False):
+    def post_init_gpt2_config(self, use_deepspeed=False, kv_cache=False, half=False, decode_engine="hf"):
+        """
+        Args:
+            decode_engine: default decoding of `inference_speech()`,
+                "hf": `GPT2InferenceModel.generate()` of transformers,
+                "native": `GPT2DecodeEngine` with a preallocated static KV cache.
+        """
+        if decode_engine not in ("hf", "native"):
+            raise ValueError(f"decode_engine must be 'hf' or 'native', got {decode_engine!r}")
         seq_length = self.max_mel_tokens + self.max_text_tokens + 2
         gpt_config = GPT2Config(
             vocab_size=self.number_mel_codes,
@@ -425,6 +459,8 @@ class UnifiedVoice(nn.Module):
 
         # self.inference_model = PrunedGPT2InferenceModel(gpt_config, self.gpt, self.mel_pos_embedding, self.mel_embedding, self.final_norm, self.mel_head)
         self.gpt.wte = self.mel_embedding
+        self.decode_engine = decode_engine
+        self.native_decoder = GPT2DecodeEngine(self.inference_model)
 
     def build_aligned_inputs_and_targets(self, input, start_token, stop_token):
         inp = F.pad(input, (1, 0), value=start_token)
@@ -520,7 +556,7 @@ class UnifiedVoice(nn.Module):
 
     def forward(self, speech_conditioning_latent, text_inputs, text_lengths, mel_codes, wav_lengths,
                 cond_mel_lengths=None, types=None, text_first=True, raw_mels=None, return_attentions=False,
-                return_latent=False, clip_inputs=False):
+                return_latent=False, clip_inputs=False, conds_latent=None):
         """
         Forward pass that uses both text and voice in either text conditioning mode or voice conditioning mode
         (actuated by `text_first`).
@@ -535,9 +571,13 @@ class UnifiedVoice(nn.Module):
         If return_attentions is specified, only logits are returned.
         If return_latent is specified, loss & logits are not computed or returned. Only the predicted latents are returned.
         If clip_inputs is True, the inputs will be clipped to the smallest input size across each input modality.
+        If conds_latent is given, it is used as the output of `get_conditioning()` and speech_conditioning_latent is ignored.
         """
 
-        speech_conditioning_latent = self.get_conditioning(speech_conditioning_latent, cond_mel_lengths)
+        if conds_latent is None:
+            speech_conditioning_latent = self.get_conditioning(speech_conditioning_latent, cond_mel_lengths)
+        else:
+            speech_conditioning_latent = conds_latent
         # Types are expressed by expanding the text embedding space.
         if types is not None:
             text_inputs = text_inputs * (1 + types).unsqueeze(-1)
@@ -588,6 +628,13 @@ class UnifiedVoice(nn.Module):
         loss_mel = F.cross_entropy(mel_logits, mel_targets.long())
         return loss_text.mean(), loss_mel.mean(), mel_logits
 
+    def get_conditioning_prefix(self, conds_latent: torch.Tensor) -> PrefixKV:
+        """
+        GPT keys/values of the conditioning latents (1, 32, dim), computed once per voice and shared
+        by all the sentences and rows decoded with the native engine, see `inference_speech(conds_prefix=...)`.
+        """
+        return self.native_decoder.prefix_kv(conds_latent)
+
     def prepare_gpt_inputs(
         self,
         conditional_latents: torch.Tensor,
@@ -609,38 +656,28 @@ class UnifiedVoice(nn.Module):
         single_cond = conditional_latents.ndim == 3 and conditional_latents.shape[0] == 1
         if not single_cond:
             assert conditional_latents.shape[0] == b, f"batch size mismatch: {conditional_latents.shape[0]} vs {b}"
-        batched_mel_emb = []
-        attention_masks = []
-        target_len = conditional_latents.shape[1] + L + 2
-        for i in range(b):
-            valid_mask = (text_inputs[i] != self.stop_text_token) & (text_inputs[i] != self.start_text_token)
-            text_input = text_inputs[i][valid_mask]
-            text_input = F.pad(text_input, (1, 0), value=self.start_text_token)
-            text_input = F.pad(text_input, (0, 1), value=self.stop_text_token)
-            text_input_pos = torch.arange(0, text_input.size(-1), device=device)
-            text_emb = self.text_embedding(text_input) + self.text_pos_embedding.emb(text_input_pos)
-            # concatenate [conditional latents][text embeddings]
-            conds_text_emb = [
-                conditional_latents.squeeze(0) if single_cond else conditional_latents[i],
-                text_emb,
-            ]
-            # +1 for the start_mel_token
-            attention_mask = torch.ones(target_len+1, dtype=torch.long, device=device)
-            # check this text input is padded
-            padding: int = L + 2 - text_input.size(-1)
-            # pad left of [cond][text] -> [pad][cond][text]
-            if padding > 0:
-                pad = torch.zeros((padding, conditional_latents.size(-1)), dtype=text_emb.dtype, device=device) # [p, dim]
-                conds_text_emb.insert(0, pad)
-                attention_mask[:padding] = 0
-            mel_emb = torch.cat(conds_text_emb) #[s, dim]
-            assert mel_emb.shape[0] == target_len, f"mel_emb.shape: {mel_emb.shape}, target_len: {target_len}"
-            batched_mel_emb.append(mel_emb)
-            attention_masks.append(attention_mask)
-        # [b, s, dim]
-        batched_mel_emb = torch.stack(batched_mel_emb, dim=0)
-        # [b, s+1]
-        attention_mask = torch.stack(attention_masks, dim=0)
+        # 所有行一次性处理: 去掉已有的 start/stop text token, 有效 token 左对齐, 再整体右移 padding 位
+        valid_mask = (text_inputs != self.stop_text_token) & (text_inputs != self.start_text_token)  # [b, L]
+        valid_len = valid_mask.sum(dim=1)  # [b]
+        # [start][text][stop][...], left aligned
+        text_input = torch.full((b, L + 2), self.stop_text_token, dtype=torch.long, device=device)
+        text_input[:, 0] = self.start_text_token
+        columns = torch.cumsum(valid_mask, dim=1)  # the j-th valid token goes to column j (1-based)
+        columns = torch.where(valid_mask, columns, L + 1)
+        text_input.scatter_(1, columns, torch.where(valid_mask, text_inputs.long(), self.stop_text_token))
+        text_input_pos = torch.arange(0, L + 2, device=device)
+        text_emb = self.text_embedding(text_input) + self.text_pos_embedding.emb(text_input_pos)
+        conds = conditional_latents.expand(b, -1, -1) if single_cond else conditional_latents
+        # [cond][text][...] -> [pad][cond][text]
+        conds_text_emb = torch.cat([conds, text_emb], dim=1)  # [b, s, dim]
+        target_len = conds_text_emb.shape[1]
+        padding = L - valid_len  # [b]
+        positions = torch.arange(target_len, device=device)[None, :] - padding[:, None]  # [b, s]
+        is_pad = positions < 0
+        batched_mel_emb = conds_text_emb.gather(1, positions.clamp(min=0)[..., None].expand(-1, -1, text_emb.shape[-1]))
+        batched_mel_emb = batched_mel_emb.masked_fill(is_pad[..., None], 0)
+        # [b, s+1], +1 for the start_mel_token
+        attention_mask = F.pad((~is_pad).long(), (0, 1), value=1)
         # [b, s+1]
         fake_inputs = torch.ones(
             (
@@ -653,21 +690,65 @@ class UnifiedVoice(nn.Module):
         fake_inputs[:, -1] = self.start_mel_token
         return fake_inputs, batched_mel_emb, attention_mask
     def inference_speech(self, speech_conditioning_mel, text_inputs, cond_mel_lengths=None, input_tokens=None, num_return_sequences=1,
-                         max_generate_length=None, typical_sampling=False, typical_mass=.9, **hf_generate_kwargs):
+                         max_generate_length=None, typical_sampling=False, typical_mass=.9, return_latent=False, conds_latent=None,
+                         decode_engine=None, conds_prefix=None, compact_finished=True, runaway_guard=None, runaway_stats=None,
+                         decode_stats=None, streamer=None, draft_layers=None, num_draft_tokens=4, ragged_prefill=True, **hf_generate_kwargs):
         """
         Args:
             speech_conditioning_mel: (b, n_mels, frames) or (n_mels, frames)
             text_inputs: (b, L)
             cond_mel_lengths: lengths of the conditioning mel spectrograms in shape (b,) or (1,)
             input_tokens: additional tokens for generation in shape (b, s) or (s,)
-            max_generate_length: limit the number of generated tokens
+            max_generate_length: limit the number of generated tokens, an int or one limit per batch item (b,),
+                the rows with a smaller limit than the others get the stop token forced after their limit
+            return_latent: also return the GPT latents of the generated codes, recorded during generation,
+                so that no second `forward(..., return_latent=True)` pass is needed.
+            conds_latent: (b, 32, dim) or (1, 32, dim) precomputed `get_conditioning()` output, e.g. from a speaker cache,
+                if given ``speech_conditioning_mel`` and ``cond_mel_lengths`` are ignored.
+            decode_engine: "hf" or "native", None for the one set by `post_init_gpt2_config()`.
+                The native engine accepts do_sample, top_k, top_p, temperature, repetition_penalty,
+                num_beams, length_penalty and early_stopping, and decodes the same codes with the same seed;
+                the penalty and warpers run fused in one pass, see `indextts.gpt.sampling.FusedSampler`.
+            conds_prefix: `get_conditioning_prefix()` of ``conds_latent``, used by the native engine:
+                the conditioning latents are not run again, all the rows attend to these keys/values.
+            compact_finished: native engine only, drop the finished rows from the batch instead of decoding padding,
+                see `GPT2DecodeEngine.generate()`; `native_decoder.last_stats` counts the padding steps avoided.
+            decode_stats: native engine only, dict the `GPT2DecodeEngine.generate()` stats of this call are added to
+                (per call counts when several threads share the model).
+            runaway_guard: True or a dict of `RunawayGuard` kwargs to stop the rows stuck in silence or in a token loop
+                during generation, the stops are added up in `runaway_stats`.
+            runaway_stats: dict with the keys of `runaway_stats`, the stops of this call are also added to it
+                (per call counts when several threads share the model).
+            streamer: native engine only, greedy/sampling: called with ``(rows, tokens, latents)`` after every
+                decoded token, see `GPT2DecodeEngine.generate()`.
+            draft_layers: native engine only, self-speculative decoding with the first ``draft_layers`` GPT layers
+                drafting ``num_draft_tokens`` tokens per full forward, greedy/sampling only (ignored with beams),
+                see `GPT2DecodeEngine.generate()`.
+            ragged_prefill: native engine only, the prefill skips the left padding of the shorter sentences,
+                see `GPT2DecodeEngine.prefill()`.
             hf_generate_kwargs: kwargs for `GPT2InferenceModel.generate(**hf_generate_kwargs)`
+        Returns:
+            codes: (b * num_return_sequences, T), or `(codes, latents)` if ``return_latent``,
+                latents: (b * num_return_sequences, T, dim), latents[:, i] is the latent of codes[:, i]
         """
-        if speech_conditioning_mel.ndim == 2:
-            speech_conditioning_mel = speech_conditioning_mel.unsqueeze(0)
-        if cond_mel_lengths is None:
-            cond_mel_lengths = torch.tensor([speech_conditioning_mel.shape[-1]], device=speech_conditioning_mel.device)
-        conds_latent = self.get_conditioning(speech_conditioning_mel, cond_mel_lengths)
+        if conds_latent is None:
+            if speech_conditioning_mel.ndim == 2:
+                speech_conditioning_mel = speech_conditioning_mel.unsqueeze(0)
+            if cond_mel_lengths is None:
+                cond_mel_lengths = torch.tensor([speech_conditioning_mel.shape[-1]], device=speech_conditioning_mel.device)
+            conds_latent = self.get_conditioning(speech_conditioning_mel, cond_mel_lengths)
+        native = (decode_engine or self.decode_engine) == "native"
+        if draft_layers and not native:
+            raise ValueError("speculative decoding (`draft_layers`) needs the native decode engine")
+        if streamer is not None and not native:
+            raise ValueError("`streamer` needs the native decode engine")
+        if native and conds_prefix is not None:
+            if conds_latent.shape[0] != 1:
+                raise ValueError("conds_prefix is shared by all the rows, it needs a single conditioning latent")
+            # [text][start_mel_token] only, the conditioning latents are in conds_prefix
+            conds_latent = conds_latent[:, :0]
+        else:
+            conds_prefix = None
         input_ids, inputs_embeds, attention_mask = self.prepare_gpt_inputs(conds_latent, text_inputs)
         self.inference_model.store_mel_emb(inputs_embeds)
         if input_tokens is None:
@@ -694,15 +775,82 @@ class UnifiedVoice(nn.Module):
                 raise ValueError(f"`typical_mass` has to be a float > 0 and < 1, but is {typical_mass}")
             min_tokens_to_keep = 2 if hf_generate_kwargs.get("num_beams", 1) > 1 else 1
             logits_processor.append(TypicalLogitsWarper(mass=typical_mass, min_tokens_to_keep=min_tokens_to_keep))
+        limits = None
+        if max_generate_length is not None and not isinstance(max_generate_length, int):
+            limits = torch.as_tensor(max_generate_length, dtype=torch.long, device=text_inputs.device).view(-1)
+            max_generate_length = int(limits.max())
+            if (limits < max_generate_length).any():
+                logits_processor.append(MelTokenLimit(self.stop_mel_token, trunc_index, limits))
         max_length = (trunc_index + self.max_mel_tokens - 1) if max_generate_length is None else trunc_index + max_generate_length
-        output = self.inference_model.generate(inputs, 
-                                            bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token,
-                                            eos_token_id=self.stop_mel_token, attention_mask=attention_mask,
-                                            max_length=max_length, logits_processor=logits_processor,
-                                            num_return_sequences=num_return_sequences,
-                                            **hf_generate_kwargs)
+        guard = None
+        if runaway_guard:
+            guard = RunawayGuard(self.stop_mel_token, trunc_index, max_length,
+                                 **(runaway_guard if isinstance(runaway_guard, dict) else {}))
+            logits_processor.append(guard)
+        if native:
+            call_stats = {}
+            codes, step_latents, beam_indices = self.native_decoder.generate(
+                inputs_embeds, inputs, attention_mask, max_length=max_length,
+                eos_token_id=self.stop_mel_token, pad_token_id=self.stop_mel_token,
+                num_return_sequences=num_return_sequences, logits_processor=logits_processor,
+                return_latent=return_latent, prefix=conds_prefix, compact_finished=compact_finished,
+                draft_layers=draft_layers, num_draft_tokens=num_draft_tokens, ragged_prefill=ragged_prefill,
+                stats=call_stats, streamer=streamer, **hf_generate_kwargs)
+            if decode_stats is not None:
+                for key, value in call_stats.items():
+                    decode_stats[key] = decode_stats.get(key, 0) + value
+            self._add_runaway_stats(guard, runaway_stats)
+            codes = codes[:, trunc_index:]
+            if return_latent:
+                return codes, self.gather_step_latents(step_latents, codes.shape[1], beam_indices)
+            return codes
+        if return_latent:
+            if hf_generate_kwargs.get("num_beams", 1) > 1:
+                # `beam_indices` maps every generated token back to the beam row it was sampled from
+                hf_generate_kwargs.update(return_dict_in_generate=True, output_scores=True)
+            self.inference_model.start_latent_capture()
+        try:
+            output = self.inference_model.generate(inputs,
+                                                bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token,
+                                                eos_token_id=self.stop_mel_token, attention_mask=attention_mask,
+                                                max_length=max_length, logits_processor=logits_processor,
+                                                num_return_sequences=num_return_sequences,
+                                                **hf_generate_kwargs)
+        finally:
+            step_latents = self.inference_model.stop_latent_capture() if return_latent else None
+        self._add_runaway_stats(guard, runaway_stats)
+        if return_latent:
+            codes = output if isinstance(output, torch.Tensor) else output.sequences
+            codes = codes[:, trunc_index:]
+            beam_indices = getattr(output, "beam_indices", None)
+            return codes, self.gather_step_latents(step_latents, codes.shape[1], beam_indices)
         if isinstance(output, torch.Tensor):
             return output[:, trunc_index:]
         # GenerateOutput
         output.sequences = output.sequences[:, trunc_index:]
         return output
+
+    def _add_runaway_stats(self, guard, call_stats=None):
+        if guard is not None:
+            for key, value in guard.stats.items():
+                self.runaway_stats[key] += value
+                if call_stats is not None:
+                    call_stats[key] += value
+
+    @staticmethod
+    def gather_step_latents(step_latents, length, beam_indices=None):
+        """
+        Args:
+            step_latents: (steps, rows, dim) latents recorded at each decode step
+            length: number of generated codes per sequence
+            beam_indices: (b, steps) the beam row of each generated token, padded with -1. None for greedy/sampling.
+        Returns:
+            latents: (b, length, dim)
+        """
+        step_latents = step_latents[:length]
+        if beam_indices is None:
+            return step_latents.transpose(0, 1)
+        beam_indices = beam_indices[:, :step_latents.shape[0]].clamp(min=0)
+        steps = torch.arange(beam_indices.shape[1], device=step_latents.device)
+        # the tail of shorter hypotheses (index -1) is cut off by `remove_long_silence()` anyway
+        return step_latents[steps.unsqueeze(0), beam_indices.to(step_latents.device)]
@@ -0,0 +1,158 @@
+from typing import Callable, List, Optional, Sequence
+
+import torch
+import torch.nn.functional as F
+
+
+def build_processors(repetition_penalty, logits_processor: Optional[Sequence[Callable]] = None) -> List[Callable]:
+    """The logits processors of transformers `generate()`: repetition penalty, then ``logits_processor``."""
+    processors = []
+    if repetition_penalty is not None and repetition_penalty != 1.0:
+        def repetition_penalty_processor(input_ids, scores):
+            score = torch.gather(scores, 1, input_ids)
+            score = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+            return scores.scatter(1, input_ids, score)
+        processors.append(repetition_penalty_processor)
+    if logits_processor:
+        processors.extend(logits_processor)
+    return processors
+
+
+def build_warpers(do_sample, top_k, top_p, temperature, min_tokens_to_keep=1) -> List[Callable]:
+    """The logits warpers of transformers `generate()`: temperature, top-k, then top-p."""
+    warpers = []
+    if not do_sample:
+        return warpers
+    if temperature is not None and temperature != 1.0:
+        if not temperature > 0:
+            raise ValueError(f"`temperature` has to be a strictly positive float, but is {temperature}")
+        warpers.append(lambda input_ids, scores: scores / temperature)
+    if top_k is not None and top_k != 0:
+        k = max(int(top_k), min_tokens_to_keep)
+
+        def top_k_warper(input_ids, scores):
+            kth = torch.topk(scores, min(k, scores.size(-1)))[0][..., -1, None]
+            return scores.masked_fill(scores < kth, -float("Inf"))
+        warpers.append(top_k_warper)
+    if top_p is not None and top_p < 1.0:
+        top_p = float(top_p)
+
+        def top_p_warper(input_ids, scores):
+            sorted_logits, sorted_indices = torch.sort(scores, descending=False)
+            cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+            sorted_indices_to_remove = cumulative_probs <= (1 - top_p)
+            sorted_indices_to_remove[..., -min_tokens_to_keep:] = 0
+            indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+            return scores.masked_fill(indices_to_remove, -float("Inf"))
+        warpers.append(top_p_warper)
+    return warpers
+
+
+def apply_all(functions: List[Callable], input_ids: torch.Tensor, scores: torch.Tensor):
+    for fn in functions:
+        scores = fn(input_ids, scores)
+    return scores
+
+
+class FusedSampler:
+    """
+    Repetition penalty, temperature, top-k and top-p of transformers `generate()` in one pass over the logits:
+        - the repetition penalty reads a running per-row token count (rows, vocab) instead of gathering and
+          scattering the whole history every step, see `token_counts()` and `update()`
+        - top-k and top-p share one `topk()` of the candidates, the full vocabulary is never sorted
+          (without top-k, top-p sorts once)
+    The filtered scores, and so the sampled tokens with the same seed, are the same as the separate
+    processors and warpers (`build_processors()`, `build_warpers()`), which are still used when the k-th
+    score is tied with the next one.
+    ``logits_processor`` (e.g. `TypicalLogitsWarper`) run after the repetition penalty, with the input ids.
+    """
+
+    def __init__(self, do_sample=False, top_k=50, top_p=1.0, temperature=1.0, repetition_penalty=1.0,
+                 logits_processor: Optional[Sequence[Callable]] = None, min_tokens_to_keep=1):
+        if do_sample and temperature is not None and temperature != 1.0 and not temperature > 0:
+            raise ValueError(f"`temperature` has to be a strictly positive float, but is {temperature}")
+        self.do_sample = do_sample
+        self.repetition_penalty = repetition_penalty if repetition_penalty not in (None, 1.0) else None
+        self.logits_processor = list(logits_processor or [])
+        self.temperature = temperature if do_sample and temperature not in (None, 1.0) else None
+        self.top_k = max(int(top_k), min_tokens_to_keep) if do_sample and top_k else None
+        self.top_p = float(top_p) if do_sample and top_p is not None and top_p < 1.0 else None
+        self.min_tokens_to_keep = min_tokens_to_keep
+        self.processors = build_processors(repetition_penalty, logits_processor)
+        self.warpers = build_warpers(do_sample, top_k, top_p, temperature, min_tokens_to_keep)
+
+    @staticmethod
+    def token_counts(input_ids: torch.Tensor, vocab_size: int) -> torch.Tensor:
+        """(rows, vocab_size) float32 number of times each token appears in ``input_ids`` (rows, length)."""
+        counts = torch.zeros((input_ids.shape[0], vocab_size), dtype=torch.float32, device=input_ids.device)
+        return counts.scatter_add_(1, input_ids.long(), torch.ones(input_ids.shape, device=input_ids.device))
+
+    @staticmethod
+    def update(counts: torch.Tensor, tokens: torch.Tensor) -> torch.Tensor:
+        """Count the new ``tokens`` (rows,) in place."""
+        return counts.scatter_add_(1, tokens.long().unsqueeze(1), torch.ones_like(counts[:, :1]))
+
+    def __call__(self, scores: torch.Tensor, counts: torch.Tensor,
+                 input_ids: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        The processed and warped ``scores`` (rows, vocab), the filtered tokens are -inf.
+        ``counts``: `token_counts()` of the input ids, ``input_ids`` is only needed by ``logits_processor``.
+        """
+        if self.repetition_penalty is not None:
+            # the same values as `torch.where(score < 0, score * penalty, score / penalty)` for the seen tokens,
+            # with min/max instead of boolean masks: the penalized score is on the side of the penalty
+            penalty = self.repetition_penalty
+            seen = counts.clamp(max=1) * 1e38
+            if penalty > 1:
+                scores = torch.maximum(torch.minimum(scores * penalty, scores / penalty), scores - seen)
+            else:
+                scores = torch.minimum(torch.maximum(scores * penalty, scores / penalty), scores + seen)
+        for fn in self.logits_processor:
+            scores = fn(input_ids, scores)
+        if not self.do_sample:
+            return scores
+        if self.temperature is not None:
+            scores = scores / self.temperature
+        if self.top_k is None and self.top_p is None:
+            return scores
+        vocab_size = scores.shape[-1]
+        if self.top_k is not None and self.top_k < vocab_size:
+            k = self.top_k
+            values, indices = torch.topk(scores, k + 1)
+            # transformers keeps every token tied with the k-th score
+            tied = (values[:, k] == values[:, k - 1]) & (values[:, k - 1] > -float("Inf"))
+            if tied.any():
+                return apply_all(self.warpers[1 if self.temperature is not None else 0:], input_ids, scores)
+            values, indices = values[:, :k], indices[:, :k]
+            if self.top_p is not None:
+                # the ascending scores of transformers' top-p, the filtered tokens are -inf in front
+                ascending = scores.new_full(scores.shape, -float("Inf"))
+                ascending[:, vocab_size - k:] = values.flip(-1)
+                values = values.masked_fill(self._top_p_remove(ascending, k).flip(-1), -float("Inf"))
+            return scores.new_full(scores.shape, -float("Inf")).scatter(1, indices, values)
+        if self.top_p is None:
+            return scores
+        ascending, indices = torch.sort(scores, descending=False)
+        remove = self._top_p_remove(ascending)
+        return scores.masked_fill(remove.scatter(1, indices, remove), -float("Inf"))
+
+    def _top_p_remove(self, ascending: torch.Tensor, last: Optional[int] = None) -> torch.Tensor:
+        """The top-p mask of the ``last`` (or all) ascending scores."""
+        cumulative_probs = ascending.softmax(dim=-1).cumsum(dim=-1)
+        if last is not None:
+            cumulative_probs = cumulative_probs[:, -last:]
+        remove = cumulative_probs <= (1 - self.top_p)
+        remove[..., -self.min_tokens_to_keep:] = 0
+        return remove
+
+    def sample(self, logits: torch.Tensor, counts: torch.Tensor, input_ids: Optional[torch.Tensor] = None):
+        """The next tokens (rows,): argmax, or a draw from the softmax of the filtered scores."""
+        scores = self(logits, counts, input_ids)
+        if not self.do_sample:
+            return torch.argmax(scores, dim=-1)
+        probs = F.softmax(scores, dim=-1)
+        return torch.multinomial(probs, num_samples=1).squeeze(1)
+
+    def reference(self, scores: torch.Tensor, input_ids: torch.Tensor) -> torch.Tensor:
+        """The same result as `__call__()` with the separate processors and warpers of transformers."""
+        return apply_all(self.warpers, input_ids, apply_all(self.processors, input_ids, scores))
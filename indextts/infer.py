@@ -1,8 +1,12 @@
+import math
 import os
+import queue
 import re
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from subprocess import CalledProcessError
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Tuple
 
 import numpy as np
 import sentencepiece as spm
@@ -17,25 +21,100 @@ import warnings
 warnings.filterwarnings("ignore", category=FutureWarning)
 warnings.filterwarnings("ignore", category=UserWarning)
 
+from indextts.BigVGAN.batching import vocode_batch
 from indextts.BigVGAN.models import BigVGAN as Generator
+from indextts.BigVGAN.streaming import StreamingVocoder
+from indextts.gpt.batching import ContinuousBatchingScheduler
 from indextts.gpt.model import UnifiedVoice
 from indextts.utils.checkpoint import load_checkpoint
+from indextts.utils.export import bundle_checkpoint, load_bundle_manifest, strip_gpt_for_inference
 from indextts.utils.feature_extractors import MelSpectrogramFeatures
 
 from indextts.utils.front import TextNormalizer, TextTokenizer
+from indextts.utils.mel_budget import MEL_BUDGET_FILE, MelBudgetEstimator
+from indextts.utils.speaker_cache import SpeakerCache, SpeakerConditioning, hash_audio_file
+from indextts.utils.voice_store import VoiceStore
+
+
+class _StreamClosed(Exception):
+    """Raised by the streamer of `IndexTTS.infer_stream()` to stop the generation when the caller closed the stream."""
+
+
+class _StreamingSilenceShrinker:
+    """
+    `IndexTTS.remove_long_silence()` of one sentence, token by token: the latents of the kept codes are returned
+    as soon as they are known to be kept. Runs of more than ``max_run`` silent tokens are shrunk only if the sentence
+    has more than ``max_consecutive`` silent tokens, so these tokens (and the next ones) wait until the count
+    is reached or the sentence ends.
+    """
+
+    def __init__(self, stop_token: int, silent_token=52, max_consecutive=30, max_run=10):
+        self.stop_token = stop_token
+        self.silent_token = silent_token
+        self.max_consecutive = max_consecutive
+        self.max_run = max_run
+        self.silent = 0
+        self.run = 0
+        self.stopped = False
+        # (latent, shrunk if the sentence has too many silent tokens)
+        self.pending: List[Tuple[torch.Tensor, bool]] = []
+
+    def push(self, code: int, latent: torch.Tensor) -> List[torch.Tensor]:
+        if self.stopped or code == self.stop_token:
+            self.stopped = True
+            return []
+        if code == self.silent_token:
+            self.silent += 1
+            self.run += 1
+        else:
+            self.run = 0
+        excess = self.run > self.max_run
+        if self.silent > self.max_consecutive:
+            kept = [pending for pending, shrunk in self.pending if not shrunk]
+            self.pending = []
+            return kept if excess else kept + [latent]
+        if excess or self.pending:
+            self.pending.append((latent, excess))
+            return []
+        return [latent]
+
+    def flush(self) -> List[torch.Tensor]:
+        """End of the sentence: not enough silent tokens to shrink the waiting ones."""
+        kept = [pending for pending, _ in self.pending]
+        self.pending = []
+        return kept
 
 
 class IndexTTS:
     def __init__(
         self, cfg_path="checkpoints/config.yaml", model_dir="checkpoints", is_fp16=True, device=None, use_cuda_kernel=None,
+        speaker_cache_size=64, speaker_cache_max_bytes=None, voice_dir=None, parallel_load=True, lazy_load=False,
+        tn_cache_dir=None, text_cache_size=4096, text_cache_max_bytes=32 << 20, decode_engine="hf",
+        polyphase_activation=False, parallel_resblocks=False,
     ):
         """
         Args:
             cfg_path (str): path to the config file.
-            model_dir (str): path to the model directory.
+            model_dir (str): path to the model directory, or an inference bundle made by `indextts export`.
             is_fp16 (bool): whether to use fp16.
             device (str): device to use (e.g., 'cuda:0', 'cpu'). If None, it will be set automatically based on the availability of CUDA or MPS.
             use_cuda_kernel (None | bool): whether to use BigVGan custom fused activation CUDA kernel, only for CUDA device.
+            speaker_cache_size (int): max number of reference voices whose conditioning is cached, 0 to disable.
+            speaker_cache_max_bytes (None | int): max total bytes of the cached conditioning tensors, None for no limit.
+            voice_dir (str): voice store directory used by `register_voice()`, default is ``<model_dir>/voices``.
+            parallel_load (bool): load GPT, BigVGAN and the text frontend concurrently on a thread pool.
+            lazy_load (bool): don't load anything in the constructor, each component is loaded on first use,
+                or call `preload()` to start loading in the background.
+            tn_cache_dir (str): prebuilt text normalizer FST cache directory, default is ``$INDEXTTS_TN_CACHE_DIR``
+                or the package cache dir, see `indextts build-normalizer-cache`.
+            text_cache_size (int): max number of input texts whose normalized text tokens are cached, 0 to disable.
+            text_cache_max_bytes (None | int): max total bytes of the cached texts and tokens, None for no limit.
+            decode_engine (str): GPT decoding, "hf" for transformers `generate()`,
+                "native" for the IndexTTS decode loop with a preallocated static KV cache.
+            polyphase_activation (bool): compute the BigVGAN anti-aliased activations by phases when the custom CUDA
+                kernel is not used, faster on CPU, same output up to float rounding.
+            parallel_resblocks (bool): run the AMP blocks of each BigVGAN upsampling stage concurrently,
+                on CUDA streams or on CPU threads, same output.
         """
         if device is not None:
             self.device = device
@@ -73,15 +152,71 @@ class IndexTTS:
         # else:
         #     self.dvae.eval()
         # print(">> vqvae weights restored from:", self.dvae_path)
-        self.gpt = UnifiedVoice(**self.cfg.gpt)
-        self.gpt_path = os.path.join(self.model_dir, self.cfg.gpt_checkpoint)
-        load_checkpoint(self.gpt, self.gpt_path)
-        self.gpt = self.gpt.to(self.device)
+        # 推理专用的导出包：GPT已去掉训练用的text_head, BigVGAN已合并weight norm, 并预先转换好fp16/bf16权重
+        self.bundle = load_bundle_manifest(self.model_dir)
+        if self.bundle is not None:
+            self.gpt_path, self.gpt_weights_dtype = bundle_checkpoint(self.bundle, self.model_dir, "gpt",
+                                                                      "float16" if self.is_fp16 else "float32")
+            self.bigvgan_path, _ = bundle_checkpoint(self.bundle, self.model_dir, "bigvgan")
+        else:
+            self.gpt_path = os.path.join(self.model_dir, self.cfg.gpt_checkpoint)
+            self.gpt_weights_dtype = "float32"
+            self.bigvgan_path = os.path.join(self.model_dir, self.cfg.bigvgan_checkpoint)
+        self.bpe_path = os.path.join(self.model_dir, self.cfg.dataset["bpe_model"])
+        self.tn_cache_dir = tn_cache_dir
+        self.text_cache_size = text_cache_size
+        self.text_cache_max_bytes = text_cache_max_bytes
+        self.decode_engine = decode_engine
+        self.polyphase_activation = polyphase_activation
+        self.parallel_resblocks = parallel_resblocks
+
+        # 各组件（GPT / BigVGAN / 文本前端）互相独立，在线程池中并行加载，
+        # 首次访问 self.gpt / self.bigvgan / self.tokenizer 时等待对应组件加载完成
+        self.load_times: Dict[str, float] = {}
+        self._component_loaders = {
+            "gpt": self._load_gpt,
+            "bigvgan": self._load_bigvgan,
+            "tokenizer": self._load_tokenizer,
+        }
+        self._component_futures: Dict[str, Future] = {}
+        self._components = {}
+        self._component_lock = threading.Lock()
+        self._load_executor = ThreadPoolExecutor(max_workers=len(self._component_loaders) if parallel_load else 1,
+                                                 thread_name_prefix="indextts-load")
+        if not lazy_load:
+            start_time = time.perf_counter()
+            self.preload()
+            self.wait_until_loaded()
+            print(f">> IndexTTS loaded in {time.perf_counter() - start_time:.2f} seconds, "
+                  + ", ".join(f"{name}: {t:.2f}s" for name, t in self.load_times.items()))
+        # 缓存参考音频的 cond_mel / GPT conditioning latents / speaker embedding，按音频内容hash做LRU
+        self.speaker_cache = SpeakerCache(max_entries=speaker_cache_size, max_bytes=speaker_cache_max_bytes)
+        # 预先注册的音色，可以用音色名代替参考音频路径
+        self.voice_store = VoiceStore(voice_dir if voice_dir is not None else os.path.join(self.model_dir, "voices"))
+        # 进度引用显示（可选）, 按线程保存: webui 并发的请求共用一个 IndexTTS, 各自显示自己的进度, 见 `gr_progress`
+        self._thread_local = threading.local()
+        # 连续批处理调度器, 见 enable_batching()
+        self.scheduler = None
+        # 按文本长度和语言估计每句的 max_mel_tokens 上界, 用已生成的句子长度拟合, 保存在模型目录
+        self.mel_budget = MelBudgetEstimator.load(os.path.join(self.model_dir, MEL_BUDGET_FILE))
+        self.mel_budget_stats = {"sentences": 0, "budget_hits": 0, "budget_tokens": 0, "generated_tokens": 0}
+        self._mel_budget_stats_lock = threading.Lock()
+        self.model_version = self.cfg.version if hasattr(self.cfg, "version") else None
+
+    def _load_gpt(self):
+        gpt = UnifiedVoice(**self.cfg.gpt)
+        if self.bundle is not None:
+            strip_gpt_for_inference(gpt)
+            if self.gpt_weights_dtype == "float16":
+                gpt.half()
+        load_checkpoint(gpt, self.gpt_path)
+        gpt = gpt.to(self.device)
         if self.is_fp16:
-            self.gpt.eval().half()
+            gpt.eval().half()
         else:
-            self.gpt.eval()
+            gpt.eval()
         print(">> GPT weights restored from:", self.gpt_path)
+        use_deepspeed = False
         if self.is_fp16:
             try:
                 import deepspeed
@@ -90,11 +225,13 @@ class IndexTTS:
             except (ImportError, OSError, CalledProcessError) as e:
                 use_deepspeed = False
                 print(f">> DeepSpeed加载失败，回退到标准推理: {e}")
+        # KV cache is used on every device: without it each decode step re-runs the whole
+        # [cond][text][mel] prefix and the cost grows quadratically with the mel length.
+        gpt.post_init_gpt2_config(use_deepspeed=use_deepspeed, kv_cache=True, half=self.is_fp16,
+                                  decode_engine=self.decode_engine)
+        return gpt
 
-            self.gpt.post_init_gpt2_config(use_deepspeed=use_deepspeed, kv_cache=True, half=True)
-        else:
-            self.gpt.post_init_gpt2_config(use_deepspeed=False, kv_cache=False, half=False)
-
+    def _load_bigvgan(self):
         if self.use_cuda_kernel:
             # preload the CUDA kernel for BigVGAN
             try:
@@ -105,35 +242,166 @@ class IndexTTS:
             except:
                 print(">> Failed to load custom CUDA kernel for BigVGAN. Falling back to torch.")
                 self.use_cuda_kernel = False
-        self.bigvgan = Generator(self.cfg.bigvgan, use_cuda_kernel=self.use_cuda_kernel)
-        self.bigvgan_path = os.path.join(self.model_dir, self.cfg.bigvgan_checkpoint)
-        vocoder_dict = torch.load(self.bigvgan_path, map_location="cpu")
-        self.bigvgan.load_state_dict(vocoder_dict["generator"])
-        self.bigvgan = self.bigvgan.to(self.device)
-        # remove weight norm on eval mode
-        self.bigvgan.remove_weight_norm()
-        self.bigvgan.eval()
+        bigvgan = Generator(self.cfg.bigvgan, use_cuda_kernel=self.use_cuda_kernel,
+                            polyphase_activation=self.polyphase_activation)
+        if self.bundle is not None:
+            # weight norm is already folded into the bundle weights
+            bigvgan.remove_weight_norm()
+            load_checkpoint(bigvgan, self.bigvgan_path)
+            bigvgan = bigvgan.to(self.device)
+        else:
+            load_checkpoint(bigvgan, self.bigvgan_path)
+            bigvgan = bigvgan.to(self.device)
+            # remove weight norm on eval mode
+            bigvgan.remove_weight_norm()
+        bigvgan.eval()
+        # 推理时 Snake/SnakeBeta 的 exp(alpha), 1/beta 只计算一次
+        bigvgan.freeze_for_inference()
+        bigvgan.parallel_resblocks = self.parallel_resblocks
         print(">> bigvgan weights restored from:", self.bigvgan_path)
-        self.bpe_path = os.path.join(self.model_dir, self.cfg.dataset["bpe_model"])
-        self.normalizer = TextNormalizer()
-        self.normalizer.load()
+        return bigvgan
+
+    def _load_tokenizer(self):
+        normalizer = TextNormalizer(cache_dir=self.tn_cache_dir)
+        normalizer.load()
         print(">> TextNormalizer loaded")
-        self.tokenizer = TextTokenizer(self.bpe_path, self.normalizer)
+        tokenizer = TextTokenizer(self.bpe_path, normalizer, cache_size=self.text_cache_size,
+                                  cache_max_bytes=self.text_cache_max_bytes)
         print(">> bpe model loaded from:", self.bpe_path)
-        # 缓存参考音频mel：
-        self.cache_audio_prompt = None
-        self.cache_cond_mel = None
-        # 进度引用显示（可选）
-        self.gr_progress = None
-        self.model_version = self.cfg.version if hasattr(self.cfg, "version") else None
+        return tokenizer
+
+    def _run_component_loader(self, name):
+        start_time = time.perf_counter()
+        component = self._component_loaders[name]()
+        self.load_times[name] = time.perf_counter() - start_time
+        print(f">> {name} loaded in {self.load_times[name]:.2f} seconds")
+        return component
+
+    def _component_future(self, name) -> Future:
+        with self._component_lock:
+            future = self._component_futures.get(name)
+            if future is None:
+                future = self._load_executor.submit(self._run_component_loader, name)
+                self._component_futures[name] = future
+                submitted = True
+            else:
+                submitted = False
+        if submitted:
+            # 在锁外注册: future 已完成时回调会立即在当前线程执行
+            future.add_done_callback(self._shutdown_loader_if_done)
+        return future
+
+    def _shutdown_loader_if_done(self, _future=None):
+        """Shut the load thread pool down once every component future is done, they are never submitted again."""
+        with self._component_lock:
+            futures = list(self._component_futures.values())
+        if len(futures) == len(self._component_loaders) and all(future.done() for future in futures):
+            self._load_executor.shutdown(wait=False)
+
+    def preload(self, names=None):
+        """
+        Start loading the components (``"gpt"``, ``"bigvgan"``, ``"tokenizer"``, default all) in the background,
+        without waiting for them.
+        """
+        for name in names or self._component_loaders:
+            self._component_future(name)
 
-    def remove_long_silence(self, codes: torch.Tensor, silent_token=52, max_consecutive=30):
+    def wait_until_loaded(self, names=None) -> Dict[str, float]:
+        """
+        Load the components (default all) and wait until they are ready, returns the load time of each component.
+        Raises the exception of a component that failed to load.
+        """
+        futures = [self._component_future(name) for name in names or self._component_loaders]
+        for future in futures:
+            future.result()
+        return dict(self.load_times)
+
+    def _get_component(self, name):
+        component = self._components.get(name)
+        if component is None:
+            component = self._components[name] = self._component_future(name).result()
+        return component
+
+    def is_loaded(self, name) -> bool:
+        future = self._component_futures.get(name)
+        return future is not None and future.done() and future.exception() is None
+
+    @property
+    def gpt(self) -> UnifiedVoice:
+        return self._get_component("gpt")
+
+    @property
+    def bigvgan(self) -> Generator:
+        return self._get_component("bigvgan")
+
+    @property
+    def tokenizer(self) -> TextTokenizer:
+        return self._get_component("tokenizer")
+
+    @property
+    def normalizer(self) -> TextNormalizer:
+        return self.tokenizer.normalizer
+
+    @property
+    def gr_progress(self):
+        """Gradio progress callback of the inference calls of the current thread, or None."""
+        return getattr(self._thread_local, "gr_progress", None)
+
+    @gr_progress.setter
+    def gr_progress(self, progress):
+        self._thread_local.gr_progress = progress
+
+    def _record_mel_budget(self, tokens: List[str], codes: torch.Tensor, budget: int) -> bool:
+        """
+        Count a generated sentence in `mel_budget_stats`, codes: [T] including the stop token (and padding).
+        Its length is learned by `mel_budget`, as a lower bound if the sentence was cut at its budget.
+        Returns True if the budget was reached.
+        """
+        stops = (codes == self.stop_mel_token).nonzero()
+        length = stops[0].item() if len(stops) > 0 else codes.shape[-1]
+        # the stop token is forced after the last token of the budget
+        hit = length >= budget
+        with self._mel_budget_stats_lock:
+            self.mel_budget_stats["sentences"] += 1
+            self.mel_budget_stats["budget_hits"] += hit
+            self.mel_budget_stats["budget_tokens"] += budget
+            self.mel_budget_stats["generated_tokens"] += length
+        self.mel_budget.observe(tokens, length, hit=hit)
+        return hit
+
+    def _print_mel_budget_hits(self, hit_budgets: List[int], num_sentences: int, max_mel_tokens: int,
+                               max_text_tokens_per_sentence: int):
+        """Summary of the sentences cut at their mel token budget (``hit_budgets``) in an inference call."""
+        if not hit_budgets:
+            return
+        if all(budget >= max_mel_tokens for budget in hit_budgets):
+            print(f">> mel budget: {len(hit_budgets)}/{num_sentences} sentences reached max_mel_tokens "
+                  f"({max_mel_tokens}), consider reducing `max_text_tokens_per_sentence` "
+                  f"({max_text_tokens_per_sentence}) or increasing `max_mel_tokens`")
+        else:
+            print(f">> mel budget: {len(hit_budgets)}/{num_sentences} sentences reached their estimated "
+                  f"mel token budget {hit_budgets} and may be cut off, pass `mel_budget=False` to generate up to "
+                  f"max_mel_tokens ({max_mel_tokens}) or refit the budget with `save_mel_budget()`")
+
+    def save_mel_budget(self, path=None, **fit_kwargs):
+        """
+        Refit the mel budget from the sentences generated so far and save it with the model
+        (``model_dir/mel_budget.json``), it is loaded by the next `IndexTTS` of this model.
+        """
+        coefficients = self.mel_budget.fit(**fit_kwargs)
+        self.mel_budget.save(path or os.path.join(self.model_dir, MEL_BUDGET_FILE))
+        return coefficients
+
+    def remove_long_silence(self, codes: torch.Tensor, silent_token=52, max_consecutive=30, latents: torch.Tensor = None):
         """
         Shrink special tokens (silent_token and stop_mel_token) in codes
         codes: [B, T]
+        latents: [B, T, dim], GPT latents captured along with the codes, shrinked in the same way if given.
+        Returns ``(codes, code_lens)``, or ``(codes, code_lens, latents)`` if ``latents`` is given.
         """
         code_lens = []
         codes_list = []
+        latents_list = []
         device = codes.device
         dtype = codes.dtype
         isfix = False
@@ -163,16 +431,24 @@ class IndexTTS:
                 # new code
                 len_ = len(ncode_idx)
                 codes_list.append(code[ncode_idx])
+                if latents is not None:
+                    latents_list.append(latents[i][ncode_idx])
                 isfix = True
             else:
                 # shrink to len_
                 codes_list.append(code[:len_])
+                if latents is not None:
+                    latents_list.append(latents[i][:len_])
             code_lens.append(len_)
         if isfix:
             if len(codes_list) > 1:
                 codes = pad_sequence(codes_list, batch_first=True, padding_value=self.stop_mel_token)
+                if latents is not None:
+                    latents = pad_sequence(latents_list, batch_first=True)
             else:
                 codes = codes_list[0].unsqueeze(0)
+                if latents is not None:
+                    latents = latents_list[0].unsqueeze(0)
         else:
             # unchanged
             pass
@@ -181,12 +457,16 @@ class IndexTTS:
         if max_len < codes.shape[1]:
             codes = codes[:, :max_len]
         code_lens = torch.tensor(code_lens, dtype=torch.long, device=device)
+        if latents is not None:
+            return codes, code_lens, latents[:, :max_len]
         return codes, code_lens
 
-    def bucket_sentences(self, sentences, bucket_max_size=4) -> List[List[Dict]]:
+    def bucket_sentences(self, sentences, bucket_max_size=4, length_factor=1.5) -> List[List[Dict]]:
         """
         Sentence data bucketing.
         if ``bucket_max_size=1``, return all sentences in one bucket.
+        ``length_factor``: a sentence starts a new bucket if it is this many times longer than the bucket median,
+        ``float("inf")`` to only bucket by size (sorted by length), e.g. with the ragged prefill of the native engine.
         """
         outputs: List[Dict] = []
         for idx, sent in enumerate(sentences):
@@ -195,7 +475,7 @@ class IndexTTS:
         if len(outputs) > bucket_max_size:
             # split sentences into buckets by sentence length
             buckets: List[List[Dict]] = []
-            factor = 1.5
+            factor = length_factor
             last_bucket = None
             last_bucket_sent_len_median = 0
 
@@ -205,7 +485,7 @@ class IndexTTS:
                     print(">> skip empty sentence")
                     continue
                 if last_bucket is None \
-                        or current_sent_len >= int(last_bucket_sent_len_median * factor) \
+                        or (factor != float("inf") and current_sent_len >= int(last_bucket_sent_len_median * factor)) \
                         or len(last_bucket) >= bucket_max_size:
                     # new bucket
                     buckets.append([sent])
@@ -259,6 +539,107 @@ class IndexTTS:
         tokens = torch.cat(outputs, dim=0)
         return tokens
 
+    def get_speaker_conditioning(self, audio_prompt, verbose=False) -> SpeakerConditioning:
+        """
+        Load the reference audio and compute its conditioning, reusing the cached one
+        if the same audio content was seen before.
+        ``audio_prompt`` is a path to the reference audio, or the name of a voice registered by `register_voice()`.
+        """
+        if not os.path.isfile(audio_prompt) and self.voice_store.exists(audio_prompt):
+            return self.load_voice(audio_prompt)
+        key = hash_audio_file(audio_prompt)
+        speaker = self.speaker_cache.get(key)
+        if speaker is not None:
+            return speaker
+        audio, sr = torchaudio.load(audio_prompt)
+        audio = torch.mean(audio, dim=0, keepdim=True)
+        if audio.shape[0] > 1:
+            audio = audio[0].unsqueeze(0)
+        audio = torchaudio.transforms.Resample(sr, 24000)(audio)
+        cond_mel = MelSpectrogramFeatures()(audio).to(self.device)
+        if verbose:
+            print(f"cond_mel shape: {cond_mel.shape}", "dtype:", cond_mel.dtype)
+        cond_mel_lengths = torch.tensor([cond_mel.shape[-1]], device=self.device)
+        with torch.no_grad():
+            with torch.amp.autocast(cond_mel.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                conds_latent = self.gpt.get_conditioning(cond_mel, cond_mel_lengths)
+                speaker_embedding = self.bigvgan.get_speaker_embedding(cond_mel.transpose(1, 2))
+        speaker = SpeakerConditioning(cond_mel, conds_latent, speaker_embedding)
+        self.speaker_cache.put(key, speaker)
+        return speaker
+
+    def register_voice(self, name, wav_path, overwrite=False, verbose=False) -> str:
+        """
+        Precompute the conditioning of the reference audio ``wav_path`` and save it to the voice store as ``name``,
+        after that ``name`` can be passed as ``audio_prompt`` to `infer()` / `infer_fast()`.
+        Returns the path of the voice profile.
+        """
+        speaker = self.get_speaker_conditioning(wav_path, verbose=verbose)
+        metadata = {
+            "model_version": self.model_version,
+            "gpt_checkpoint": os.path.basename(self.gpt_path),
+            "bigvgan_checkpoint": os.path.basename(self.bigvgan_path),
+            "source_file": os.path.basename(wav_path),
+            "source_sha256": speaker.key,
+        }
+        path = self.voice_store.save(name, speaker, metadata=metadata, overwrite=overwrite)
+        print(f">> voice {name!r} registered to:", path)
+        return path
+
+    def load_voice(self, name) -> SpeakerConditioning:
+        """
+        Load a voice profile from the voice store, cached like a reference audio.
+        """
+        path = self.voice_store.path(name)
+        # a re-registered voice gets a new cache key
+        key = f"voice:{name}:{os.stat(path).st_mtime_ns}"
+        speaker = self.speaker_cache.get(key)
+        if speaker is not None:
+            return speaker
+        speaker = self.voice_store.load(name, device=self.device)
+        if speaker.conds_latent.shape[-1] != self.gpt.model_dim \
+                or speaker.speaker_embedding.shape[-1] != self.cfg.bigvgan.speaker_embedding_dim:
+            raise ValueError(f"Voice {name!r} was registered with a different model: {path}")
+        model_version = self.voice_store.metadata(name).get("model_version")
+        if model_version != str(self.model_version):
+            warnings.warn(f"Voice {name!r} was registered with model version {model_version}, "
+                          f"current model version is {self.model_version}. Consider re-registering it.",
+                          category=RuntimeWarning)
+        dtype = self.dtype or torch.float32
+        speaker.conds_latent = speaker.conds_latent.to(dtype)
+        speaker.speaker_embedding = speaker.speaker_embedding.to(dtype)
+        speaker.cond_mel = speaker.cond_mel.float()
+        self.speaker_cache.put(key, speaker)
+        return speaker
+
+    def get_gpt_prefix(self, speaker: SpeakerConditioning):
+        """
+        GPT keys/values of the voice's conditioning latents, computed once and kept with the cached voice,
+        shared by all the sentences and requests of the voice (native decode engine and continuous batching).
+        """
+        if speaker.gpt_prefix is None:
+            with torch.no_grad():
+                with torch.amp.autocast(speaker.conds_latent.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                    speaker.gpt_prefix = self.gpt.get_conditioning_prefix(speaker.conds_latent)
+            if speaker.key is not None and speaker.key in self.speaker_cache:
+                # account for the prefix bytes
+                self.speaker_cache.put(speaker.key, speaker)
+        return speaker.gpt_prefix
+
+    def get_vocoder_biases(self, speaker: SpeakerConditioning):
+        """
+        BigVGAN conditioning biases of the voice's speaker embedding, computed once and kept with the cached voice,
+        see `BigVGAN.get_conditioning_biases()`.
+        """
+        if speaker.vocoder_biases is None:
+            with torch.no_grad():
+                with torch.amp.autocast(speaker.speaker_embedding.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                    speaker.vocoder_biases = self.bigvgan.get_conditioning_biases(speaker.speaker_embedding)
+            if speaker.key is not None and speaker.key in self.speaker_cache:
+                # account for the bias bytes
+                self.speaker_cache.put(speaker.key, speaker)
+        return speaker.vocoder_biases
+
     def torch_empty_cache(self):
         try:
             if "cuda" in str(self.device):
@@ -268,6 +649,34 @@ class IndexTTS:
         except Exception as e:
             pass
 
+    def enable_batching(self, max_batch_size=8, max_mel_tokens=600, **generation_kwargs) -> ContinuousBatchingScheduler:
+        """
+        Share the GPT between concurrent `infer`/`infer_fast` calls with continuous batching:
+        the sentences of all calls (any voice) are decoded together, each call gets its codes as soon as they finish.
+        Args:
+            max_batch_size: max number of sentences decoded together, the KV cache is preallocated for them
+            generation_kwargs: do_sample, top_p, top_k, temperature, repetition_penalty of the scheduler,
+                they replace the per-call generation kwargs (beam search is not supported while batching)
+        """
+        self.disable_batching()
+        self.scheduler = ContinuousBatchingScheduler(self.gpt, max_batch_size=max_batch_size, max_mel_tokens=max_mel_tokens,
+                                                     dtype=self.dtype, return_latent=True, **generation_kwargs)
+        self.scheduler.start()
+        print(f">> continuous batching enabled, max_batch_size: {max_batch_size}")
+        return self.scheduler
+
+    def disable_batching(self):
+        if self.scheduler is not None:
+            self.scheduler.close()
+            self.scheduler = None
+
+    def close(self):
+        """
+        Stop the batching scheduler and the load thread pool, the components not loaded yet are not loaded anymore.
+        """
+        self.disable_batching()
+        self._load_executor.shutdown(wait=True, cancel_futures=True)
+
     def _set_gr_progress(self, value, desc):
         if self.gr_progress is not None:
             self.gr_progress(value, desc=desc)
@@ -282,6 +691,7 @@ class IndexTTS:
             ``sentences_bucket_max_size``: 分句分桶的最大容量，默认``4``，可以根据GPU内存调整
                 - 越大，bucket数量越少，batch越多，推理速度越*快*，占用内存更多，可能影响质量
                 - 越小，bucket数量越多，batch越少，推理速度越*慢*，占用内存和质量更接近于非快速推理
+            ``capture_latents``: 在生成mel codes的同时记录GPT latent，省去第二次GPT前向计算，默认``False``
         """
         print(">> start fast inference...")
         
@@ -290,34 +700,24 @@ class IndexTTS:
             print(f"origin text:{text}")
         start_time = time.perf_counter()
 
-        # 如果参考音频改变了，才需要重新生成 cond_mel, 提升速度
-        if self.cache_cond_mel is None or self.cache_audio_prompt != audio_prompt:
-            audio, sr = torchaudio.load(audio_prompt)
-            audio = torch.mean(audio, dim=0, keepdim=True)
-            if audio.shape[0] > 1:
-                audio = audio[0].unsqueeze(0)
-            audio = torchaudio.transforms.Resample(sr, 24000)(audio)
-            cond_mel = MelSpectrogramFeatures()(audio).to(self.device)
-            cond_mel_frame = cond_mel.shape[-1]
-            if verbose:
-                print(f"cond_mel shape: {cond_mel.shape}", "dtype:", cond_mel.dtype)
-
-            self.cache_audio_prompt = audio_prompt
-            self.cache_cond_mel = cond_mel
-        else:
-            cond_mel = self.cache_cond_mel
-            cond_mel_frame = cond_mel.shape[-1]
-            pass
+        # 同一参考音频（按内容hash）的 conditioning 只计算一次, 提升速度
+        speaker = self.get_speaker_conditioning(audio_prompt, verbose=verbose)
+        cond_mel = speaker.cond_mel
+        cond_mel_frame = speaker.cond_mel_frames
 
         auto_conditioning = cond_mel
         cond_mel_lengths = torch.tensor([cond_mel_frame], device=self.device)
 
+        # native decode engine: 音色 conditioning 的 KV 只计算一次, 所有分句共享
+        conds_prefix = self.get_gpt_prefix(speaker) if self.gpt.decode_engine == "native" else None
+
         # text_tokens
         text_tokens_list = self.tokenizer.tokenize(text)
 
         sentences = self.tokenizer.split_sentences(text_tokens_list, max_tokens_per_sentence=max_text_tokens_per_sentence)
         if verbose:
             print(">> text token count:", len(text_tokens_list))
+            print("   text token cache:", self.tokenizer.cache.stats())
             print("   splited sentences count:", len(sentences))
             print("   max_text_tokens_per_sentence:", max_text_tokens_per_sentence)
             print(*sentences, sep="\n")
@@ -330,6 +730,13 @@ class IndexTTS:
         num_beams = generation_kwargs.pop("num_beams", 3)
         repetition_penalty = generation_kwargs.pop("repetition_penalty", 10.0)
         max_mel_tokens = generation_kwargs.pop("max_mel_tokens", 600)
+        capture_latents = generation_kwargs.pop("capture_latents", False)
+        # 解码中途截停卡在静音或循环里的句子, 不必生成到 max_mel_tokens
+        runaway_guard = generation_kwargs.pop("runaway_guard", True)
+        # 本次调用的截停次数, 并发的请求各自统计
+        runaway_stops = dict.fromkeys(self.gpt.runaway_stats, 0)
+        use_mel_budget = generation_kwargs.pop("mel_budget", True)
+        hit_budgets = []
         sampling_rate = 24000
         # lang = "EN"
         # lang = "ZH"
@@ -337,12 +744,21 @@ class IndexTTS:
         gpt_gen_time = 0
         gpt_forward_time = 0
         bigvgan_time = 0
+        # native 引擎: 已结束的句子移出批次, 统计省去的 padding 解码步数
+        decode_stats = {}
 
         # text processing
         all_text_tokens: List[List[torch.Tensor]] = []
         self._set_gr_progress(0.1, "text processing...")
         bucket_max_size = sentences_bucket_max_size if self.device != "cpu" else 1
-        all_sentences = self.bucket_sentences(sentences, bucket_max_size=bucket_max_size)
+        scheduler = self.scheduler
+        if scheduler is not None:
+            # 连续批处理: 每个分句单独提交给调度器, 由调度器与其他请求的分句一起解码
+            bucket_max_size = 1
+            capture_latents = True
+        # native 引擎的 prefill 跳过 padding (ragged prefill), 长短句可以放进同一个桶
+        length_factor = float("inf") if self.gpt.decode_engine == "native" else 1.5
+        all_sentences = self.bucket_sentences(sentences, bucket_max_size=bucket_max_size, length_factor=length_factor)
         bucket_count = len(all_sentences)
         if verbose:
             print(">> sentences bucket_count:", bucket_count,
@@ -353,6 +769,7 @@ class IndexTTS:
             all_text_tokens.append(temp_tokens)
             for item in sentences:
                 sent = item["sent"]
+                item["budget"] = self.mel_budget.estimate(sent, max_mel_tokens) if use_mel_budget else max_mel_tokens
                 text_tokens = self.tokenizer.convert_tokens_to_ids(sent)
                 text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
                 if verbose:
@@ -367,9 +784,16 @@ class IndexTTS:
         # Sequential processing of bucketing data
         all_batch_num = sum(len(s) for s in all_sentences)
         all_batch_codes = []
+        all_batch_latents = []
         processed_num = 0
-        for item_tokens in all_text_tokens:
+        if scheduler is not None:
+            gpt_prefix = self.get_gpt_prefix(speaker)
+            futures = [scheduler.submit(speaker.conds_latent, item_tokens[0], max_mel_tokens=bucket[0]["budget"],
+                                        prefix=gpt_prefix, runaway_guard=runaway_guard, runaway_stats=runaway_stops)
+                       for item_tokens, bucket in zip(all_text_tokens, all_sentences)]
+        for bucket_idx, item_tokens in enumerate(all_text_tokens):
             batch_num = len(item_tokens)
+            budgets = [item["budget"] for item in all_sentences[bucket_idx]]
             if batch_num > 1:
                 batch_text_tokens = self.pad_tokens_cat(item_tokens)
             else:
@@ -378,6 +802,12 @@ class IndexTTS:
             # gpt speech
             self._set_gr_progress(0.2 + 0.3 * processed_num/all_batch_num, f"gpt inference speech... {processed_num}/{all_batch_num}")
             m_start_time = time.perf_counter()
+            if scheduler is not None:
+                temp_codes, temp_latents = futures[bucket_idx].result()
+                all_batch_codes.append(temp_codes)
+                all_batch_latents.append(temp_latents)
+                gpt_gen_time += time.perf_counter() - m_start_time
+                continue
             with torch.no_grad():
                 with torch.amp.autocast(batch_text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
                     temp_codes = self.gpt.inference_speech(auto_conditioning, batch_text_tokens,
@@ -391,8 +821,17 @@ class IndexTTS:
                                         length_penalty=length_penalty,
                                         num_beams=num_beams,
                                         repetition_penalty=repetition_penalty,
-                                        max_generate_length=max_mel_tokens,
+                                        max_generate_length=budgets if batch_num > 1 else budgets[0],
+                                        return_latent=capture_latents,
+                                        conds_latent=speaker.conds_latent,
+                                        conds_prefix=conds_prefix,
+                                        runaway_guard=runaway_guard,
+                                        runaway_stats=runaway_stops,
+                                        decode_stats=decode_stats,
                                         **generation_kwargs)
+                    if capture_latents:
+                        temp_codes, temp_latents = temp_codes
+                        all_batch_latents.append(temp_latents)
                     all_batch_codes.append(temp_codes)
             gpt_gen_time += time.perf_counter() - m_start_time
 
@@ -400,28 +839,29 @@ class IndexTTS:
         self._set_gr_progress(0.5, "gpt inference latents...")
         all_idxs = []
         all_latents = []
-        has_warned = False
-        for batch_codes, batch_tokens, batch_sentences in zip(all_batch_codes, all_text_tokens, all_sentences):
+        for batch_idx, (batch_codes, batch_tokens, batch_sentences) in enumerate(zip(all_batch_codes, all_text_tokens, all_sentences)):
             for i in range(batch_codes.shape[0]):
                 codes = batch_codes[i]  # [x]
-                if not has_warned and codes[-1] != self.stop_mel_token:
-                    warnings.warn(
-                        f"WARN: generation stopped due to exceeding `max_mel_tokens` ({max_mel_tokens}). "
-                        f"Consider reducing `max_text_tokens_per_sentence`({max_text_tokens_per_sentence}) or increasing `max_mel_tokens`.",
-                        category=RuntimeWarning
-                    )
-                    has_warned = True
+                if self._record_mel_budget(batch_sentences[i]["sent"], codes, batch_sentences[i]["budget"]):
+                    hit_budgets.append(batch_sentences[i]["budget"])
                 codes = codes.unsqueeze(0)  # [x] -> [1, x]
                 if verbose:
                     print("codes:", codes.shape)
                     print(codes)
-                codes, code_lens = self.remove_long_silence(codes, silent_token=52, max_consecutive=30)
+                if capture_latents:
+                    latent = all_batch_latents[batch_idx][i].unsqueeze(0)
+                    codes, code_lens, latent = self.remove_long_silence(codes, silent_token=52, max_consecutive=30, latents=latent)
+                else:
+                    codes, code_lens = self.remove_long_silence(codes, silent_token=52, max_consecutive=30)
                 if verbose:
                     print("fix codes:", codes.shape)
                     print(codes)
                     print("code_lens:", code_lens)
                 text_tokens = batch_tokens[i]
                 all_idxs.append(batch_sentences[i]["idx"])
+                if capture_latents:
+                    all_latents.append(latent)
+                    continue
                 m_start_time = time.perf_counter()
                 with torch.no_grad():
                     with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
@@ -430,39 +870,35 @@ class IndexTTS:
                                         torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
                                         code_lens*self.gpt.mel_length_compression,
                                         cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]], device=text_tokens.device),
-                                        return_latent=True, clip_inputs=False)
+                                        return_latent=True, clip_inputs=False, conds_latent=speaker.conds_latent)
                         gpt_forward_time += time.perf_counter() - m_start_time
                         all_latents.append(latent)
-        del all_batch_codes, all_text_tokens, all_sentences
-        # bigvgan chunk
+        del all_batch_codes, all_batch_latents, all_text_tokens, all_sentences
+        # bigvgan 批量解码: 分句按长度排序分批, padding 部分按长度 mask, 与逐句解码结果一致
         chunk_size = 2
         all_latents = [all_latents[all_idxs.index(i)] for i in range(len(all_latents))]
         if verbose:
             print(">> all_latents:", len(all_latents))
             print("  latents length:", [l.shape[1] for l in all_latents])
-        chunk_latents = [all_latents[i : i + chunk_size] for i in range(0, len(all_latents), chunk_size)]
-        chunk_length = len(chunk_latents)
+        chunk_length = math.ceil(len(all_latents) / chunk_size)
         latent_length = len(all_latents)
 
         # bigvgan chunk decode
         self._set_gr_progress(0.7, "bigvgan decode...")
         tqdm_progress = tqdm(total=latent_length, desc="bigvgan")
-        for items in chunk_latents:
-            tqdm_progress.update(len(items))
-            latent = torch.cat(items, dim=1)
-            with torch.no_grad():
-                with torch.amp.autocast(latent.device.type, enabled=self.dtype is not None, dtype=self.dtype):
-                    m_start_time = time.perf_counter()
-                    wav, _ = self.bigvgan(latent, auto_conditioning.transpose(1, 2))
-                    bigvgan_time += time.perf_counter() - m_start_time
-                    wav = wav.squeeze(1)
-                    pass
-            wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
-            wavs.append(wav.cpu()) # to cpu before saving
+        with torch.no_grad():
+            with torch.amp.autocast(torch.device(self.device).type, enabled=self.dtype is not None, dtype=self.dtype):
+                m_start_time = time.perf_counter()
+                for wav in vocode_batch(self.bigvgan, all_latents, max_batch_size=chunk_size,
+                                        cond_biases=self.get_vocoder_biases(speaker)):
+                    wav = torch.clamp(32767 * wav.float(), -32767.0, 32767.0)
+                    wavs.append(wav.cpu()) # to cpu before saving
+                    tqdm_progress.update(1)
+                bigvgan_time += time.perf_counter() - m_start_time
 
         # clear cache
         tqdm_progress.close()  # 确保进度条被关闭
-        del all_latents, chunk_latents
+        del all_latents
         end_time = time.perf_counter()
         self.torch_empty_cache()
 
@@ -472,6 +908,9 @@ class IndexTTS:
         wav_length = wav.shape[-1] / sampling_rate
         print(f">> Reference audio length: {cond_mel_frame * 256 / sampling_rate:.2f} seconds")
         print(f">> gpt_gen_time: {gpt_gen_time:.2f} seconds")
+        if any(runaway_stops.values()):
+            print(f">> runaway guard: {runaway_stops}")
+        self._print_mel_budget_hits(hit_budgets, len(sentences), max_mel_tokens, max_text_tokens_per_sentence)
         print(f">> gpt_forward_time: {gpt_forward_time:.2f} seconds")
         print(f">> bigvgan_time: {bigvgan_time:.2f} seconds")
         print(f">> Total fast inference time: {end_time - start_time:.2f} seconds")
@@ -479,6 +918,8 @@ class IndexTTS:
         print(f">> [fast] bigvgan chunk_length: {chunk_length}")
         print(f">> [fast] batch_num: {all_batch_num} bucket_max_size: {bucket_max_size}", f"bucket_count: {bucket_count}" if bucket_max_size > 1 else "")
         print(f">> [fast] RTF: {(end_time - start_time) / wav_length:.4f}")
+        if self.gpt.decode_engine == "native" and scheduler is None:
+            print(f">> [fast] padding steps avoided: {decode_stats.get('padding_steps_avoided', 0)}")
 
         # save audio
         wav = wav.cpu()  # to cpu
@@ -496,37 +937,30 @@ class IndexTTS:
 
     # 原始推理模式
     def infer(self, audio_prompt, text, output_path, verbose=False, max_text_tokens_per_sentence=120, **generation_kwargs):
+        """
+        Args:
+            ``capture_latents``: 在生成mel codes的同时记录GPT latent，省去第二次GPT前向计算，默认``False``
+        """
         print(">> start inference...")
         self._set_gr_progress(0, "start inference...")
         if verbose:
             print(f"origin text:{text}")
         start_time = time.perf_counter()
 
-        # 如果参考音频改变了，才需要重新生成 cond_mel, 提升速度
-        if self.cache_cond_mel is None or self.cache_audio_prompt != audio_prompt:
-            audio, sr = torchaudio.load(audio_prompt)
-            audio = torch.mean(audio, dim=0, keepdim=True)
-            if audio.shape[0] > 1:
-                audio = audio[0].unsqueeze(0)
-            audio = torchaudio.transforms.Resample(sr, 24000)(audio)
-            cond_mel = MelSpectrogramFeatures()(audio).to(self.device)
-            cond_mel_frame = cond_mel.shape[-1]
-            if verbose:
-                print(f"cond_mel shape: {cond_mel.shape}", "dtype:", cond_mel.dtype)
-
-            self.cache_audio_prompt = audio_prompt
-            self.cache_cond_mel = cond_mel
-        else:
-            cond_mel = self.cache_cond_mel
-            cond_mel_frame = cond_mel.shape[-1]
-            pass
+        # 同一参考音频（按内容hash）的 conditioning 只计算一次, 提升速度
+        speaker = self.get_speaker_conditioning(audio_prompt, verbose=verbose)
+        cond_mel = speaker.cond_mel
+        cond_mel_frame = speaker.cond_mel_frames
 
         self._set_gr_progress(0.1, "text processing...")
         auto_conditioning = cond_mel
+        # native decode engine: 音色 conditioning 的 KV 只计算一次, 所有分句共享
+        conds_prefix = self.get_gpt_prefix(speaker) if self.gpt.decode_engine == "native" else None
         text_tokens_list = self.tokenizer.tokenize(text)
         sentences = self.tokenizer.split_sentences(text_tokens_list, max_text_tokens_per_sentence)
         if verbose:
             print("text token count:", len(text_tokens_list))
+            print("text token cache:", self.tokenizer.cache.stats())
             print("sentences count:", len(sentences))
             print("max_text_tokens_per_sentence:", max_text_tokens_per_sentence)
             print(*sentences, sep="\n")
@@ -539,6 +973,15 @@ class IndexTTS:
         num_beams = generation_kwargs.pop("num_beams", 3)
         repetition_penalty = generation_kwargs.pop("repetition_penalty", 10.0)
         max_mel_tokens = generation_kwargs.pop("max_mel_tokens", 600)
+        capture_latents = generation_kwargs.pop("capture_latents", False)
+        # 解码中途截停卡在静音或循环里的句子, 不必生成到 max_mel_tokens
+        runaway_guard = generation_kwargs.pop("runaway_guard", True)
+        # 本次调用的截停次数, 并发的请求各自统计
+        runaway_stops = dict.fromkeys(self.gpt.runaway_stats, 0)
+        use_mel_budget = generation_kwargs.pop("mel_budget", True)
+        hit_budgets = []
+        budgets = [self.mel_budget.estimate(sent, max_mel_tokens) if use_mel_budget else max_mel_tokens
+                   for sent in sentences]
         sampling_rate = 24000
         # lang = "EN"
         # lang = "ZH"
@@ -547,8 +990,17 @@ class IndexTTS:
         gpt_forward_time = 0
         bigvgan_time = 0
         progress = 0
-        has_warned = False
-        for sent in sentences:
+        scheduler = self.scheduler
+        if scheduler is not None:
+            # 连续批处理: 所有分句一次提交, 边生成边解码前面已完成的分句
+            capture_latents = True
+            gpt_prefix = self.get_gpt_prefix(speaker)
+            futures = [scheduler.submit(speaker.conds_latent,
+                                        torch.tensor(self.tokenizer.convert_tokens_to_ids(sent), dtype=torch.int32),
+                                        max_mel_tokens=budget, prefix=gpt_prefix,
+                                        runaway_guard=runaway_guard, runaway_stats=runaway_stops)
+                       for sent, budget in zip(sentences, budgets)]
+        for sent_idx, sent in enumerate(sentences):
             text_tokens = self.tokenizer.convert_tokens_to_ids(sent)
             text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
             # text_tokens = F.pad(text_tokens, (0, 1))  # This may not be necessary.
@@ -567,30 +1019,34 @@ class IndexTTS:
             self._set_gr_progress(0.2 + 0.4 * (progress-1) / len(sentences), f"gpt inference latent... {progress}/{len(sentences)}")
             m_start_time = time.perf_counter()
             with torch.no_grad():
-                with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
-                    codes = self.gpt.inference_speech(auto_conditioning, text_tokens,
-                                                        cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]],
-                                                                                      device=text_tokens.device),
-                                                        # text_lengths=text_len,
-                                                        do_sample=do_sample,
-                                                        top_p=top_p,
-                                                        top_k=top_k,
-                                                        temperature=temperature,
-                                                        num_return_sequences=autoregressive_batch_size,
-                                                        length_penalty=length_penalty,
-                                                        num_beams=num_beams,
-                                                        repetition_penalty=repetition_penalty,
-                                                        max_generate_length=max_mel_tokens,
-                                                        **generation_kwargs)
+                if scheduler is not None:
+                    codes, latent = futures[sent_idx].result()
+                else:
+                    with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                        codes = self.gpt.inference_speech(auto_conditioning, text_tokens,
+                                                            cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]],
+                                                                                          device=text_tokens.device),
+                                                            # text_lengths=text_len,
+                                                            do_sample=do_sample,
+                                                            top_p=top_p,
+                                                            top_k=top_k,
+                                                            temperature=temperature,
+                                                            num_return_sequences=autoregressive_batch_size,
+                                                            length_penalty=length_penalty,
+                                                            num_beams=num_beams,
+                                                            repetition_penalty=repetition_penalty,
+                                                            max_generate_length=budgets[sent_idx],
+                                                            return_latent=capture_latents,
+                                                            conds_latent=speaker.conds_latent,
+                                                            conds_prefix=conds_prefix,
+                                                            runaway_guard=runaway_guard,
+                                                            runaway_stats=runaway_stops,
+                                                            **generation_kwargs)
+                        if capture_latents:
+                            codes, latent = codes
                 gpt_gen_time += time.perf_counter() - m_start_time
-                if not has_warned and (codes[:, -1] != self.stop_mel_token).any():
-                    warnings.warn(
-                        f"WARN: generation stopped due to exceeding `max_mel_tokens` ({max_mel_tokens}). "
-                        f"Input text tokens: {text_tokens.shape[1]}. "
-                        f"Consider reducing `max_text_tokens_per_sentence`({max_text_tokens_per_sentence}) or increasing `max_mel_tokens`.",
-                        category=RuntimeWarning
-                    )
-                    has_warned = True
+                if self._record_mel_budget(sent, codes[0], budgets[sent_idx]):
+                    hit_budgets.append(budgets[sent_idx])
 
                 code_lens = torch.tensor([codes.shape[-1]], device=codes.device, dtype=codes.dtype)
                 if verbose:
@@ -600,25 +1056,29 @@ class IndexTTS:
 
                 # remove ultra-long silence if exits
                 # temporarily fix the long silence bug.
-                codes, code_lens = self.remove_long_silence(codes, silent_token=52, max_consecutive=30)
+                if capture_latents:
+                    codes, code_lens, latent = self.remove_long_silence(codes, silent_token=52, max_consecutive=30, latents=latent)
+                else:
+                    codes, code_lens = self.remove_long_silence(codes, silent_token=52, max_consecutive=30)
                 if verbose:
                     print(codes, type(codes))
                     print(f"fix codes shape: {codes.shape}, codes type: {codes.dtype}")
                     print(f"code len: {code_lens}")
                 self._set_gr_progress(0.2 + 0.4 * progress / len(sentences), f"gpt inference speech... {progress}/{len(sentences)}")
-                m_start_time = time.perf_counter()
                 # latent, text_lens_out, code_lens_out = \
                 with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
-                    latent = \
-                        self.gpt(auto_conditioning, text_tokens,
-                                    torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
-                                    code_lens*self.gpt.mel_length_compression,
-                                    cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]], device=text_tokens.device),
-                                    return_latent=True, clip_inputs=False)
-                    gpt_forward_time += time.perf_counter() - m_start_time
+                    if not capture_latents:
+                        m_start_time = time.perf_counter()
+                        latent = \
+                            self.gpt(auto_conditioning, text_tokens,
+                                        torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
+                                        code_lens*self.gpt.mel_length_compression,
+                                        cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]], device=text_tokens.device),
+                                        return_latent=True, clip_inputs=False, conds_latent=speaker.conds_latent)
+                        gpt_forward_time += time.perf_counter() - m_start_time
 
                     m_start_time = time.perf_counter()
-                    wav, _ = self.bigvgan(latent, auto_conditioning.transpose(1, 2))
+                    wav, _ = self.bigvgan(latent, auto_conditioning.transpose(1, 2), cond_biases=self.get_vocoder_biases(speaker))
                     bigvgan_time += time.perf_counter() - m_start_time
                     wav = wav.squeeze(1)
 
@@ -633,6 +1093,9 @@ class IndexTTS:
         wav_length = wav.shape[-1] / sampling_rate
         print(f">> Reference audio length: {cond_mel_frame * 256 / sampling_rate:.2f} seconds")
         print(f">> gpt_gen_time: {gpt_gen_time:.2f} seconds")
+        if any(runaway_stops.values()):
+            print(f">> runaway guard: {runaway_stops}")
+        self._print_mel_budget_hits(hit_budgets, len(sentences), max_mel_tokens, max_text_tokens_per_sentence)
         print(f">> gpt_forward_time: {gpt_forward_time:.2f} seconds")
         print(f">> bigvgan_time: {bigvgan_time:.2f} seconds")
         print(f">> Total inference time: {end_time - start_time:.2f} seconds")
@@ -657,6 +1120,147 @@ class IndexTTS:
             wav_data = wav_data.numpy().T
             return (sampling_rate, wav_data)
 
+    def infer_stream(self, audio_prompt, text, verbose=False, max_text_tokens_per_sentence=120, window_frames=16,
+                     max_window_frames=128, prefetch_sentences=2, **generation_kwargs) -> Iterator[torch.Tensor]:
+        """
+        Streaming `infer()`: yield the int16 PCM chunks (samples,) at 24kHz as soon as they are vocoded.
+        A producer thread generates the sentences one after the other, the caller vocodes their latents
+        with `StreamingVocoder`, so vocoding overlaps generation:
+            - greedy / sampling (``num_beams=1``): the latents are pushed as the tokens are decoded (native decode
+              engine, same codes as transformers `generate()`), the first chunk only waits for the first
+              ``window_frames`` frames and the right context of the vocoder
+            - beam search: a beam's latents are final only when the sentence ends, the sentences are vocoded
+              once generated, the first chunk waits for the whole first sentence
+        The concatenated chunks are the audio of `infer(capture_latents=True)` with the same codes.
+        Args:
+            prefetch_sentences: max sentences generated ahead of the vocoding, the producer then waits for the caller
+            generation_kwargs: the same as `infer()`, the GPT latents are always captured during generation
+        """
+        start_time = time.perf_counter()
+        speaker = self.get_speaker_conditioning(audio_prompt, verbose=verbose)
+        sentences = self.tokenizer.split_sentences(self.tokenizer.tokenize(text), max_text_tokens_per_sentence)
+        if verbose:
+            print("sentences count:", len(sentences))
+            print(*sentences, sep="\n")
+        do_sample = generation_kwargs.pop("do_sample", True)
+        top_p = generation_kwargs.pop("top_p", 0.8)
+        top_k = generation_kwargs.pop("top_k", 30)
+        temperature = generation_kwargs.pop("temperature", 1.0)
+        length_penalty = generation_kwargs.pop("length_penalty", 0.0)
+        num_beams = generation_kwargs.pop("num_beams", 3)
+        repetition_penalty = generation_kwargs.pop("repetition_penalty", 10.0)
+        max_mel_tokens = generation_kwargs.pop("max_mel_tokens", 600)
+        generation_kwargs.pop("capture_latents", None)
+        runaway_guard = generation_kwargs.pop("runaway_guard", True)
+        use_mel_budget = generation_kwargs.pop("mel_budget", True)
+        # 逐 token 推送 latent: greedy / sampling, 用 native 引擎的 streamer
+        token_streaming = num_beams == 1 and not generation_kwargs.get("draft_layers")
+        if token_streaming:
+            generation_kwargs["decode_engine"] = "native"
+        native = (generation_kwargs.get("decode_engine") or self.gpt.decode_engine) == "native"
+        conds_prefix = self.get_gpt_prefix(speaker) if native else None
+        vocoder = StreamingVocoder(self.bigvgan, speaker_embedding=speaker.speaker_embedding,
+                                   window_frames=window_frames, max_window_frames=max_window_frames,
+                                   cond_biases=self.get_vocoder_biases(speaker))
+        device_type = torch.device(self.device).type
+        # 生成线程 -> 调用方: ("start", None), ("latent", (1, t, dim)), ("end", None) 每句, 最后 ("done", None),
+        # 出错时 ("error", exception)
+        generated = queue.Queue()
+        # 最多提前生成 prefetch_sentences 句, 调用方 flush 一句后释放
+        sentence_slots = threading.Semaphore(max(1, prefetch_sentences))
+        stopped = threading.Event()
+
+        def generate_sentence(sent, budget):
+            text_tokens = torch.tensor(self.tokenizer.convert_tokens_to_ids(sent), dtype=torch.int32,
+                                       device=self.device).unsqueeze(0)
+            shrinker = _StreamingSilenceShrinker(self.stop_mel_token)
+
+            def streamer(rows, tokens, latents):
+                if stopped.is_set():
+                    raise _StreamClosed()
+                kept = shrinker.push(tokens[0].item(), latents[:1].unsqueeze(1))
+                if kept:
+                    generated.put(("latent", torch.cat(kept, dim=1)))
+
+            # no_grad / autocast 是线程局部的, 在生成线程内设置
+            with torch.no_grad(), torch.amp.autocast(device_type, enabled=self.dtype is not None, dtype=self.dtype):
+                codes, latent = self.gpt.inference_speech(speaker.cond_mel, text_tokens,
+                                                          do_sample=do_sample,
+                                                          top_p=top_p,
+                                                          top_k=top_k,
+                                                          temperature=temperature,
+                                                          num_return_sequences=1,
+                                                          length_penalty=length_penalty,
+                                                          num_beams=num_beams,
+                                                          repetition_penalty=repetition_penalty,
+                                                          max_generate_length=budget,
+                                                          return_latent=True,
+                                                          conds_latent=speaker.conds_latent,
+                                                          conds_prefix=conds_prefix,
+                                                          runaway_guard=runaway_guard,
+                                                          streamer=streamer if token_streaming else None,
+                                                          **generation_kwargs)
+            self._record_mel_budget(sent, codes[0], budget)
+            if token_streaming:
+                kept = shrinker.flush()
+                if kept:
+                    generated.put(("latent", torch.cat(kept, dim=1)))
+            else:
+                codes, code_lens, latent = self.remove_long_silence(codes, silent_token=52, max_consecutive=30,
+                                                                    latents=latent)
+                for i in range(0, latent.shape[1], window_frames):
+                    generated.put(("latent", latent[:, i:i + window_frames]))
+
+        def generate():
+            try:
+                for sent in sentences:
+                    while not sentence_slots.acquire(timeout=0.1):
+                        if stopped.is_set():
+                            return
+                    if stopped.is_set():
+                        return
+                    budget = self.mel_budget.estimate(sent, max_mel_tokens) if use_mel_budget else max_mel_tokens
+                    generated.put(("start", None))
+                    generate_sentence(sent, budget)
+                    generated.put(("end", None))
+                generated.put(("done", None))
+            except _StreamClosed:
+                pass
+            except BaseException as e:
+                generated.put(("error", e))
+
+        producer = threading.Thread(target=generate, name="indextts-stream-gpt", daemon=True)
+        producer.start()
+        first_chunk_time = None
+        audio_samples = 0
+        try:
+            while True:
+                kind, value = generated.get()
+                if kind == "done":
+                    break
+                if kind == "error":
+                    raise value
+                if kind == "start":
+                    vocoder.reset()
+                    continue
+                with torch.amp.autocast(device_type, enabled=self.dtype is not None, dtype=self.dtype):
+                    pcm = vocoder.push(value) if kind == "latent" else vocoder.flush()
+                if kind == "end":
+                    sentence_slots.release()
+                if pcm is None:
+                    continue
+                if first_chunk_time is None:
+                    first_chunk_time = time.perf_counter() - start_time
+                    print(f">> [stream] first audio chunk after {first_chunk_time:.2f} seconds")
+                audio_samples += pcm.shape[-1]
+                yield pcm.cpu()
+        finally:
+            stopped.set()
+            # 等待生成线程结束, 之后不会再有线程使用模型
+            producer.join()
+        end_time = time.perf_counter()
+        if audio_samples:
+            print(f">> [stream] RTF: {(end_time - start_time) / (audio_samples / 24000):.4f}")
 
 if __name__ == "__main__":
     prompt_wav="test_data/input.wav"
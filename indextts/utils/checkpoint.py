@@ -22,13 +22,70 @@ import torch
 import yaml
 
 
-def load_checkpoint(model: torch.nn.Module, model_pth: str) -> dict:
-    checkpoint = torch.load(model_pth, map_location='cpu')
-    checkpoint = checkpoint['model'] if 'model' in checkpoint else checkpoint
-    model.load_state_dict(checkpoint, strict=True)
-    info_path = re.sub('.pth$', '.yaml', model_pth)
+def checkpoint_safetensors_path(model_pth: str) -> str:
+    """The converted safetensors sibling of a ``.pth`` checkpoint, e.g. ``gpt.pth`` -> ``gpt.safetensors``."""
+    return os.path.splitext(model_pth)[0] + '.safetensors'
+
+
+def load_state_dict_file(model_pth: str, mmap: bool = True) -> dict:
+    """
+    Load a state dict from ``.safetensors`` or ``.pth``.
+    With ``mmap`` the tensors are backed by the memory-mapped file instead of being read into RAM,
+    so several processes loading the same checkpoint share the page cache.
+    """
+    if model_pth.endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return load_file(model_pth, device='cpu')
+    if mmap:
+        try:
+            return torch.load(model_pth, map_location='cpu', mmap=True, weights_only=True)
+        except Exception as e:
+            # legacy (non-zipfile) checkpoints or pickled non-tensor objects
+            logging.warning(f'mmap loading {model_pth} failed, falling back to torch.load: {e}')
+    return torch.load(model_pth, map_location='cpu')
+
+
+def unwrap_state_dict(checkpoint: dict) -> dict:
+    for key in ('model', 'generator'):
+        if key in checkpoint and isinstance(checkpoint[key], dict):
+            return checkpoint[key]
+    return checkpoint
+
+
+def load_checkpoint(model: torch.nn.Module, model_pth: str, mmap: bool = True) -> dict:
+    """
+    Load ``model_pth`` into ``model``, preferring its converted ``.safetensors`` sibling if present.
+    With ``mmap`` the parameters are assigned the memory-mapped tensors (no copy) when their dtypes match.
+    """
+    safetensors_pth = checkpoint_safetensors_path(model_pth)
+    checkpoint_pth = safetensors_pth if os.path.isfile(safetensors_pth) else model_pth
+    checkpoint = unwrap_state_dict(load_state_dict_file(checkpoint_pth, mmap=mmap))
+    assign = False
+    if mmap:
+        model_state = model.state_dict()
+        assign = all(k in checkpoint and checkpoint[k].dtype == v.dtype for k, v in model_state.items())
+    model.load_state_dict(checkpoint, strict=True, assign=assign)
+    info_path = os.path.splitext(model_pth)[0] + '.yaml'
     configs = {}
     if os.path.exists(info_path):
         with open(info_path, 'r') as fin:
             configs = yaml.load(fin, Loader=yaml.FullLoader)
     return configs
+
+
+def convert_checkpoint(model_pth: str, output_path: str = None) -> str:
+    """
+    One-time conversion of a ``.pth`` checkpoint to ``.safetensors`` (weights only),
+    which `load_checkpoint` then picks up automatically.
+    """
+    from safetensors.torch import save_file
+    output_path = output_path or checkpoint_safetensors_path(model_pth)
+    checkpoint = unwrap_state_dict(torch.load(model_pth, map_location='cpu'))
+    # safetensors refuses tensors sharing storage
+    tensors = {k: v.detach().clone().contiguous() for k, v in checkpoint.items() if isinstance(v, torch.Tensor)}
+    tmp_path = output_path + '.tmp'
+    save_file(tensors, tmp_path, metadata={'format': 'pt', 'source': os.path.basename(model_pth)})
+    # safetensors creates the file as 0600
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, output_path)
+    return output_path
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Dict, Iterable, List, Optional
+
+import torch
+from omegaconf import OmegaConf
+
+BUNDLE_MANIFEST = "manifest.json"
+BUNDLE_FORMAT = "indextts-bundle"
+BUNDLE_VERSION = 1
+
+BUNDLE_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+# UnifiedVoice modules only used by training (text token prediction)
+GPT_TRAINING_ONLY_MODULES = ("text_head",)
+
+
+def sha256_file(path: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def strip_gpt_for_inference(gpt: torch.nn.Module):
+    """Drop the training-only modules of `UnifiedVoice`, so that it loads a bundle checkpoint strictly."""
+    for name in GPT_TRAINING_ONLY_MODULES:
+        setattr(gpt, name, None)
+    return gpt
+
+
+def load_bundle_manifest(model_dir: str) -> Optional[dict]:
+    """Returns the manifest if ``model_dir`` is an inference bundle made by `export_inference_bundle()`, else None."""
+    manifest_path = os.path.join(model_dir, BUNDLE_MANIFEST)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != BUNDLE_FORMAT:
+        raise ValueError(f"{manifest_path} is not an IndexTTS inference bundle manifest.")
+    if manifest.get("version", 0) > BUNDLE_VERSION:
+        raise ValueError(f"{manifest_path}: unsupported bundle version {manifest.get('version')}, "
+                         f"this IndexTTS supports up to {BUNDLE_VERSION}.")
+    return manifest
+
+
+def bundle_checkpoint(manifest: dict, model_dir: str, component: str, dtype: str = "float32"):
+    """
+    Path of the ``component`` ("gpt" or "bigvgan") checkpoint in the bundle and its dtype name,
+    falls back to the float32 variant if ``dtype`` was not exported.
+    """
+    variants = manifest["files"][component]
+    if dtype not in variants:
+        dtype = "float32"
+    entry = variants[dtype]
+    path = os.path.join(model_dir, entry["path"])
+    if os.path.getsize(path) != entry["size"]:
+        raise ValueError(f"{path} size mismatch with {BUNDLE_MANIFEST}, the bundle is incomplete or corrupted.")
+    return path, dtype
+
+
+def verify_bundle(model_dir: str) -> List[str]:
+    """Check the sha256 of every file listed in the manifest, returns the mismatched paths."""
+    manifest = load_bundle_manifest(model_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"{os.path.join(model_dir, BUNDLE_MANIFEST)} not found")
+    entries = [manifest["config"], manifest["bpe_model"]]
+    for variants in manifest["files"].values():
+        entries.extend(variants.values())
+    mismatched = []
+    for entry in entries:
+        path = os.path.join(model_dir, entry["path"])
+        if not os.path.isfile(path) or sha256_file(path) != entry["sha256"]:
+            mismatched.append(path)
+    return mismatched
+
+
+def _file_entry(output_dir: str, filename: str, **extra) -> Dict:
+    path = os.path.join(output_dir, filename)
+    entry = {"path": filename, "size": os.path.getsize(path), "sha256": sha256_file(path)}
+    entry.update(extra)
+    return entry
+
+
+def export_inference_bundle(cfg_path: str, model_dir: str, output_dir: str,
+                            dtypes: Iterable[str] = ("float32", "float16")) -> dict:
+    """
+    Export an inference-only bundle to ``output_dir``:
+        - GPT without the training-only text head, one safetensors file per dtype in ``dtypes``
+        - BigVGAN with weight norm folded, float32 (it runs under autocast with float32 weights)
+        - config.yaml, the bpe model, and manifest.json with the file hashes
+    `IndexTTS(model_dir=output_dir, cfg_path=output_dir + "/config.yaml")` loads it directly.
+    """
+    from safetensors.torch import save_file
+
+    from indextts.BigVGAN.models import BigVGAN
+    from indextts.gpt.model import UnifiedVoice
+    from indextts.utils.checkpoint import load_checkpoint
+
+    dtypes = list(dict.fromkeys(["float32", *dtypes]))
+    for dtype in dtypes:
+        if dtype not in BUNDLE_DTYPES:
+            raise ValueError(f"Unsupported dtype {dtype!r}, expected one of {list(BUNDLE_DTYPES)}")
+    cfg = OmegaConf.load(cfg_path)
+    os.makedirs(output_dir, exist_ok=True)
+
+    def save_state_dict(module: torch.nn.Module, filename: str, dtype: torch.dtype):
+        # clone: safetensors refuses tensors sharing storage
+        tensors = {k: v.detach().to(dtype if v.is_floating_point() else v.dtype).clone().contiguous()
+                   for k, v in module.state_dict().items()}
+        save_file(tensors, os.path.join(output_dir, filename), metadata={"format": "pt"})
+        # safetensors creates the file as 0600
+        os.chmod(os.path.join(output_dir, filename), 0o644)
+
+    gpt_files = {}
+    gpt = UnifiedVoice(**cfg.gpt)
+    load_checkpoint(gpt, os.path.join(model_dir, cfg.gpt_checkpoint))
+    strip_gpt_for_inference(gpt)
+    for dtype in dtypes:
+        filename = "gpt.safetensors" if dtype == "float32" else f"gpt.{dtype}.safetensors"
+        save_state_dict(gpt, filename, BUNDLE_DTYPES[dtype])
+        gpt_files[dtype] = _file_entry(output_dir, filename)
+        print(f">> exported GPT ({dtype}):", os.path.join(output_dir, filename))
+    del gpt
+
+    bigvgan = BigVGAN(cfg.bigvgan)
+    load_checkpoint(bigvgan, os.path.join(model_dir, cfg.bigvgan_checkpoint))
+    bigvgan.remove_weight_norm()
+    save_state_dict(bigvgan, "bigvgan_generator.safetensors", torch.float32)
+    bigvgan_files = {"float32": _file_entry(output_dir, "bigvgan_generator.safetensors")}
+    print(">> exported BigVGAN:", os.path.join(output_dir, "bigvgan_generator.safetensors"))
+    del bigvgan
+
+    bpe_model = cfg.dataset["bpe_model"]
+    os.makedirs(os.path.dirname(os.path.join(output_dir, bpe_model)), exist_ok=True)
+    shutil.copyfile(os.path.join(model_dir, bpe_model), os.path.join(output_dir, bpe_model))
+    cfg.gpt_checkpoint = gpt_files["float32"]["path"]
+    cfg.bigvgan_checkpoint = bigvgan_files["float32"]["path"]
+    OmegaConf.save(cfg, os.path.join(output_dir, "config.yaml"))
+
+    manifest = {
+        "format": BUNDLE_FORMAT,
+        "version": BUNDLE_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "model_version": cfg.get("version", None),
+        "stripped_modules": {"gpt": list(GPT_TRAINING_ONLY_MODULES)},
+        "weight_norm_folded": True,
+        "config": _file_entry(output_dir, "config.yaml", content=OmegaConf.to_container(cfg)),
+        "bpe_model": _file_entry(output_dir, bpe_model),
+        "files": {"gpt": gpt_files, "bigvgan": bigvgan_files},
+    }
+    with open(os.path.join(output_dir, BUNDLE_MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    print(">> bundle manifest saved to:", os.path.join(output_dir, BUNDLE_MANIFEST))
+    return manifest
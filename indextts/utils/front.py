@@ -1,17 +1,42 @@
 # -*- coding: utf-8 -*-
+import json
 import os
+import sys
 import traceback
 import re
-from typing import List, Union, overload
+from typing import Dict, List, Optional, Tuple, Union, overload
 import warnings
 from indextts.utils.common import tokenize_by_CJK_char, de_tokenized_by_CJK_char
+from indextts.utils.lru_cache import LRUCache
 from sentencepiece import SentencePieceProcessor
 
 
+# 共享的（只读）WeTextProcessing FST 缓存目录, 用 `indextts build-normalizer-cache` 预先构建
+TN_CACHE_DIR_ENV = "INDEXTTS_TN_CACHE_DIR"
+# marker file written by `TextNormalizer.build_cache()`, records the options the FSTs were built with
+TN_CACHE_INFO_FILE = "indextts_tn_cache.json"
+# disable remove_interjections and remove_erhua of the zh tagger rules
+ZH_NORMALIZER_OPTIONS = {"remove_interjections": False, "remove_erhua": False}
+
+
 class TextNormalizer:
-    def __init__(self):
+    def __init__(self, cache_dir=None, build_if_missing=None, fast_path=True):
+        """
+        Args:
+            cache_dir (str): WeTextProcessing FST cache directory, default is ``$INDEXTTS_TN_CACHE_DIR``,
+                or ``indextts/utils/tagger_cache`` inside the package if the variable is not set.
+            build_if_missing (None | bool): build the FSTs into ``cache_dir`` if they are missing,
+                default is ``True`` only for the package cache dir. A configured cache dir must be prebuilt
+                by `indextts build-normalizer-cache`, otherwise `load()` fails fast instead of rebuilding.
+            fast_path (bool): skip the FSTs for text they would not rewrite, see `fast_normalize()`.
+        """
         self.zh_normalizer = None
         self.en_normalizer = None
+        if cache_dir is None:
+            cache_dir = os.environ.get(TN_CACHE_DIR_ENV) or None
+        self.is_default_cache_dir = cache_dir is None
+        self.cache_dir = cache_dir if cache_dir is not None else self.default_cache_dir()
+        self.build_if_missing = self.is_default_cache_dir if build_if_missing is None else build_if_missing
         self.char_rep_map = {
             "：": ",",
             "；": ",",
@@ -53,6 +78,11 @@ class TextNormalizer:
             "$": ".",
             **self.char_rep_map,
         }
+        self.char_rep_pattern = re.compile("|".join(re.escape(p) for p in self.char_rep_map.keys()))
+        self.zh_char_rep_pattern = re.compile("|".join(re.escape(p) for p in self.zh_char_rep_map.keys()))
+        self.fast_path = fast_path
+        # fast path 的字符表, 由 `load()` 从 WeTextProcessing 的规则数据中读取
+        self._fast_path_data = None
 
     def match_email(self, email):
         # 正则表达式匹配邮箱格式：数字英文@数字英文.英文
@@ -75,6 +105,14 @@ class TextNormalizer:
     ENGLISH_CONTRACTION_PATTERN = r"(what|where|who|which|how|t?here|it|s?he|that|this)'s"
 
 
+    # 快速路径允许的字符: 不含数字, 数学运算符, 货币符号等会被 FST 改写的字符
+    ZH_FAST_PATH_PATTERN = re.compile(
+        r"^[\u4e00-\u9fffa-zA-Z \t\n,.!?;:'\"()\[\]{}…·—–~、。，！？：；“”‘’《》「」『』【】（）〈〉～\u3000]*$"
+    )
+    # 英文单词, 单个空格分隔, 词尾可带一个标点
+    EN_FAST_PATH_PATTERN = re.compile(r"^[a-zA-Z]+(?:['-][a-zA-Z]+)*[,.!?;:]?(?: [a-zA-Z]+(?:['-][a-zA-Z]+)*[,.!?;:]?)*$")
+    EN_FAST_PATH_WORD_PATTERN = re.compile(r"[a-zA-Z]+(?:['-][a-zA-Z]+)*([,.!?;:]?)")
+
     def use_chinese(self, s):
         has_chinese = bool(re.search(r"[\u4e00-\u9fff]", s))
         has_alpha = bool(re.search(r"[a-zA-Z]", s))
@@ -85,6 +123,36 @@ class TextNormalizer:
         has_pinyin = bool(re.search(TextNormalizer.PINYIN_TONE_PATTERN, s, re.IGNORECASE))
         return has_pinyin
 
+    @staticmethod
+    def default_cache_dir():
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), "tagger_cache")
+
+    def cache_files(self) -> List[str]:
+        files = [os.path.join(self.cache_dir, f"zh_tn_{name}.fst") for name in ("tagger", "verbalizer")]
+        if not self.is_default_cache_dir:
+            # the package cache dir only holds the zh FSTs, the en FSTs are shipped with WeTextProcessing
+            files += [os.path.join(self.cache_dir, f"en_tn_{name}.fst") for name in ("tagger", "verbalizer")]
+        return files
+
+    def check_cache(self):
+        """
+        Raises if the FST cache is missing or was built with other options.
+        """
+        missing = [f for f in self.cache_files() if not os.path.isfile(f)]
+        if missing:
+            raise FileNotFoundError(
+                f"Text normalizer FST cache is missing: {', '.join(missing)}. "
+                f"Prebuild it with `indextts build-normalizer-cache --cache_dir {self.cache_dir}`."
+            )
+        info_path = os.path.join(self.cache_dir, TN_CACHE_INFO_FILE)
+        if os.path.isfile(info_path):
+            with open(info_path, "r", encoding="utf-8") as f:
+                info = json.load(f)
+            if info.get("zh_options") != ZH_NORMALIZER_OPTIONS:
+                raise ValueError(f"Text normalizer FST cache {self.cache_dir} was built with other options: "
+                                 f"{info.get('zh_options')}, expected {ZH_NORMALIZER_OPTIONS}. Rebuild it with "
+                                 f"`indextts build-normalizer-cache --cache_dir {self.cache_dir} --force`.")
+
     def load(self):
         # print(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
         # sys.path.append(model_dir)
@@ -99,23 +167,133 @@ class TextNormalizer:
         else:
             from tn.chinese.normalizer import Normalizer as NormalizerZh
             from tn.english.normalizer import Normalizer as NormalizerEn
-            # use new cache dir for build tagger rules with disable remove_interjections and remove_erhua
-            cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tagger_cache")
-            if not os.path.exists(cache_dir):
-                os.makedirs(cache_dir)
-                with open(os.path.join(cache_dir, ".gitignore"), "w") as f:
-                    f.write("*\n")
-            self.zh_normalizer = NormalizerZh(
-                cache_dir=cache_dir, remove_interjections=False, remove_erhua=False, overwrite_cache=False
-            )
+            if self.build_if_missing:
+                if self.is_default_cache_dir and not os.path.exists(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                    with open(os.path.join(self.cache_dir, ".gitignore"), "w") as f:
+                        f.write("*\n")
+            else:
+                self.check_cache()
+            self.zh_normalizer = NormalizerZh(cache_dir=self.cache_dir, overwrite_cache=False, **ZH_NORMALIZER_OPTIONS)
+            self.en_normalizer = NormalizerEn(cache_dir=None if self.is_default_cache_dir else self.cache_dir,
+                                              overwrite_cache=False)
+            self._fast_path_data = self._load_fast_path_data()
+
+    @staticmethod
+    def _load_fast_path_data():
+        """
+        读取 WeTextProcessing 规则数据中, 不含数字也会被 FST 改写的字符和词
+        """
+        from tn.utils import get_abs_path
+
+        def read_tsv(path):
+            with open(get_abs_path(path), "r", encoding="utf-8") as f:
+                return [line.rstrip("\n").split("\t") for line in f if line.strip()]
+
+        # 繁体转简体
+        zh_unsafe_chars = {row[0] for row in read_tsv("chinese/data/char/traditional_to_simple.tsv") if row[0] != row[1]}
+        # 例如 M.V.P -> M V P, 其余条目都含有数字
+        zh_whitelist = [row[0] for row in read_tsv("chinese/data/default/whitelist.tsv")
+                        + read_tsv("chinese/data/erhua/whitelist.tsv")
+                        if TextNormalizer.ZH_FAST_PATH_PATTERN.match(row[0])]
+        full_to_half = str.maketrans({row[0]: row[1] for row in read_tsv("chinese/data/char/fullwidth_to_halfwidth.tsv")})
+        # 英文 whitelist 的词 (Mr -> Mister, ", CA" -> ", California" ...), 多词条目只需要第一个词 (World War II -> World War two)
+        en_whitelist_words = set()
+        en_phrase_first_words = set()
+        for path in ("english/data/whitelist/tts.tsv", "english/data/whitelist/symbol.tsv",
+                     "english/data/whitelist/alternatives.tsv"):
+            for row in read_tsv(path):
+                words = row[0].split()
+                if len(words) > 1:
+                    en_phrase_first_words.add(words[0])
+                else:
+                    en_whitelist_words.add(words[0].rstrip(".,"))
+        for row in read_tsv("english/data/address/state.tsv"):
+            en_whitelist_words.update(word.rstrip(".,") for word in " ".join(row).split())
+        return {
+            "zh_unsafe_chars": zh_unsafe_chars,
+            "zh_whitelist": zh_whitelist,
+            "full_to_half": full_to_half,
+            "en_whitelist_words": en_whitelist_words,
+            "en_phrase_first_words": en_phrase_first_words,
+        }
+
+    def build_cache(self, overwrite=False):
+        """
+        Build the FSTs into ``cache_dir``, so that workers can load them from a shared read-only directory.
+        """
+        from importlib.metadata import version
+        from importlib.resources import files
+        import shutil
+        from tn.chinese.normalizer import Normalizer as NormalizerZh
+        from tn.english.normalizer import Normalizer as NormalizerEn
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.zh_normalizer = NormalizerZh(cache_dir=self.cache_dir, overwrite_cache=overwrite, **ZH_NORMALIZER_OPTIONS)
+        if self.is_default_cache_dir:
             self.en_normalizer = NormalizerEn(overwrite_cache=False)
+        else:
+            # the en FSTs use the default options, reuse the ones shipped with WeTextProcessing if present
+            for name in ("en_tn_tagger.fst", "en_tn_verbalizer.fst"):
+                src, dst = str(files("tn") / name), os.path.join(self.cache_dir, name)
+                if os.path.isfile(src) and (overwrite or not os.path.isfile(dst)):
+                    shutil.copyfile(src, dst)
+            self.en_normalizer = NormalizerEn(cache_dir=self.cache_dir, overwrite_cache=False)
+        try:
+            tn_version = version("WeTextProcessing")
+        except Exception:
+            tn_version = None
+        with open(os.path.join(self.cache_dir, TN_CACHE_INFO_FILE), "w", encoding="utf-8") as f:
+            json.dump({"wetext_processing": tn_version, "zh_options": ZH_NORMALIZER_OPTIONS}, f, indent=2)
+
+    def fast_normalize_zh(self, text: str):
+        """
+        不需要 FST 的中文文本 (没有数字, 符号, 繁体字, whitelist 词), 直接做全角转半角和字符替换,
+        结果与 FST 完全一致. 返回 None 表示需要走 FST.
+        """
+        data = self._fast_path_data
+        if not TextNormalizer.ZH_FAST_PATH_PATTERN.match(text):
+            return None
+        if any(c in data["zh_unsafe_chars"] for c in text) or any(w in text for w in data["zh_whitelist"]):
+            return None
+        result = text.translate(data["full_to_half"])
+        return self.zh_char_rep_pattern.sub(lambda x: self.zh_char_rep_map[x.group()], result)
+
+    def fast_normalize_en(self, text: str):
+        """
+        只有普通英文单词和句末标点的文本, FST 不做改写, 直接做字符替换. 返回 None 表示需要走 FST.
+        """
+        if not TextNormalizer.EN_FAST_PATH_PATTERN.match(text) or "per " in text:
+            # "per ft" -> "- per foot"
+            return None
+        words = self._fast_path_data["en_whitelist_words"]
+        first_words = self._fast_path_data["en_phrase_first_words"]
+        for m in TextNormalizer.EN_FAST_PATH_WORD_PATTERN.finditer(text):
+            word, punct = m.group(0)[: m.start(1) - m.start(0)], m.group(1)
+            if word in words:
+                return None
+            # FST 也会匹配词的后缀, 例如 "aCo." -> "a company", "xWorld War II" -> "x World War two"
+            if any(word[i:] in first_words or word[i:] + punct in first_words for i in range(len(word))):
+                return None
+            if punct:
+                if any(word[i:] in words for i in range(1, len(word))):
+                    return None
+                if punct == "." and word[-1].isupper():
+                    # U. S. A. -> USA
+                    return None
+        return self.char_rep_pattern.sub(lambda x: self.char_rep_map[x.group()], text)
 
     def normalize(self, text: str) -> str:
         if not self.zh_normalizer or not self.en_normalizer:
             print("Error, text normalizer is not initialized !!!")
             return ""
+        use_fast_path = self.fast_path and self._fast_path_data is not None
         if self.use_chinese(text):
             text = re.sub(TextNormalizer.ENGLISH_CONTRACTION_PATTERN, r"\1 is", text, flags=re.IGNORECASE)
+            if use_fast_path:
+                result = self.fast_normalize_zh(text.rstrip())
+                if result is not None:
+                    return result
             replaced_text, pinyin_list = self.save_pinyin_tones(text.rstrip())
             
             replaced_text, original_name_list = self.save_names(replaced_text)
@@ -128,17 +306,19 @@ class TextNormalizer:
             result = self.restore_names(result, original_name_list)
             # 恢复拼音声调
             result = self.restore_pinyin_tones(result, pinyin_list)
-            pattern = re.compile("|".join(re.escape(p) for p in self.zh_char_rep_map.keys()))
-            result = pattern.sub(lambda x: self.zh_char_rep_map[x.group()], result)
+            result = self.zh_char_rep_pattern.sub(lambda x: self.zh_char_rep_map[x.group()], result)
         else:
+            text = re.sub(TextNormalizer.ENGLISH_CONTRACTION_PATTERN, r"\1 is", text, flags=re.IGNORECASE)
+            if use_fast_path:
+                result = self.fast_normalize_en(text)
+                if result is not None:
+                    return result
             try:
-                text = re.sub(TextNormalizer.ENGLISH_CONTRACTION_PATTERN, r"\1 is", text, flags=re.IGNORECASE)
                 result = self.en_normalizer.normalize(text)
             except Exception:
                 result = text
                 print(traceback.format_exc())
-            pattern = re.compile("|".join(re.escape(p) for p in self.char_rep_map.keys()))
-            result = pattern.sub(lambda x: self.char_rep_map[x.group()], result)
+            result = self.char_rep_pattern.sub(lambda x: self.char_rep_map[x.group()], result)
         return result
 
     def correct_pinyin(self, pinyin: str):
@@ -228,10 +408,45 @@ class TextNormalizer:
         return transformed_text
 
 
+class TextTokenCache(LRUCache):
+    """
+    LRU cache of `TextTokenizer.encode()` results (normalize + `tokenize_by_CJK_char` + SentencePiece),
+    keyed by the input text and the output type.
+    Args:
+        max_entries: max number of cached texts, ``0`` disables the cache.
+        max_bytes: max total (approximate) memory of the cached texts and tokens, ``None`` for no limit.
+    """
+
+    def __init__(self, max_entries: int = 4096, max_bytes: Optional[int] = 32 << 20):
+        super().__init__(max_entries, max_bytes)
+
+    @staticmethod
+    def entry_nbytes(text: str, tokens: tuple) -> int:
+        return sys.getsizeof(text) + sys.getsizeof(tokens) + sum(sys.getsizeof(t) for t in tokens)
+
+    def get(self, key: Tuple[str, type]) -> Optional[list]:
+        tokens = super().get(key)
+        # 返回副本, 调用方可以修改
+        return None if tokens is None else list(tokens)
+
+    def put(self, key: Tuple[str, type], tokens: list):
+        tokens = tuple(tokens)
+        super().put(key, tokens, self.entry_nbytes(key[0], tokens))
+
+
 class TextTokenizer:
-    def __init__(self, vocab_file: str, normalizer: TextNormalizer = None):
+    def __init__(self, vocab_file: str, normalizer: TextNormalizer = None,
+                 cache_size: int = 4096, cache_max_bytes: Optional[int] = 32 << 20):
+        """
+        Args:
+            vocab_file (str): sentencepiece bpe model.
+            normalizer (TextNormalizer): text normalizer applied before tokenization.
+            cache_size (int): max number of texts whose `encode()` result is cached, 0 to disable.
+            cache_max_bytes (None | int): max total bytes of the cached texts and tokens, None for no limit.
+        """
         self.vocab_file = vocab_file
         self.normalizer = normalizer
+        self.cache = TextTokenCache(max_entries=cache_size, max_bytes=cache_max_bytes)
 
         if self.vocab_file is None:
             raise ValueError("vocab_file is None")
@@ -316,15 +531,25 @@ class TextTokenizer:
     def encode(self, text: str, **kwargs):
         if len(text) == 0:
             return []
+        out_type = kwargs.pop("out_type", int)
         if len(text.strip()) == 1:
-            return self.sp_model.Encode(text, out_type=kwargs.pop("out_type", int), **kwargs)
+            return self.sp_model.Encode(text, out_type=out_type, **kwargs)
+        # 其他 sentencepiece 参数 (如 enable_sampling) 的结果不缓存
+        cache_key = (text, out_type) if not kwargs else None
+        if cache_key is not None:
+            tokens = self.cache.get(cache_key)
+            if tokens is not None:
+                return tokens
         # 预处理
         if self.normalizer:
             text = self.normalizer.normalize(text)
         if len(self.pre_tokenizers) > 0:
             for pre_tokenizer in self.pre_tokenizers:
                 text = pre_tokenizer(text)
-        return self.sp_model.Encode(text, out_type=kwargs.pop("out_type", int), **kwargs)
+        tokens = self.sp_model.Encode(text, out_type=out_type, **kwargs)
+        if cache_key is not None:
+            self.cache.put(cache_key, tokens)
+        return tokens
 
     def batch_encode(self, texts: List[str], **kwargs):
         # 预处理
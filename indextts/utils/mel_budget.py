@@ -0,0 +1,126 @@
+import json
+import math
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+from transformers import LogitsProcessor
+
+from indextts.utils.runaway_guard import force_stop_token
+
+MEL_BUDGET_FILE = "mel_budget.json"
+
+# 每个文本 token 的 mel token 上界 (slope) 与常数项 (intercept), 未拟合时使用
+# 约 23 个 mel token 每秒, 按最慢的语速留出余量
+DEFAULT_COEFFICIENTS = {
+    "zh": (12.0, 40.0),
+    "en": (12.0, 40.0),
+}
+
+_CJK_PATTERN = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+
+
+class MelBudgetEstimator:
+    """
+    Upper bound of the mel tokens of a sentence from its text token count and language,
+    ``ceil(slope * text_tokens + intercept)``, capped by ``max_mel_tokens``.
+    The coefficients are fitted from the code lengths of the generated sentences, see `observe()` and `fit()`,
+    and stored with the model as ``mel_budget.json``.
+    """
+
+    def __init__(self, coefficients: Optional[Dict[str, Tuple[float, float]]] = None,
+                 observations: Optional[List[Tuple[str, int, int, bool]]] = None, max_observations=10000):
+        self.coefficients = {**DEFAULT_COEFFICIENTS, **{k: tuple(v) for k, v in (coefficients or {}).items()}}
+        # (language, text tokens, mel tokens, budget hit), the files without the hit flag only had natural stops
+        self.observations = [(*o, False) if len(o) == 3 else tuple(o) for o in (observations or [])][-max_observations:]
+        self.max_observations = max_observations
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def language(tokens: Sequence[str]) -> str:
+        """"zh" if at least half of the text tokens are CJK, else "en"."""
+        cjk = sum(1 for token in tokens if _CJK_PATTERN.search(token))
+        return "zh" if cjk * 2 >= len(tokens) and cjk > 0 else "en"
+
+    def estimate(self, tokens: Sequence[str], max_mel_tokens: int) -> int:
+        slope, intercept = self.coefficients[self.language(tokens)]
+        return max(1, min(max_mel_tokens, math.ceil(slope * len(tokens) + intercept)))
+
+    def observe(self, tokens: Sequence[str], num_codes: int, hit=False):
+        """
+        Record the code length (without the stop token) of a generated sentence.
+        ``hit``: the sentence was cut at its budget, its real length is only known to be at least ``num_codes``.
+        """
+        with self._lock:
+            self.observations.append((self.language(tokens), len(tokens), int(num_codes), bool(hit)))
+            del self.observations[:-self.max_observations]
+
+    def fit(self, quantile=0.99, margin=1.25, min_observations=20) -> Dict[str, Tuple[float, float]]:
+        """
+        Refit the slope of every language with at least ``min_observations`` sentences:
+        ``margin`` times the ``quantile`` of the mel tokens per text token after the intercept.
+        The sentences cut at their budget count as their budget (censored, the real length is longer).
+        While more than ``1 - quantile`` of the sentences are cut the quantile is only a lower bound,
+        so the slope is not lowered.
+        Returns the coefficients.
+        """
+        with self._lock:
+            observations = list(self.observations)
+        for lang, (old_slope, intercept) in list(self.coefficients.items()):
+            ratios, hits = [], 0
+            for obs_lang, n, codes, hit in observations:
+                if obs_lang == lang and n > 0:
+                    ratios.append((codes - intercept) / n)
+                    hits += hit
+            if len(ratios) < min_observations:
+                continue
+            slope = torch.quantile(torch.tensor(ratios, dtype=torch.float64), quantile).item() * margin
+            if hits > (1 - quantile) * len(ratios):
+                slope = max(slope, old_slope)
+            self.coefficients[lang] = (max(slope, 1.0), intercept)
+        return dict(self.coefficients)
+
+    @classmethod
+    def load(cls, path: str) -> "MelBudgetEstimator":
+        """Load ``path``, or the default coefficients if it does not exist."""
+        if not os.path.isfile(path):
+            return cls()
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data.get("coefficients"), data.get("observations"))
+
+    def save(self, path: str):
+        with self._lock:
+            data = {"coefficients": self.coefficients, "observations": self.observations}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+
+class MelTokenLimit(LogitsProcessor):
+    """
+    Per-row ``max_generate_length``: force the stop token after the ``limits[i]`` generated tokens of row ``i``
+    (and after it, for the beams that continue), so that every row gets ``limits[i]`` codes.
+    The rows whose limit is the length of the whole batch are ended by ``max_length`` as usual, without a stop token.
+    The limits are per batch item, repeated for `num_return_sequences` / beams,
+    `GPT2DecodeEngine.generate()` drops them with the finished rows through `select_rows()`.
+    """
+
+    def __init__(self, stop_token: int, prompt_length: int, limits: torch.Tensor):
+        self.stop_token = stop_token
+        self.prompt_length = prompt_length
+        self.max_limit = int(limits.max())
+        self.limits = limits
+
+    def select_rows(self, index: torch.Tensor):
+        self.limits = self.limits[index]
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.limits.shape[0] != input_ids.shape[0]:
+            self.limits = self.limits.to(input_ids.device).repeat_interleave(input_ids.shape[0] // self.limits.shape[0])
+        generated = input_ids.shape[1] - self.prompt_length
+        stop = (self.limits <= generated) & (self.limits < self.max_limit)
+        return force_stop_token(scores, stop, self.stop_token)
@@ -0,0 +1,88 @@
+import torch
+from transformers import LogitsProcessor
+
+
+def force_stop_token(scores: torch.Tensor, rows: torch.Tensor, stop_token: int, margin=50.0) -> torch.Tensor:
+    """
+    Make ``stop_token`` the next token of the ``rows`` (rows,) bool: its score is raised ``margin`` above the best one.
+    The other tokens are not masked out, so beam sampling (``min_tokens_to_keep=2``) still finds 2 * num_beams
+    candidates when all the beams of an item are stopped.
+    """
+    stop_scores = torch.where(rows, scores.max(dim=-1).values + margin, scores[:, stop_token])
+    scores = scores.clone()
+    scores[:, stop_token] = stop_scores
+    return scores
+
+
+class RunawayGuard(LogitsProcessor):
+    """
+    Stop the rows whose mel tokens ran away, instead of generating up to ``max_length``:
+        - a run of ``max_silent_tokens`` silent tokens
+        - a loop: the last ``min_loop_length`` tokens repeat with a period of at most ``max_loop_period``
+    The stop token is forced for these rows (``force_stop``), or they are only counted.
+    Works as a logits processor of transformers `generate()` and of `GPT2DecodeEngine.generate()`,
+    the detection looks at the generated tokens only and keeps no state per row, so it follows beam reordering
+    and the dropped rows. `stats` counts the stops and the generation budget they saved.
+    Args:
+        stop_token: `stop_mel_token`, also the pad token of the finished rows
+        prompt_length: length of the input ids before the first generated token
+        max_length: max length of the input ids, for counting the saved tokens
+    """
+
+    def __init__(self, stop_token: int, prompt_length: int, max_length: int, silent_token=52, max_silent_tokens=60,
+                 max_loop_period=8, min_loop_length=60, force_stop=True):
+        if not 0 < max_loop_period < min_loop_length:
+            raise ValueError(f"`max_loop_period` has to be in [1, min_loop_length), but is {max_loop_period}")
+        self.stop_token = stop_token
+        self.prompt_length = prompt_length
+        self.max_length = max_length
+        self.silent_token = silent_token
+        self.max_silent_tokens = max_silent_tokens
+        self.max_loop_period = max_loop_period
+        self.min_loop_length = min_loop_length
+        self.force_stop = force_stop
+        # device counters, read by `stats` without a sync every step
+        self._silence_stops = 0
+        self._loop_stops = 0
+        self._tokens_saved = 0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "silence_stops": int(self._silence_stops),
+            "loop_stops": int(self._loop_stops),
+            "tokens_saved": int(self._tokens_saved),
+        }
+
+    def _is_loop(self, window: torch.Tensor) -> torch.Tensor:
+        loop = torch.zeros(window.shape[0], dtype=torch.bool, device=window.device)
+        for period in range(1, self.max_loop_period + 1):
+            loop |= (window[:, period:] == window[:, :-period]).all(dim=-1)
+        # silence is counted by its own run length
+        return loop & ~(window == self.silent_token).all(dim=-1)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        generated = input_ids[:, self.prompt_length:]
+        length = generated.shape[1]
+        if length < min(self.max_silent_tokens, self.min_loop_length + 1):
+            return scores
+        # the rows are stopped (or counted) once, when the run or the loop reaches its length
+        silence = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if length >= self.max_silent_tokens:
+            silence = (generated[:, -self.max_silent_tokens:] == self.silent_token).all(dim=-1)
+            if length > self.max_silent_tokens:
+                silence &= generated[:, -self.max_silent_tokens - 1] != self.silent_token
+        loop = torch.zeros_like(silence)
+        if length > self.min_loop_length:
+            loop = self._is_loop(generated[:, -self.min_loop_length:]) \
+                & ~self._is_loop(generated[:, -self.min_loop_length - 1:-1])
+        running = generated[:, -1] != self.stop_token
+        silence &= running
+        loop &= running & ~silence
+        stopped = silence | loop
+        self._silence_stops += silence.sum()
+        self._loop_stops += loop.sum()
+        self._tokens_saved += stopped.sum() * (self.max_length - input_ids.shape[1] - 1)
+        if not self.force_stop:
+            return scores
+        return force_stop_token(scores, stopped, self.stop_token)
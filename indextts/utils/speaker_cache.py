@@ -0,0 +1,80 @@
+import hashlib
+from typing import Dict, Optional
+
+import torch
+
+from indextts.utils.lru_cache import LRUCache
+
+
+def hash_audio_file(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    sha256 of the audio file bytes, so the same voice is found again even if it is uploaded
+    under a different path (e.g. gradio temp files), and a file replaced in place is not.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class SpeakerConditioning:
+    """
+    Everything derived from a reference audio that does not depend on the text:
+        cond_mel: (1, n_mels, frames) conditioning mel spectrogram
+        conds_latent: (1, 32, dim) `UnifiedVoice.get_conditioning()` output
+        speaker_embedding: (1, 1, speaker_embedding_dim) `BigVGAN.get_speaker_embedding()` output
+        gpt_prefix: `UnifiedVoice.get_conditioning_prefix()` GPT keys/values of conds_latent, computed on first use,
+            kept in memory only (it depends on the GPT weights and dtype)
+        vocoder_biases: `BigVGAN.get_conditioning_biases()` of speaker_embedding, computed on first use,
+            kept in memory only (it depends on the BigVGAN weights and dtype)
+    """
+
+    def __init__(self, cond_mel: torch.Tensor, conds_latent: torch.Tensor, speaker_embedding: torch.Tensor, key: Optional[str] = None):
+        self.cond_mel = cond_mel
+        self.conds_latent = conds_latent
+        self.speaker_embedding = speaker_embedding
+        self.key = key
+        self.gpt_prefix = None
+        self.vocoder_biases = None
+
+    @property
+    def cond_mel_frames(self) -> int:
+        return self.cond_mel.shape[-1]
+
+    def tensors(self) -> Dict[str, torch.Tensor]:
+        return {
+            "cond_mel": self.cond_mel,
+            "conds_latent": self.conds_latent,
+            "speaker_embedding": self.speaker_embedding,
+        }
+
+    @property
+    def nbytes(self) -> int:
+        nbytes = sum(t.numel() * t.element_size() for t in self.tensors().values())
+        if self.gpt_prefix is not None:
+            nbytes += self.gpt_prefix.nbytes
+        if self.vocoder_biases is not None:
+            nbytes += sum(t.numel() * t.element_size() for t in self.vocoder_biases)
+        return nbytes
+
+
+class SpeakerCache(LRUCache):
+    """
+    LRU cache of `SpeakerConditioning`, keyed by `hash_audio_file()`.
+    Args:
+        max_entries: max number of cached voices, ``0`` disables the cache.
+        max_bytes: max total tensor bytes of the cached voices, ``None`` for no limit.
+    """
+
+    def __init__(self, max_entries: int = 64, max_bytes: Optional[int] = None):
+        super().__init__(max_entries, max_bytes)
+
+    def put(self, key: str, entry: SpeakerConditioning):
+        """
+        Add or replace ``key``, put the same entry again to account for the tensors added to it
+        (gpt_prefix, vocoder_biases): its bytes are counted when it is put, an entry grown over ``max_bytes``
+        is removed from the cache.
+        """
+        entry.key = key
+        super().put(key, entry, entry.nbytes)
@@ -0,0 +1,89 @@
+import os
+import re
+import tempfile
+from typing import Dict, List, Optional
+
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from indextts.utils.speaker_cache import SpeakerConditioning
+
+VOICE_FORMAT = "indextts-voice"
+VOICE_FORMAT_VERSION = 1
+VOICE_FILE_SUFFIX = ".safetensors"
+
+_VOICE_NAME_RE = re.compile(r"^[\w.\-]+$")
+
+
+class VoiceStore:
+    """
+    A directory of precomputed voice profiles, one safetensors file per voice:
+        <root>/<name>.safetensors
+    Each file holds the `SpeakerConditioning` tensors (cond_mel, conds_latent, speaker_embedding),
+    and its metadata records the format version and the model the profile was computed with.
+    Files are written atomically, so several workers can share one store.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    @staticmethod
+    def is_valid_name(name: str) -> bool:
+        return bool(name) and _VOICE_NAME_RE.match(name) is not None and name not in (".", "..")
+
+    def path(self, name: str) -> str:
+        if not self.is_valid_name(name):
+            raise ValueError(f"Invalid voice name: {name!r}, only letters, digits, '_', '-' and '.' are allowed.")
+        return os.path.join(self.root, name + VOICE_FILE_SUFFIX)
+
+    def exists(self, name: str) -> bool:
+        return self.is_valid_name(name) and os.path.isfile(self.path(name))
+
+    def list(self) -> List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(f[: -len(VOICE_FILE_SUFFIX)] for f in os.listdir(self.root) if f.endswith(VOICE_FILE_SUFFIX))
+
+    def save(self, name: str, speaker: SpeakerConditioning, metadata: Optional[Dict[str, str]] = None, overwrite=False) -> str:
+        path = self.path(name)
+        if os.path.exists(path) and not overwrite:
+            raise FileExistsError(f"Voice {name!r} already exists: {path}")
+        os.makedirs(self.root, exist_ok=True)
+        tensors = {k: v.detach().to("cpu").contiguous() for k, v in speaker.tensors().items()}
+        meta = {"format": VOICE_FORMAT, "version": str(VOICE_FORMAT_VERSION), "name": name}
+        if metadata:
+            meta.update({k: str(v) for k, v in metadata.items()})
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=self.root)
+        os.close(fd)
+        try:
+            save_file(tensors, tmp_path, metadata=meta)
+            # mkstemp creates the file as 0600, make it readable by the other workers
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+    def metadata(self, name: str) -> Dict[str, str]:
+        with safe_open(self.path(name), framework="pt") as f:
+            return f.metadata() or {}
+
+    def load(self, name: str, device="cpu") -> SpeakerConditioning:
+        """
+        Load a voice profile, the file is memory-mapped and the tensors are copied only once to ``device``.
+        """
+        path = self.path(name)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"Voice {name!r} not found in {self.root}")
+        with safe_open(path, framework="pt") as f:
+            meta = f.metadata() or {}
+            if meta.get("format") != VOICE_FORMAT:
+                raise ValueError(f"{path} is not an IndexTTS voice profile.")
+            version = int(meta.get("version", 0))
+            if version > VOICE_FORMAT_VERSION:
+                raise ValueError(f"{path}: unsupported voice profile version {version}, "
+                                 f"this IndexTTS supports up to {VOICE_FORMAT_VERSION}.")
+            tensors = {k: f.get_tensor(k).to(device) for k in f.keys()}
+        return SpeakerConditioning(tensors["cond_mel"], tensors["conds_latent"], tensors["speaker_embedding"],
+                                   key=f"voice:{name}")
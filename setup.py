@@ -21,6 +21,7 @@ setup(
         "transformers==4.36.2",
         "accelerate",
         "tokenizers==0.15.0",
+        "safetensors",
         "einops==0.8.1",
         "matplotlib==3.8.2",
         "omegaconf",
@@ -0,0 +1,51 @@
+import sys
+import time
+
+import torch
+from indextts.BigVGAN.batching import vocode_batch
+from indextts.BigVGAN.streaming import to_pcm16
+from indextts.infer import IndexTTS
+
+if __name__ == "__main__":
+    """
+    Check that `vocode_batch` gives every row the same int16 PCM as vocoding it alone,
+    for latents of different lengths and voices, and compare the time with the row by row decoding.
+    ```
+    python tests/batched_vocoder_test.py checkpoints
+    python tests/batched_vocoder_test.py checkpoints cuda:0
+    ```
+    """
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else "checkpoints"
+    device = sys.argv[2] if len(sys.argv) > 2 else "cpu"
+    tts = IndexTTS(cfg_path=f"{model_dir}/config.yaml", model_dir=model_dir, is_fp16=False, device=device)
+    speaker = tts.get_speaker_conditioning("tests/sample_prompt.wav")
+    generator = torch.Generator().manual_seed(0)
+    lengths = [7, 120, 33, 64, 90, 18]
+    latents = [torch.randn((1, n, tts.cfg.bigvgan.gpt_dim), generator=generator).to(device) for n in lengths]
+    # every other row with another voice
+    other = speaker.speaker_embedding + 0.1 * torch.randn(speaker.speaker_embedding.shape, generator=generator).to(device)
+    speaker_embeddings = [speaker.speaker_embedding if i % 2 == 0 else other for i in range(len(lengths))]
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        expected = [tts.bigvgan(latent, None, speaker_embedding=embedding)[0][0]
+                    for latent, embedding in zip(latents, speaker_embeddings)]
+    single_time = time.perf_counter() - start
+    failed = []
+    for max_batch_size in (1, 3, len(lengths)):
+        start = time.perf_counter()
+        wavs = vocode_batch(tts.bigvgan, latents, speaker_embeddings, max_batch_size=max_batch_size)
+        batch_time = time.perf_counter() - start
+        diffs = []
+        for wav, ref in zip(wavs, expected):
+            # float rounding of the convolutions can move a sample to the next int16 value
+            diffs.append((to_pcm16(wav).int() - to_pcm16(ref).int()).abs().max().item()
+                         if wav.shape == ref.shape else float("nan"))
+        ok = all(diff <= 1 for diff in diffs)
+        print(f"{'OK  ' if ok else 'FAIL'} max_batch_size {max_batch_size}: max int16 diff per row {diffs}, "
+              f"{batch_time:.3f}s / row by row {single_time:.3f}s")
+        if not ok:
+            failed.append(max_batch_size)
+    if failed:
+        print("batched vocoder mismatch:", failed)
+        sys.exit(1)
@@ -0,0 +1,47 @@
+import copy
+import sys
+import time
+
+import torch
+from indextts.BigVGAN.models import BigVGAN
+from indextts.infer import IndexTTS
+
+if __name__ == "__main__":
+    """
+    Check that `BigVGAN.freeze_for_inference()` and the cached conditioning biases give the same waveform as the
+    plain forward, and compare their time.
+    ```
+    python tests/bigvgan_freeze_test.py checkpoints
+    python tests/bigvgan_freeze_test.py checkpoints cuda:0
+    ```
+    """
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else "checkpoints"
+    device = sys.argv[2] if len(sys.argv) > 2 else "cpu"
+    tts = IndexTTS(cfg_path=f"{model_dir}/config.yaml", model_dir=model_dir, is_fp16=False, device=device)
+    frozen = tts.bigvgan  # frozen by IndexTTS
+    plain = BigVGAN(copy.deepcopy(tts.cfg.bigvgan), use_cuda_kernel=tts.use_cuda_kernel)
+    plain.remove_weight_norm()
+    plain.load_state_dict(frozen.state_dict())
+    plain = plain.to(device).eval()
+    speaker = tts.get_speaker_conditioning("tests/sample_prompt.wav")
+    cond_biases = tts.get_vocoder_biases(speaker)
+    generator = torch.Generator().manual_seed(0)
+    failed = []
+    for frames in (20, 100):
+        latent = torch.randn((1, frames, tts.cfg.bigvgan.gpt_dim), generator=generator).to(device)
+        times, wavs = {}, {}
+        with torch.no_grad():
+            for name, model, kwargs in (("plain", plain, {"speaker_embedding": speaker.speaker_embedding}),
+                                        ("frozen", frozen, {"cond_biases": cond_biases})):
+                model(latent[:, :10], None, **kwargs)  # warmup
+                start = time.perf_counter()
+                wavs[name], _ = model(latent, None, **kwargs)
+                times[name] = time.perf_counter() - start
+        ok = torch.equal(wavs["plain"], wavs["frozen"])
+        print(f"{'OK  ' if ok else 'FAIL'} {frames} frames: plain {times['plain']:.3f}s, frozen {times['frozen']:.3f}s, "
+              f"max diff {(wavs['plain'] - wavs['frozen']).abs().max().item():.3g}")
+        if not ok:
+            failed.append(frames)
+    if failed:
+        print("frozen BigVGAN mismatch:", failed)
+        sys.exit(1)
@@ -0,0 +1,110 @@
+import sys
+import threading
+import time
+
+import torch
+import torchaudio
+from indextts.infer import IndexTTS
+from indextts.gpt.batching import ContinuousBatchingScheduler
+from indextts.utils.feature_extractors import MelSpectrogramFeatures
+
+TEXTS = [
+    "There is a vehicle arriving in dock number 7?",
+    "晕XUAN4是一种GAN3觉",
+    "Hello world.",
+    "大家好，我现在正在bilibili 体验 ai 科技，说实话，来之前我绝对想不到！AI技术已经发展到这样匪夷所思的地步了！",
+    "The quick brown fox jumps over the lazy dog.",
+    "你好",
+]
+
+if __name__ == "__main__":
+    """
+    Submit sentences of two voices from several threads to `ContinuousBatchingScheduler`,
+    and check that greedy decoding gives the same codes as decoding each sentence alone,
+    also with a `RunawayGuard` stopping some rows.
+    ```
+    python tests/continuous_batching_test.py checkpoints
+    python tests/continuous_batching_test.py IndexTTS-1.5 cuda:0 4
+    ```
+    """
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else "checkpoints"
+    device = sys.argv[2] if len(sys.argv) > 2 else "cpu"
+    max_batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    tts = IndexTTS(cfg_path=f"{model_dir}/config.yaml", model_dir=model_dir, is_fp16=False, device=device)
+    audio, sr = torchaudio.load("tests/sample_prompt.wav")
+    audio = torch.mean(audio, dim=0, keepdim=True)
+    audio = torchaudio.transforms.Resample(sr, 24000)(audio)
+    conds = []
+    # two voices: the prompt and its first half
+    for mel in (MelSpectrogramFeatures()(audio), MelSpectrogramFeatures()(audio[:, :audio.shape[1] // 2])):
+        mel = mel.to(tts.device)
+        with torch.no_grad():
+            conds.append(tts.gpt.get_conditioning(mel, torch.tensor([mel.shape[-1]], device=tts.device)))
+    jobs = []
+    for i, text in enumerate(TEXTS * 2):
+        tokens = torch.tensor(tts.tokenizer.encode(text), dtype=torch.int32, device=tts.device).unsqueeze(0)
+        jobs.append((conds[i % 2], tokens, 20 + 15 * i))
+
+    expected = []
+    start = time.perf_counter()
+    for cond, tokens, max_mel_tokens in jobs:
+        with torch.no_grad():
+            expected.append(tts.gpt.inference_speech(None, tokens, conds_latent=cond, do_sample=False, num_beams=1,
+                                                     repetition_penalty=10.0, max_generate_length=max_mel_tokens,
+                                                     return_latent=True, decode_engine="native"))
+    sequential_time = time.perf_counter() - start
+
+    scheduler = ContinuousBatchingScheduler(tts.gpt, max_batch_size=max_batch_size, max_mel_tokens=300,
+                                            do_sample=False, repetition_penalty=10.0).start()
+    results = [None] * len(jobs)
+
+    def client(indices):
+        futures = [(i, scheduler.submit(jobs[i][0], jobs[i][1], max_mel_tokens=jobs[i][2])) for i in indices]
+        for i, future in futures:
+            results[i] = future.result()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(range(k, len(jobs), 3),)) for k in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batched_time = time.perf_counter() - start
+    print("scheduler stats:", scheduler.stats())
+    scheduler.close()
+
+    failed = 0
+    for i, ((codes, latents), (expected_codes, expected_latents)) in enumerate(zip(results, expected)):
+        same = codes.shape == expected_codes.shape and torch.equal(codes, expected_codes)
+        diff = (latents - expected_latents).abs().max().item() if same else float("nan")
+        ok = same and diff < 1e-3
+        failed += not ok
+        print(f"{'OK  ' if ok else 'FAIL'} job {i}: codes {tuple(codes.shape)} expected {tuple(expected_codes.shape)}, "
+              f"latent max diff {diff:.2e}")
+    print(f"sequential {sequential_time:.3f}s, continuous batching {batched_time:.3f}s")
+
+    # runaway guard per slot: a token generated by the third job as "silence" stops it (and any other row emitting it)
+    guard = {"silent_token": expected[2][0][0, 5].item(), "max_silent_tokens": 1}
+    guard_expected = dict.fromkeys(tts.gpt.runaway_stats, 0)
+    guard_stats = dict.fromkeys(tts.gpt.runaway_stats, 0)
+    scheduler = ContinuousBatchingScheduler(tts.gpt, max_batch_size=max_batch_size, max_mel_tokens=300,
+                                            do_sample=False, repetition_penalty=10.0).start()
+    futures = [scheduler.submit(cond, tokens, max_mel_tokens=max_mel_tokens, runaway_guard=guard,
+                                runaway_stats=guard_stats) for cond, tokens, max_mel_tokens in jobs]
+    for i, (cond, tokens, max_mel_tokens) in enumerate(jobs):
+        with torch.no_grad():
+            codes = tts.gpt.inference_speech(None, tokens, conds_latent=cond, do_sample=False, num_beams=1,
+                                             repetition_penalty=10.0, max_generate_length=max_mel_tokens,
+                                             decode_engine="native", runaway_guard=guard,
+                                             runaway_stats=guard_expected)[0]
+        stops = (codes == tts.gpt.stop_mel_token).nonzero()
+        codes = codes[:stops[0].item() + 1] if len(stops) else codes
+        ok = torch.equal(futures[i].result()[0][0], codes)
+        failed += not ok
+        print(f"{'OK  ' if ok else 'FAIL'} guarded job {i}: codes {codes.shape[-1]}")
+    scheduler.close()
+    print("runaway stats:", guard_stats, "expected:", guard_expected)
+    if guard_stats != guard_expected or not guard_stats["silence_stops"]:
+        failed += 1
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,70 @@
+import sys
+import time
+
+import torch
+import transformers
+from indextts.gpt.sampling import FusedSampler
+from indextts.utils.typical_sampling import TypicalLogitsWarper
+
+# FusedSampler kwargs
+CONFIGS = [
+    dict(do_sample=False),
+    dict(do_sample=False, repetition_penalty=10.0),
+    dict(do_sample=True, top_p=0.8, top_k=30, temperature=1.0, repetition_penalty=10.0),
+    dict(do_sample=True, top_p=0.8, top_k=30, temperature=0.7, repetition_penalty=2.0),
+    dict(do_sample=True, top_k=50),
+    dict(do_sample=True, top_k=50, repetition_penalty=0.8),
+    dict(do_sample=True, top_k=0, top_p=0.9),
+    dict(do_sample=True, top_k=30, top_p=0.8, min_tokens_to_keep=2),
+    dict(do_sample=True, top_k=30, repetition_penalty=10.0, logits_processor=[TypicalLogitsWarper(mass=0.9)]),
+]
+
+if __name__ == "__main__":
+    """
+    Check that `FusedSampler` filters the same scores and samples the same tokens with a fixed seed
+    as the separate transformers processors and warpers, and time both.
+    ```
+    python tests/fused_sampler_test.py
+    python tests/fused_sampler_test.py cuda:0 8
+    ```
+    """
+    device = sys.argv[1] if len(sys.argv) > 1 else "cpu"
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    vocab_size, history, steps = 8194, 200, 50
+    failed = []
+    for kwargs in CONFIGS:
+        sampler = FusedSampler(**kwargs)
+        name = ", ".join(f"{k}={v}" for k, v in kwargs.items() if k != "logits_processor")
+        if "logits_processor" in kwargs:
+            name += ", typical"
+        generator = torch.Generator().manual_seed(0)
+        input_ids = torch.randint(0, vocab_size, (rows, history), generator=generator).to(device)
+        counts = sampler.token_counts(input_ids, vocab_size)
+        mismatches = 0
+        fused_time = reference_time = 0.0
+        for step in range(steps):
+            logits = (torch.randn((rows, vocab_size), generator=generator) * 3).to(device)
+            if step % 10 == 0:
+                # ties at the k-th score
+                logits[:, :64] = logits[:, :1]
+            transformers.set_seed(step)
+            start = time.perf_counter()
+            tokens = sampler.sample(logits, counts, input_ids)
+            fused_time += time.perf_counter() - start
+            fused_scores = sampler(logits, counts, input_ids)
+            transformers.set_seed(step)
+            start = time.perf_counter()
+            scores = sampler.reference(logits, input_ids)
+            expected = torch.multinomial(torch.softmax(scores, dim=-1), 1).squeeze(1) if sampler.do_sample \
+                else torch.argmax(scores, dim=-1)
+            reference_time += time.perf_counter() - start
+            mismatches += not (torch.equal(tokens, expected) and torch.equal(fused_scores, scores))
+            input_ids = torch.cat([input_ids, tokens[:, None]], dim=1)
+            sampler.update(counts, tokens)
+        print(f"{'OK  ' if mismatches == 0 else 'FAIL'} {name}: fused {fused_time / steps * 1000:.3f}ms/step, "
+              f"separate {reference_time / steps * 1000:.3f}ms/step")
+        if mismatches:
+            failed.append(name)
+    if failed:
+        print("fused sampler mismatch:", failed)
+        sys.exit(1)
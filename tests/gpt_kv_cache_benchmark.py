@@ -0,0 +1,59 @@
+import time
+
+import torch
+import torchaudio
+from indextts.infer import IndexTTS
+from indextts.utils.feature_extractors import MelSpectrogramFeatures
+
+if __name__ == "__main__":
+    """
+    Benchmark the per-token latency of GPT mel-token decoding with and without KV cache.
+    ```
+    python tests/gpt_kv_cache_benchmark.py checkpoints
+    python tests/gpt_kv_cache_benchmark.py IndexTTS-1.5 cpu
+    ```
+    With KV cache the per-token latency should stay flat as `max_mel_tokens` grows,
+    without it the latency grows linearly with the generated length.
+    """
+    import transformers
+    transformers.set_seed(42)
+    import sys
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else "checkpoints"
+    device = sys.argv[2] if len(sys.argv) > 2 else "cpu"
+    audio_prompt = "tests/sample_prompt.wav"
+    tts = IndexTTS(cfg_path=f"{model_dir}/config.yaml", model_dir=model_dir, is_fp16=False, device=device)
+    text_tokens = tts.tokenizer.encode("There is a vehicle arriving in dock number 7?")
+    text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=tts.device).unsqueeze(0)
+
+    audio, sr = torchaudio.load(audio_prompt)
+    audio = torch.mean(audio, dim=0, keepdim=True)
+    audio = torchaudio.transforms.Resample(sr, 24000)(audio)
+    auto_conditioning = MelSpectrogramFeatures()(audio).to(tts.device)
+    cond_mel_lengths = torch.tensor([auto_conditioning.shape[-1]], device=tts.device)
+
+    results = {}
+    for kv_cache in (True, False):
+        tts.gpt.post_init_gpt2_config(use_deepspeed=False, kv_cache=kv_cache, half=False)
+        for max_mel_tokens in (100, 200, 400, 600):
+            with torch.no_grad():
+                start = time.perf_counter()
+                codes = tts.gpt.inference_speech(auto_conditioning, text_tokens,
+                                                 cond_mel_lengths=cond_mel_lengths,
+                                                 do_sample=False,
+                                                 num_beams=1,
+                                                 top_k=None,
+                                                 repetition_penalty=10.0,
+                                                 max_generate_length=max_mel_tokens,
+                                                 # never stop early, so every run decodes exactly `max_mel_tokens`
+                                                 min_new_tokens=max_mel_tokens)
+                elapsed = time.perf_counter() - start
+            results[(kv_cache, max_mel_tokens)] = elapsed / codes.shape[-1]
+            print(f"kv_cache={kv_cache} max_mel_tokens={max_mel_tokens}: "
+                  f"{codes.shape[-1]} tokens in {elapsed:.2f}s, {1000 * elapsed / codes.shape[-1]:.2f} ms/token")
+    tts.gpt.post_init_gpt2_config(use_deepspeed=False, kv_cache=True, half=False)
+
+    print("--" * 10)
+    print("max_mel_tokens | kv_cache ms/token | no cache ms/token")
+    for max_mel_tokens in (100, 200, 400, 600):
+        print(f"{max_mel_tokens:>14} | {1000 * results[(True, max_mel_tokens)]:>17.2f} | "
+              f"{1000 * results[(False, max_mel_tokens)]:>17.2f}")
@@ -0,0 +1,83 @@
+import os
+import sys
+import tempfile
+
+import torch
+from indextts.utils.mel_budget import MelBudgetEstimator, MelTokenLimit
+
+STOP, PROMPT = 8193, 4
+
+if __name__ == "__main__":
+    """
+    Check the mel budget estimator (language, estimate, fit, save/load) and the per-row `MelTokenLimit`.
+    ```
+    python tests/mel_budget_test.py
+    ```
+    """
+    failed = []
+    estimator = MelBudgetEstimator()
+    zh = list("大家好我现在正在体验科技")
+    en = ["▁THE", "▁QUICK", "▁BROWN", "▁FOX", "▁JUMPS", "."]
+    print("language:", estimator.language(zh), estimator.language(en), estimator.language(zh[:2] + en))
+    if (estimator.language(zh), estimator.language(en), estimator.language(zh[:2] + en)) != ("zh", "en", "en"):
+        failed.append("language")
+    budgets = estimator.estimate(zh, 600), estimator.estimate(en, 600), estimator.estimate(zh * 10, 600)
+    print("default budgets:", budgets)
+    if budgets[2] != 600 or not budgets[1] < budgets[0] < 600:
+        failed.append("estimate")
+
+    # ~6 mel tokens per chinese character, ~8 per english token
+    generator = torch.Generator().manual_seed(0)
+    for _ in range(200):
+        n = int(torch.randint(2, 60, (1,), generator=generator))
+        estimator.observe(zh[:1] * n, int(n * (4 + 4 * torch.rand(1, generator=generator).item())))
+        estimator.observe(en[:1] * n, int(n * (6 + 4 * torch.rand(1, generator=generator).item())) + 10)
+    coefficients = estimator.fit(quantile=1.0, margin=1.0)
+    print("fitted:", coefficients)
+    for lang, tokens in (("zh", zh[:1] * 59), ("en", en[:1] * 59)):
+        # the fitted upper bound covers every observed sentence
+        if not all(estimator.estimate(tokens[:n], 10000) >= codes
+                   for obs_lang, n, codes, _ in estimator.observations if obs_lang == lang):
+            failed.append(f"fit {lang}")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "mel_budget.json")
+        estimator.save(path)
+        loaded = MelBudgetEstimator.load(path)
+        if loaded.estimate(zh, 600) != estimator.estimate(zh, 600) or len(loaded.observations) != 400:
+            failed.append("save/load")
+
+    # sentences cut at their budget: the fit must not shrink the budget, whatever the natural stops say
+    censored = MelBudgetEstimator({"zh": (8.0, 0.0)})
+    for n in range(10, 50):
+        censored.observe(zh[:1] * n, 2 * n)
+        censored.observe(zh[:1] * n, 8 * n, hit=True)
+    slope = censored.fit(quantile=0.9)["zh"][0]
+    print("censored fit slope:", slope)
+    if slope < 8.0:
+        failed.append("censored fit")
+
+    # per-row limits: rows 0 and 2 stop after their limit, row 1 has the batch limit and is ended by max_length,
+    # every row gets its limit of codes
+    limit = MelTokenLimit(STOP, PROMPT, torch.tensor([3, 10, 6]))
+    stopped = {}
+    input_ids = torch.zeros((3, PROMPT), dtype=torch.long)
+    rows = torch.arange(3)
+    for step in range(10):
+        scores = limit(input_ids, torch.zeros((input_ids.shape[0], STOP + 1)))
+        tokens = scores.argmax(dim=-1)
+        for row, token in zip(rows.tolist(), tokens.tolist()):
+            if token == STOP and row not in stopped:
+                stopped[row] = step + 1
+        input_ids = torch.cat([input_ids, tokens[:, None]], dim=1)
+        if step == 4:
+            # drop the finished row 0, like `GPT2DecodeEngine.generate(compact_finished=True)`
+            keep = torch.tensor([1, 2])
+            limit.select_rows(keep)
+            input_ids, rows = input_ids[keep], rows[keep]
+    print("stopped at:", stopped)
+    if stopped != {0: 4, 2: 7}:
+        failed.append("limit")
+    if failed:
+        print("mel budget mismatch:", failed)
+        sys.exit(1)
+    print("OK")
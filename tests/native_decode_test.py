@@ -0,0 +1,98 @@
+import sys
+import time
+
+import torch
+import torchaudio
+import transformers
+from indextts.infer import IndexTTS
+from indextts.utils.feature_extractors import MelSpectrogramFeatures
+
+# (name, inference_speech kwargs)
+MODES = [
+    ("greedy", dict(do_sample=False, num_beams=1)),
+    ("sample", dict(do_sample=True, top_p=0.8, top_k=30, temperature=1.0, num_beams=1, repetition_penalty=10.0)),
+    ("sample x2", dict(do_sample=True, top_p=0.8, top_k=30, num_beams=1, num_return_sequences=2)),
+    ("typical", dict(do_sample=True, num_beams=1, typical_sampling=True, typical_mass=0.9)),
+    ("beam search", dict(do_sample=False, num_beams=3, length_penalty=0.0, repetition_penalty=10.0)),
+    ("beam sample", dict(do_sample=True, top_p=0.8, top_k=30, temperature=1.0, num_beams=3,
+                         length_penalty=0.0, repetition_penalty=10.0)),
+    ("beam sample x2", dict(do_sample=True, top_p=0.8, top_k=30, num_beams=3, num_return_sequences=2)),
+]
+
+if __name__ == "__main__":
+    """
+    Check that the native decode engine gives the same codes and latents as transformers `generate()` with a fixed seed,
+    also with the shared conditioning prefix, and that dropping the finished rows (`compact_finished`)
+    keeps the codes of a batch of sentences.
+    ```
+    python tests/native_decode_test.py checkpoints
+    python tests/native_decode_test.py IndexTTS-1.5 cuda:0
+    ```
+    """
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else "checkpoints"
+    device = sys.argv[2] if len(sys.argv) > 2 else "cpu"
+    max_mel_tokens = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    tts = IndexTTS(cfg_path=f"{model_dir}/config.yaml", model_dir=model_dir, is_fp16=False, device=device)
+    text_tokens = tts.tokenizer.encode("There is a vehicle arriving in dock number 7?")
+    text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=tts.device).unsqueeze(0)
+    audio, sr = torchaudio.load("tests/sample_prompt.wav")
+    audio = torch.mean(audio, dim=0, keepdim=True)
+    audio = torchaudio.transforms.Resample(sr, 24000)(audio)
+    auto_conditioning = MelSpectrogramFeatures()(audio).to(tts.device)
+
+    with torch.no_grad():
+        conds_latent = tts.gpt.get_conditioning(auto_conditioning,
+                                                torch.tensor([auto_conditioning.shape[-1]], device=tts.device))
+        conds_prefix = tts.gpt.get_conditioning_prefix(conds_latent)
+
+    failed = []
+    for name, kwargs in MODES:
+        results = {}
+        # "native+prefix": the conditioning keys/values are computed once and shared, only the sum order differs
+        for engine, prefix in (("hf", None), ("native", None), ("native+prefix", conds_prefix)):
+            transformers.set_seed(42)
+            start = time.perf_counter()
+            with torch.no_grad():
+                # compaction samples fewer rows per step, only the uncompacted engine follows the same random draws
+                codes, latents = tts.gpt.inference_speech(None, text_tokens, conds_latent=conds_latent,
+                                                          max_generate_length=max_mel_tokens, return_latent=True,
+                                                          decode_engine=engine.split("+")[0], conds_prefix=prefix,
+                                                          compact_finished=not kwargs["do_sample"], **kwargs)
+            results[engine] = (codes, latents, time.perf_counter() - start)
+        hf_codes, hf_latents, hf_time = results["hf"]
+        line = []
+        for engine in ("native", "native+prefix"):
+            codes, latents, native_time = results[engine]
+            same_codes = hf_codes.shape == codes.shape and torch.equal(hf_codes, codes)
+            latent_diff = (hf_latents - latents).abs().max().item() if same_codes else float("nan")
+            ok = same_codes and latent_diff <= 1e-4
+            line.append(f"{engine} {'OK' if ok else 'FAIL'} {native_time:.3f}s latent max diff {latent_diff:.2e}")
+            if not ok:
+                failed.append(f"{name} ({engine})")
+        print(f"{name:16s} codes {tuple(hf_codes.shape)}, hf {hf_time:.3f}s, " + ", ".join(line))
+
+    batch_tokens = tts.pad_tokens_cat([torch.tensor([tts.tokenizer.encode(text)], dtype=torch.int32, device=tts.device)
+                                       for text in ("Hello world.", "There is a vehicle arriving in dock number 7?",
+                                                    "晕XUAN4是一种GAN3觉")])
+    for name, kwargs in MODES:
+        if kwargs["do_sample"]:
+            continue
+        results = {}
+        for engine in ("hf", "native"):
+            with torch.no_grad():
+                results[engine] = tts.gpt.inference_speech(None, batch_tokens, conds_latent=conds_latent,
+                                                           max_generate_length=max_mel_tokens, return_latent=True,
+                                                           decode_engine=engine, **kwargs)
+        (hf_codes, hf_latents), (codes, latents) = results["hf"], results["native"]
+        same_codes = hf_codes.shape == codes.shape and torch.equal(hf_codes, codes)
+        # the latents after the stop token are not computed for the dropped rows
+        valid = (torch.cumsum((hf_codes == tts.gpt.stop_mel_token).long(), dim=1) == 0).unsqueeze(-1)
+        latent_diff = ((hf_latents - latents) * valid).abs().max().item() if same_codes else float("nan")
+        ok = same_codes and latent_diff <= 1e-4
+        print(f"{name + ' batch':16s} codes {tuple(hf_codes.shape)}, native {'OK' if ok else 'FAIL'} "
+              f"latent max diff {latent_diff:.2e}, {tts.gpt.native_decoder.last_stats}")
+        if not ok:
+            failed.append(f"{name} batch (compact_finished)")
+    if failed:
+        print("native decode mismatch:", failed)
+        sys.exit(1)
@@ -0,0 +1,155 @@
+import random
+import re
+import sys
+import time
+
+from indextts.utils.front import TextNormalizer
+
+CASES = [
+    # 中文, 走 fast path
+    "你好世界",
+    "你好 世界",
+    "你好  世界   ",
+    " 你好",
+    "你好，世界！",
+    "你好,world",
+    "我在 bilibili 体验 ai 科技",
+    "他说：“好的”。",
+    "什么？！",
+    "《盗梦空间》是一部电影",
+    "这酒...里...有毒...",
+    "只有,,,才是最好的",
+    "只有，，，才是最好的",
+    "清晨拉开窗帘，阳光洒在窗台的Bloomixy花艺礼盒上——薰衣草香薰蜡烛唤醒嗅觉",
+    "克里斯托弗·诺兰执导并编剧，约瑟夫·高登-莱维特主演",
+    "约瑟夫·高登-莱维特（Joseph Gordon-Levitt is an American actor）",
+    "今天是个好日子 it's a good day",
+    "中国VS美国",
+    "A股大涨",
+    "你好\t世界\n再见",
+    "呃，这个嘛，啊",
+    "一点儿也不",
+    "儿女情长",
+    "【注意】「引号」『书名』",
+    "你好～",
+    "你好~",
+    # 中文, 走 FST
+    "IndexTTS 正式发布1.0版本了，效果666",
+    "晕XUAN4是一种GAN3觉",
+    "M.V.P是谁",
+    "這是繁體字",
+    "甲+乙",
+    "你-我",
+    "乘以×",
+    "2.5平方电线",
+    "苹果于2030/1/2发布新 iPhone 2X 系列手机，最低售价仅 ¥12999",
+    "８０后",
+    # 英文, 走 fast path
+    "I love you!",
+    "Hello world",
+    "Hello, world!",
+    "don't stop believing",
+    "well-known fact.",
+    "where's the money?",
+    "how's it going?",
+    "hello; world: yes",
+    "Monday is a good day",
+    "The IV",
+    "NASA is big",
+    # 英文, 走 FST
+    "Hello  world ",
+    " Hello world",
+    "Mr Smith",
+    "Mr. Smith",
+    "Sacramento, CA",
+    "U.S.A.",
+    "U. S. A.",
+    "google.com",
+    "aCo.",
+    "a paper towel",
+    "per ft",
+    "World War II",
+    "(hello)",
+    "'quoted'",
+    "See you at 8:00 AM",
+    "This sales for 2.5% off, only $12.5.",
+    "such as XTTS, CosyVoice2, Fish-Speech, and F5-TTS",
+]
+
+ZH_ALPHABET = list("你好世界中国人的是在了不和有大这上为个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高长现二将") + \
+    list("儿呃啊這個們時說與") + list("abcXYZ ") + list("，。！？：；、“”‘’《》（）【】「」…—·～~,.!?:;'\"()[]-+=×÷<>/$%1234567890０１")
+EN_ALPHABET = list("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ") + list(" '-,.!?;:") + ["1", "$", "%", "(", '"']
+EN_WORDS = ["the", "I", "a", "Mr", "Dr", "St", "CA", "NY", "OK", "IN", "am", "pm", "Jan", "Monday", "World", "War", "II",
+            "vs", "etc", "Ave", "hello", "there", "it's", "what's", "well-known", "don't", "NASA", "A", "U", "S", "ft", "kg",
+            "California", "New", "York", "one", "first", "per", "cent", "love", "you", "Hon", "Inc", "Ltd", "No", "Co",
+            "paper", "xCo", "aNew", "Io", "mph", "Ft", "NO", "km", "hr", "sec", "min", "TV", "Jr"]
+
+
+def random_zh(rng: random.Random) -> str:
+    return "".join(rng.choice(ZH_ALPHABET) for _ in range(rng.randint(1, 24)))
+
+
+def random_en(rng: random.Random) -> str:
+    words = []
+    for _ in range(rng.randint(1, 10)):
+        if rng.random() < 0.6:
+            word = rng.choice(EN_WORDS)
+        else:
+            word = "".join(rng.choice(EN_ALPHABET[:52]) for _ in range(rng.randint(1, 6)))
+        if rng.random() < 0.3:
+            word += rng.choice(",.!?;:")
+        if rng.random() < 0.05:
+            word = rng.choice(EN_ALPHABET) + word
+        words.append(word)
+    return (" " if rng.random() < 0.95 else "  ").join(words)
+
+
+if __name__ == "__main__":
+    """
+    Check that the normalizer fast path gives byte-identical output to the FSTs.
+    ```
+    python tests/normalizer_fast_path_test.py
+    python tests/normalizer_fast_path_test.py /path/to/tn_cache 20000
+    ```
+    """
+    cache_dir = sys.argv[1] if len(sys.argv) > 1 else None
+    num_random = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    normalizer = TextNormalizer(cache_dir=cache_dir)
+    normalizer.load()
+
+    rng = random.Random(1234)
+    corpus = list(CASES)
+    corpus += [random_zh(rng) for _ in range(num_random)]
+    corpus += [random_en(rng) for _ in range(num_random)]
+
+    mismatches = []
+    fast_hits = 0
+    fast_time = slow_time = 0.0
+    for text in corpus:
+        stripped = re.sub(TextNormalizer.ENGLISH_CONTRACTION_PATTERN, r"\1 is", text, flags=re.IGNORECASE)
+        if normalizer.use_chinese(text):
+            hit = normalizer.fast_normalize_zh(stripped.rstrip()) is not None
+        else:
+            hit = normalizer.fast_normalize_en(stripped) is not None
+        normalizer.fast_path = False
+        start = time.perf_counter()
+        expected = normalizer.normalize(text)
+        if hit:
+            slow_time += time.perf_counter() - start
+        normalizer.fast_path = True
+        start = time.perf_counter()
+        result = normalizer.normalize(text)
+        if hit:
+            fast_time += time.perf_counter() - start
+        fast_hits += hit
+        if result != expected:
+            mismatches.append((text, expected, result))
+        if text in CASES:
+            print(f"{'fast' if hit else 'fst '} {text!r} -> {result!r}")
+
+    for text, expected, result in mismatches[:50]:
+        print(f"MISMATCH {text!r}: fst={expected!r}, fast path={result!r}")
+    print(f"{len(corpus)} texts, {fast_hits} on the fast path, {len(mismatches)} mismatches")
+    print(f"time of the fast path texts: fst {slow_time:.3f}s, fast path {fast_time:.3f}s")
+    if mismatches:
+        sys.exit(1)
@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+
+import torch
+from indextts.infer import IndexTTS
+
+
+def vocode_time(bigvgan, latent, cond_biases, repeat=3):
+    """Best of ``repeat`` BigVGAN calls, in seconds, and the waveform."""
+    best = float("inf")
+    with torch.no_grad():
+        bigvgan(latent[:, :10], None, cond_biases=cond_biases)  # warmup
+        for _ in range(repeat):
+            start = time.perf_counter()
+            wav, _ = bigvgan(latent, None, cond_biases=cond_biases)
+            if latent.is_cuda:
+                torch.cuda.synchronize()
+            best = min(best, time.perf_counter() - start)
+    return best, wav
+
+
+if __name__ == "__main__":
+    """
+    Benchmark `bigvgan_time` with the AMP blocks of each upsampling stage run one after the other
+    and concurrently (`BigVGAN.parallel_resblocks`), and check that the waveforms are the same.
+    On CPU the concurrent blocks share the cores with the intra-op threads of each conv,
+    so it is also timed with the intra-op threads divided by the number of blocks.
+    ```
+    python tests/parallel_resblocks_benchmark.py checkpoints
+    python tests/parallel_resblocks_benchmark.py checkpoints cuda:0
+    ```
+    """
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else "checkpoints"
+    device = sys.argv[2] if len(sys.argv) > 2 else "cpu"
+    tts = IndexTTS(cfg_path=f"{model_dir}/config.yaml", model_dir=model_dir, is_fp16=False, device=device)
+    bigvgan = tts.bigvgan
+    cond_biases = tts.get_vocoder_biases(tts.get_speaker_conditioning("tests/sample_prompt.wav"))
+    threads = torch.get_num_threads()
+    settings = [("sequential", False, threads), ("parallel", True, threads)]
+    if device == "cpu" and threads >= bigvgan.num_kernels:
+        settings.append(("parallel, fewer intra-op threads", True, threads // bigvgan.num_kernels))
+    print(f">> {os.cpu_count()} cpus, {threads} intra-op threads, {bigvgan.num_kernels} AMP blocks per stage")
+    generator = torch.Generator().manual_seed(0)
+    failed = []
+    for frames in (16, 50, 200):
+        latent = torch.randn((1, frames, tts.cfg.bigvgan.gpt_dim), generator=generator).to(device)
+        reference = None
+        for name, parallel, num_threads in settings:
+            bigvgan.parallel_resblocks = parallel
+            torch.set_num_threads(num_threads)
+            bigvgan_time, wav = vocode_time(bigvgan, latent, cond_biases)
+            same = reference is None or torch.equal(wav, reference)
+            if reference is None:
+                reference, sequential_time = wav, bigvgan_time
+            print(f"{'OK  ' if same else 'FAIL'} {frames} frames, {name} ({num_threads} threads): "
+                  f"bigvgan_time {bigvgan_time:.3f}s ({sequential_time / bigvgan_time:.2f}x)")
+            if not same:
+                failed.append(f"{frames}/{name}")
+        torch.set_num_threads(threads)
+    bigvgan.parallel_resblocks = False
+    if failed:
+        print("parallel resblocks mismatch:", failed)
+        sys.exit(1)
@@ -0,0 +1,70 @@
+import copy
+import sys
+import time
+
+import torch
+from indextts.BigVGAN.activations import Snake, SnakeBeta
+from indextts.BigVGAN.alias_free_torch import Activation1d, PolyphaseActivation1d
+from indextts.BigVGAN.models import BigVGAN, masked_activation
+from indextts.infer import IndexTTS
+
+
+def check_activations(generator, atol=1e-5):
+    """`PolyphaseActivation1d` against `Activation1d`, whole rows and right padded rows, returns the failures."""
+    failed = []
+    for activation in (Snake(16, alpha_logscale=False), SnakeBeta(16, alpha_logscale=True)):
+        activation.alpha.data = torch.rand(16, generator=generator) + 0.5
+        if isinstance(activation, SnakeBeta):
+            activation.alpha.data = torch.randn(16, generator=generator)
+            activation.beta.data = torch.randn(16, generator=generator)
+        reference, polyphase = Activation1d(activation), PolyphaseActivation1d(activation)
+        for length in (1, 2, 3, 5, 6, 7, 64, 1000):
+            x = torch.randn((2, 16, length), generator=generator)
+            diff = (reference(x) - polyphase(x)).abs().max().item()
+            lengths = torch.tensor([length, max(1, length // 3)])
+            padded = polyphase(x, lengths)
+            diff = max([diff] + [(reference(x[i:i + 1, :, :n]) - padded[i:i + 1, :, :n]).abs().max().item()
+                                 for i, n in enumerate(lengths.tolist())])
+            diff = max(diff, (masked_activation(reference, x, lengths) - padded)[1, :, :lengths[1]].abs().max().item())
+            if diff > atol:
+                failed.append(f"{type(activation).__name__} {length}: {diff:.3g}")
+    return failed
+
+
+if __name__ == "__main__":
+    """
+    Check that `PolyphaseActivation1d` gives the outputs of `Activation1d` (up to float rounding),
+    then benchmark `BigVGAN.forward` on CPU with both.
+    ```
+    python tests/polyphase_activation_benchmark.py checkpoints
+    ```
+    """
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else "checkpoints"
+    generator = torch.Generator().manual_seed(0)
+    failed = check_activations(generator)
+    print("activations:", "OK" if not failed else failed)
+
+    tts = IndexTTS(cfg_path=f"{model_dir}/config.yaml", model_dir=model_dir, is_fp16=False, device="cpu")
+    reference = tts.bigvgan
+    polyphase = BigVGAN(copy.deepcopy(tts.cfg.bigvgan), polyphase_activation=True)
+    polyphase.remove_weight_norm()
+    polyphase.load_state_dict(reference.state_dict())
+    polyphase.eval()
+    speaker = tts.get_speaker_conditioning("tests/sample_prompt.wav")
+    for frames in (50, 100, 200):
+        latent = torch.randn((1, frames, tts.cfg.bigvgan.gpt_dim), generator=generator)
+        times, wavs = {}, {}
+        with torch.no_grad():
+            for name, model in (("reference", reference), ("polyphase", polyphase)):
+                model(latent[:, :10], None, speaker_embedding=speaker.speaker_embedding)  # warmup
+                start = time.perf_counter()
+                wavs[name], _ = model(latent, None, speaker_embedding=speaker.speaker_embedding)
+                times[name] = time.perf_counter() - start
+        diff = (wavs["reference"] - wavs["polyphase"]).abs().max().item()
+        if diff > 1e-4:
+            failed.append(f"BigVGAN {frames}: {diff:.3g}")
+        print(f"{frames} frames: Activation1d {times['reference']:.3f}s, PolyphaseActivation1d {times['polyphase']:.3f}s "
+              f"({times['reference'] / times['polyphase']:.2f}x), max diff {diff:.3g}")
+    if failed:
+        print("polyphase activation mismatch:", failed)
+        sys.exit(1)
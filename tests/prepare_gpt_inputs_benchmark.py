@@ -0,0 +1,92 @@
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+from indextts.infer import IndexTTS
+
+
+def prepare_gpt_inputs_loop(gpt, conditional_latents, text_inputs):
+    """The per-row reference of `UnifiedVoice.prepare_gpt_inputs()`."""
+    b, L = text_inputs.shape[:2]
+    device = text_inputs.device
+    single_cond = conditional_latents.ndim == 3 and conditional_latents.shape[0] == 1
+    batched_mel_emb = []
+    attention_masks = []
+    target_len = conditional_latents.shape[1] + L + 2
+    for i in range(b):
+        valid_mask = (text_inputs[i] != gpt.stop_text_token) & (text_inputs[i] != gpt.start_text_token)
+        text_input = text_inputs[i][valid_mask]
+        text_input = F.pad(text_input, (1, 0), value=gpt.start_text_token)
+        text_input = F.pad(text_input, (0, 1), value=gpt.stop_text_token)
+        text_input_pos = torch.arange(0, text_input.size(-1), device=device)
+        text_emb = gpt.text_embedding(text_input) + gpt.text_pos_embedding.emb(text_input_pos)
+        conds_text_emb = [conditional_latents.squeeze(0) if single_cond else conditional_latents[i], text_emb]
+        attention_mask = torch.ones(target_len + 1, dtype=torch.long, device=device)
+        padding = L + 2 - text_input.size(-1)
+        if padding > 0:
+            pad = torch.zeros((padding, conditional_latents.size(-1)), dtype=text_emb.dtype, device=device)
+            conds_text_emb.insert(0, pad)
+            attention_mask[:padding] = 0
+        batched_mel_emb.append(torch.cat(conds_text_emb))
+        attention_masks.append(attention_mask)
+    fake_inputs = torch.ones((b, target_len + 1), dtype=torch.long, device=device)
+    fake_inputs[:, -1] = gpt.start_mel_token
+    return fake_inputs, torch.stack(batched_mel_emb), torch.stack(attention_masks)
+
+
+def random_text_inputs(gpt, b, max_len, generator):
+    """Right padded text tokens with the stop token, some rows wrapped with start/stop tokens as in training data."""
+    text_inputs = torch.full((b, max_len), gpt.stop_text_token, dtype=torch.int32)
+    for i in range(b):
+        n = int(torch.randint(1, max_len + 1, (1,), generator=generator))
+        text_inputs[i, :n] = torch.randint(2, gpt.number_text_tokens, (n,), generator=generator)
+        if i % 3 == 1 and n > 2:
+            text_inputs[i, 0] = gpt.start_text_token
+    return text_inputs
+
+
+if __name__ == "__main__":
+    """
+    Check that the batched `UnifiedVoice.prepare_gpt_inputs()` returns the same inputs as the per-row loop,
+    and time both for growing batch sizes.
+    ```
+    python tests/prepare_gpt_inputs_benchmark.py checkpoints
+    python tests/prepare_gpt_inputs_benchmark.py checkpoints cuda:0
+    ```
+    """
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else "checkpoints"
+    device = sys.argv[2] if len(sys.argv) > 2 else "cpu"
+    tts = IndexTTS(cfg_path=f"{model_dir}/config.yaml", model_dir=model_dir, is_fp16=False, device=device)
+    gpt = tts.gpt
+    generator = torch.Generator().manual_seed(0)
+    repeats = 20
+    failed = []
+    print("batch | loop ms | batched ms | speedup")
+    for b in (1, 4, 16, 32, 64):
+        text_inputs = random_text_inputs(gpt, b, 80, generator).to(device)
+        for single_cond in (True, False):
+            conds = torch.randn((1 if single_cond else b, 32, gpt.model_dim), generator=generator).to(device)
+            with torch.no_grad():
+                expected = prepare_gpt_inputs_loop(gpt, conds, text_inputs)
+                outputs = gpt.prepare_gpt_inputs(conds, text_inputs)
+            if not all(torch.equal(x, y) for x, y in zip(outputs, expected)):
+                failed.append((b, single_cond))
+        timings = []
+        for fn in (lambda: prepare_gpt_inputs_loop(gpt, conds, text_inputs),
+                   lambda: gpt.prepare_gpt_inputs(conds, text_inputs)):
+            with torch.no_grad():
+                fn()
+                if device.startswith("cuda"):
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    fn()
+                if device.startswith("cuda"):
+                    torch.cuda.synchronize()
+            timings.append((time.perf_counter() - start) / repeats * 1000)
+        print(f"{b:>5} | {timings[0]:>7.2f} | {timings[1]:>10.2f} | {timings[0] / timings[1]:>6.1f}x")
+    if failed:
+        print("prepare_gpt_inputs mismatch (batch, single_cond):", failed)
+        sys.exit(1)
+    print("OK")
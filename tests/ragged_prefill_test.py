@@ -0,0 +1,76 @@
+import sys
+import time
+
+import torch
+import torchaudio
+from indextts.gpt.generation import StaticKVCache
+from indextts.infer import IndexTTS
+from indextts.utils.feature_extractors import MelSpectrogramFeatures
+
+TEXTS = [
+    "Hello world.",
+    "There is a vehicle arriving in dock number 7?",
+    "晕XUAN4是一种GAN3觉",
+    "The quick brown fox jumps over the lazy dog, and then it runs into the forest to look for something to eat "
+    "before the night falls on the quiet little village by the river.",
+]
+
+if __name__ == "__main__":
+    """
+    Check that the ragged prefill of the native engine (the padding of the shorter sentences is skipped)
+    gives the same codes and latents as the padded prefill for a batch of mixed-length sentences,
+    and time both prefills.
+    ```
+    python tests/ragged_prefill_test.py checkpoints
+    python tests/ragged_prefill_test.py checkpoints cuda:0
+    ```
+    """
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else "checkpoints"
+    device = sys.argv[2] if len(sys.argv) > 2 else "cpu"
+    tts = IndexTTS(cfg_path=f"{model_dir}/config.yaml", model_dir=model_dir, is_fp16=False, device=device)
+    gpt, engine = tts.gpt, tts.gpt.native_decoder
+    audio, sr = torchaudio.load("tests/sample_prompt.wav")
+    audio = torchaudio.transforms.Resample(sr, 24000)(torch.mean(audio, dim=0, keepdim=True))
+    auto_conditioning = MelSpectrogramFeatures()(audio).to(tts.device)
+    text_tokens = tts.pad_tokens_cat([torch.tensor([tts.tokenizer.encode(text)], dtype=torch.int32, device=tts.device)
+                                      for text in TEXTS])
+    with torch.no_grad():
+        conds_latent = gpt.get_conditioning(auto_conditioning,
+                                            torch.tensor([auto_conditioning.shape[-1]], device=tts.device))
+    failed = []
+    for name, kwargs in (("greedy", dict(do_sample=False, num_beams=1, repetition_penalty=10.0)),
+                         ("beam search", dict(do_sample=False, num_beams=3, length_penalty=0.0,
+                                              repetition_penalty=10.0))):
+        results = {}
+        for ragged in (False, True):
+            with torch.no_grad():
+                results[ragged] = gpt.inference_speech(None, text_tokens, conds_latent=conds_latent,
+                                                       max_generate_length=100, return_latent=True,
+                                                       decode_engine="native", ragged_prefill=ragged, **kwargs)
+        (codes, latents), (ragged_codes, ragged_latents) = results[False], results[True]
+        same_codes = codes.shape == ragged_codes.shape and torch.equal(codes, ragged_codes)
+        valid = (torch.cumsum((codes == gpt.stop_mel_token).long(), dim=1) == 0).unsqueeze(-1)
+        latent_diff = ((latents - ragged_latents) * valid).abs().max().item() if same_codes else float("nan")
+        ok = same_codes and latent_diff <= 1e-4
+        print(f"{name:12s} {'OK' if ok else 'FAIL'} codes {tuple(codes.shape)}, latent max diff {latent_diff:.2e}")
+        if not ok:
+            failed.append(name)
+
+    # prefill only, with the repeated mixed-length batch
+    for repeat in (1, 4, 16):
+        input_ids, mel_emb, attention_mask = gpt.prepare_gpt_inputs(conds_latent, text_tokens.repeat(repeat, 1))
+        timings = []
+        for ragged in (False, True):
+            with torch.no_grad():
+                embeds = engine.embed_prefill(mel_emb, input_ids)
+                start = time.perf_counter()
+                for _ in range(5):
+                    cache = StaticKVCache(len(engine.transformer.h), input_ids.shape[1])
+                    engine.prefill(embeds, attention_mask, cache, ragged=ragged)
+                timings.append((time.perf_counter() - start) / 5 * 1000)
+        padding = 1 - attention_mask.float().mean().item()
+        print(f"prefill {input_ids.shape[0]:>3} rows x {input_ids.shape[1]} positions, {padding:.0%} padding: "
+              f"padded {timings[0]:.1f}ms, ragged {timings[1]:.1f}ms")
+    if failed:
+        print("ragged prefill mismatch:", failed)
+        sys.exit(1)
@@ -0,0 +1,54 @@
+import sys
+
+import torch
+from indextts.utils.runaway_guard import RunawayGuard
+
+STOP, SILENT, PROMPT = 8193, 52, 5
+
+
+def run(guard, rows, steps_from):
+    """Feed the guard the growing prefixes of ``rows``, return the step at which each row got the stop token forced."""
+    input_ids = torch.tensor(rows)
+    stopped = [None] * len(rows)
+    for length in range(PROMPT + steps_from, input_ids.shape[1] + 1):
+        scores = guard(input_ids[:, :length], torch.zeros((len(rows), STOP + 1)))
+        for i in range(len(rows)):
+            if stopped[i] is None and scores[i].argmax() == STOP:
+                stopped[i] = length - PROMPT
+    return stopped
+
+
+if __name__ == "__main__":
+    """
+    Check that `RunawayGuard` stops the rows stuck in silence or in a short token loop once, at the expected step,
+    and leaves the other rows alone.
+    ```
+    python tests/runaway_guard_test.py
+    ```
+    """
+    generator = torch.Generator().manual_seed(0)
+    speech = torch.randint(100, 8000, (200,), generator=generator).tolist()
+    prompt = [1] * (PROMPT - 1) + [8192]
+    rows = [
+        prompt + speech,                                          # normal speech
+        prompt + speech[:20] + [SILENT] * 100 + speech[:80],      # silence run from step 20
+        prompt + speech[:30] + [11, 12, 13] * 40 + speech[:50],   # loop of period 3 from step 30
+        prompt + speech[:40] + [SILENT] * 20 + speech[:140],      # short pause
+        prompt + speech[:10] + [STOP] * 190,                      # finished row padded with the stop token
+    ]
+    guard = RunawayGuard(STOP, PROMPT, PROMPT + 300, max_silent_tokens=60, max_loop_period=8, min_loop_length=60)
+    stopped = run(guard, rows, 1)
+    expected = [None, 20 + 60, 30 + 60, None, None]
+    stats = guard.stats
+    expected_stats = {"silence_stops": 1, "loop_stops": 1, "tokens_saved": (300 - 80 - 1) + (300 - 90 - 1)}
+    print("stopped at:", stopped, "expected:", expected)
+    print("stats:", stats, "expected:", expected_stats)
+
+    # counting only, every runaway is counted once
+    counter = RunawayGuard(STOP, PROMPT, PROMPT + 300, force_stop=False)
+    assert run(counter, rows, 1) == [None] * len(rows)
+    print("count only:", counter.stats)
+    if stopped != expected or stats != expected_stats or counter.stats != expected_stats:
+        print("runaway guard mismatch")
+        sys.exit(1)
+    print("OK")
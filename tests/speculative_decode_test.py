@@ -0,0 +1,83 @@
+import sys
+import time
+
+import torch
+import torchaudio
+import transformers
+from indextts.infer import IndexTTS
+from indextts.utils.feature_extractors import MelSpectrogramFeatures
+
+if __name__ == "__main__":
+    """
+    Check the self-speculative decoding of the native engine (`draft_layers`):
+        - greedy decoding gives the same codes and latents as the normal native decoding, also for a batch
+        - sampling keeps the distribution of the first tokens (histograms of many rows)
+    and compare the tokens/s with the normal decoding.
+    ```
+    python tests/speculative_decode_test.py checkpoints
+    python tests/speculative_decode_test.py checkpoints cpu 12 4
+    ```
+    """
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else "checkpoints"
+    device = sys.argv[2] if len(sys.argv) > 2 else "cpu"
+    tts = IndexTTS(cfg_path=f"{model_dir}/config.yaml", model_dir=model_dir, is_fp16=False, device=device)
+    num_layers = len(tts.gpt.inference_model.transformer.h)
+    draft_layers = int(sys.argv[3]) if len(sys.argv) > 3 else max(1, num_layers // 2)
+    num_draft_tokens = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+    audio, sr = torchaudio.load("tests/sample_prompt.wav")
+    audio = torchaudio.transforms.Resample(sr, 24000)(torch.mean(audio, dim=0, keepdim=True))
+    auto_conditioning = MelSpectrogramFeatures()(audio).to(tts.device)
+    with torch.no_grad():
+        conds_latent = tts.gpt.get_conditioning(auto_conditioning,
+                                                torch.tensor([auto_conditioning.shape[-1]], device=tts.device))
+    speculative = dict(draft_layers=draft_layers, num_draft_tokens=num_draft_tokens)
+
+    def generate(text_tokens, max_generate_length, **kwargs):
+        start = time.perf_counter()
+        with torch.no_grad():
+            codes, latents = tts.gpt.inference_speech(None, text_tokens, conds_latent=conds_latent,
+                                                      max_generate_length=max_generate_length, return_latent=True,
+                                                      decode_engine="native", **kwargs)
+        return codes, latents, time.perf_counter() - start
+
+    failed = []
+    single = torch.tensor([tts.tokenizer.encode("There is a vehicle arriving in dock number 7?")],
+                          dtype=torch.int32, device=tts.device)
+    batch = tts.pad_tokens_cat([torch.tensor([tts.tokenizer.encode(text)], dtype=torch.int32, device=tts.device)
+                                for text in ("Hello world.", "There is a vehicle arriving in dock number 7?",
+                                             "晕XUAN4是一种GAN3觉")])
+    greedy = dict(do_sample=False, num_beams=1, repetition_penalty=10.0)
+    for name, text_tokens in (("greedy", single), ("greedy batch", batch)):
+        codes, latents, base_time = generate(text_tokens, 200, **greedy)
+        spec_codes, spec_latents, spec_time = generate(text_tokens, 200, **greedy, **speculative)
+        stats = tts.gpt.native_decoder.last_stats
+        same_codes = codes.shape == spec_codes.shape and torch.equal(codes, spec_codes)
+        valid = (torch.cumsum((codes == tts.gpt.stop_mel_token).long(), dim=1) == 0).unsqueeze(-1)
+        latent_diff = ((latents - spec_latents) * valid).abs().max().item() if same_codes else float("nan")
+        ok = same_codes and latent_diff <= 1e-4
+        print(f"{name:14s} {'OK' if ok else 'FAIL'} codes {tuple(codes.shape)}, latent max diff {latent_diff:.2e}, "
+              f"{codes.numel() / base_time:.1f} -> {spec_codes.numel() / spec_time:.1f} tokens/s, "
+              f"accepted {stats['accepted']}/{stats['drafted']} drafts, {stats['steps']} full forwards")
+        if not ok:
+            failed.append(name)
+
+    # sampling: histograms of the first tokens of many rows, against the normal sampling and its own noise
+    rows, length = 1500, 3
+    sampling = dict(do_sample=True, top_k=8, temperature=1.0, num_beams=1, repetition_penalty=2.0)
+    many = single.repeat(rows, 1)
+    histograms = []
+    for seed, kwargs in ((0, sampling), (1, sampling), (0, {**sampling, **speculative})):
+        transformers.set_seed(seed)
+        codes = generate(many, length, **kwargs)[0]
+        histograms.append([torch.bincount(codes[:, i], minlength=tts.gpt.number_mel_codes).float() / rows
+                           for i in range(length)])
+    noise = max((a - b).abs().sum().item() / 2 for a, b in zip(histograms[0], histograms[1]))
+    distance = max((a - b).abs().sum().item() / 2 for a, b in zip(histograms[0], histograms[2]))
+    ok = distance <= max(2 * noise, 0.05)
+    print(f"sampling       {'OK' if ok else 'FAIL'} total variation of the first {length} tokens: "
+          f"speculative {distance:.3f}, two seeds {noise:.3f}")
+    if not ok:
+        failed.append("sampling")
+    if failed:
+        print("speculative decode mismatch:", failed)
+        sys.exit(1)
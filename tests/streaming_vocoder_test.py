@@ -0,0 +1,50 @@
+import sys
+import time
+
+import torch
+from indextts.BigVGAN.streaming import StreamingVocoder, to_pcm16
+from indextts.infer import IndexTTS
+
+if __name__ == "__main__":
+    """
+    Check that `StreamingVocoder` gives the same int16 PCM as vocoding the whole latent sequence at once,
+    for latents pushed frame by frame or by chunks, and compare the time to the first chunk.
+    ```
+    python tests/streaming_vocoder_test.py checkpoints
+    python tests/streaming_vocoder_test.py checkpoints cuda:0
+    ```
+    """
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else "checkpoints"
+    device = sys.argv[2] if len(sys.argv) > 2 else "cpu"
+    tts = IndexTTS(cfg_path=f"{model_dir}/config.yaml", model_dir=model_dir, is_fp16=False, device=device)
+    speaker = tts.get_speaker_conditioning("tests/sample_prompt.wav")
+    generator = torch.Generator().manual_seed(0)
+    failed = []
+    for length, chunk in ((10, 1), (100, 1), (100, 7), (250, 25)):
+        latents = torch.randn((1, length, tts.cfg.bigvgan.gpt_dim), generator=generator).to(device)
+        start = time.perf_counter()
+        with torch.no_grad():
+            wav, _ = tts.bigvgan(latents, None, speaker_embedding=speaker.speaker_embedding)
+        full_time = time.perf_counter() - start
+        expected = to_pcm16(wav.squeeze(1)[0]).cpu()
+        vocoder = StreamingVocoder(tts.bigvgan, speaker_embedding=speaker.speaker_embedding)
+        start = time.perf_counter()
+        first_chunk_time = None
+        chunks = []
+        for pcm in vocoder.stream(latents[:, i:i + chunk] for i in range(0, length, chunk)):
+            if first_chunk_time is None:
+                first_chunk_time = time.perf_counter() - start
+            chunks.append(pcm.cpu())
+        stream_time = time.perf_counter() - start
+        pcm = torch.cat(chunks)
+        # float rounding of the convolutions can move a sample to the next int16 value
+        diff = (pcm.int() - expected.int()).abs().max().item() if pcm.shape == expected.shape else float("nan")
+        ok = diff <= 1
+        print(f"{'OK  ' if ok else 'FAIL'} {length} frames pushed by {chunk}: {len(chunks)} chunks, "
+              f"max int16 diff {diff}, context {vocoder.context_frames} frames, "
+              f"first chunk {first_chunk_time:.3f}s / full decoding {full_time:.3f}s, streaming total {stream_time:.3f}s")
+        if not ok:
+            failed.append(f"{length}/{chunk}")
+    if failed:
+        print("streaming vocoder mismatch:", failed)
+        sys.exit(1)
@@ -19,6 +19,8 @@ parser.add_argument("--port", type=int, default=7860, help="Port to run the web
 parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to run the web UI on")
 parser.add_argument("--model_dir", type=str, default="checkpoints", help="Model checkpoints directory")
 parser.add_argument("--language", type=str, default="auto", help="UI language (auto, en_US, zh_CN)")
+parser.add_argument("--batching", type=int, default=0,
+                    help="Serve concurrent requests with continuous batching, max number of sentences decoded together (0 to disable)")
 cmd_args = parser.parse_args()
 
 if not os.path.exists(cmd_args.model_dir):
@@ -55,7 +57,13 @@ else:
 
 i18n = I18nAuto(language=language)
 MODE = 'local'
-tts = IndexTTS(model_dir=cmd_args.model_dir, cfg_path=os.path.join(cmd_args.model_dir, "config.yaml"),)
+tts = IndexTTS(model_dir=cmd_args.model_dir, cfg_path=os.path.join(cmd_args.model_dir, "config.yaml"), lazy_load=True)
+# load the models in the background, the UI (and the sentence preview, which only needs the tokenizer) is ready earlier
+tts.preload()
+if cmd_args.batching > 0:
+    tts.enable_batching(max_batch_size=cmd_args.batching)
+# 开启连续批处理时允许多个请求同时推理, 否则逐个排队
+queue_kwargs = {"default_concurrency_limit": cmd_args.batching} if cmd_args.batching > 0 else {}
 
 
 os.makedirs("outputs/tasks",exist_ok=True)
@@ -77,8 +85,8 @@ def gen_single(prompt, text, infer_mode, max_text_tokens_per_sentence=120, sente
                 *args, progress=gr.Progress()):
     output_path = None
     if not output_path:
-        output_path = os.path.join("outputs", f"spk_{int(time.time())}.wav")
-    # set gradio progress
+        output_path = os.path.join("outputs", f"spk_{int(time.time())}_{threading.get_ident()}.wav")
+    # set gradio progress (per request thread, see `IndexTTS.gr_progress`)
     tts.gr_progress = progress
     do_sample, top_p, top_k, temperature, \
         length_penalty, num_beams, repetition_penalty, max_mel_tokens = args
@@ -464,7 +472,7 @@ if __name__ == "__main__":
         if use_tunnel:
             print("🌐 Additional tunnel URLs available (see above)")
 
-        demo.queue(20)
+        demo.queue(20, **queue_kwargs)
         demo.launch(
             server_name="0.0.0.0",
             server_port=cmd_args.port,
@@ -481,7 +489,7 @@ if __name__ == "__main__":
             print("🔗 Interface will be available in Kaggle's output panel")
             print("⚠️  For public access, try running with --host 0.0.0.0")
 
-        demo.queue(20)
+        demo.queue(20, **queue_kwargs)
         demo.launch(
             server_name="0.0.0.0",
             server_port=cmd_args.port,
@@ -496,7 +504,7 @@ if __name__ == "__main__":
             print("🌐 Public access via tunnel URLs (see above)")
         print(f"🏠 Local access: http://{cmd_args.host}:{cmd_args.port}")
 
-        demo.queue(20)
+        demo.queue(20, **queue_kwargs)
         demo.launch(
             server_name=cmd_args.host,
             server_port=cmd_args.port,